@@ -1,8 +1,113 @@
+import asyncio
 import base64
+import io
+import json
+import logging
+import math
 import os
 import re
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import List, Dict, Any
 
+from asgiref.sync import sync_to_async
+
+from .cache import get_response_cache, make_key
+from . import metrics, prompt
+from .conf import setting
+from .resilience import FATAL, classify, failover_enabled, get_scheduler
+from .singleflight import get_singleflight
+from .streaming import ColorScanner
+
+logger = logging.getLogger(__name__)
+
+
+
+class ConnectionStats:
+    """Counts requests and new TCP/TLS connections seen by one pooled HTTP client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+
+    def on_request(self, request) -> None:
+        request.extensions["trace"] = self._trace
+        with self._lock:
+            self.requests += 1
+
+    async def on_request_async(self, request) -> None:
+        request.extensions["trace"] = self._trace_async
+        with self._lock:
+            self.requests += 1
+
+    async def _trace_async(self, event_name: str, info: Dict[str, Any]) -> None:
+        self._trace(event_name, info)
+
+    def _trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.connections += 1
+        elif event_name == "connection.start_tls.complete":
+            with self._lock:
+                self.tls_handshakes += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            reused = max(self.requests - self.connections, 0)
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reused_requests": reused,
+                "reuse_ratio": (reused / self.requests) if self.requests else 0.0,
+            }
+
+
+def _pool_config():
+    import httpx  # type: ignore
+    conf = setting("COLORSENSE_HTTP_POOL", {}) or {}
+    limits = httpx.Limits(
+        max_connections=int(conf.get("MAX_CONNECTIONS", 50)),
+        max_keepalive_connections=int(conf.get("MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(conf.get("KEEPALIVE_EXPIRY", 60)),
+    )
+    timeout = httpx.Timeout(float(conf.get("TIMEOUT", 60)), connect=float(conf.get("CONNECT_TIMEOUT", 5)))
+    return httpx, limits, timeout
+
+
+def _pooled_http_client(stats: ConnectionStats):
+    """Keep-alive httpx client sized by COLORSENSE_HTTP_POOL; None if httpx is unavailable."""
+    try:
+        httpx, limits, timeout = _pool_config()
+    except Exception:
+        return None
+    return httpx.Client(limits=limits, timeout=timeout, event_hooks={"request": [stats.on_request]})
+
+
+def _pooled_async_http_client(stats: ConnectionStats):
+    """Async counterpart of :func:`_pooled_http_client`."""
+    try:
+        httpx, limits, timeout = _pool_config()
+    except Exception:
+        return None
+    return httpx.AsyncClient(limits=limits, timeout=timeout, event_hooks={"request": [stats.on_request_async]})
+
+
+def _api_key(name: str) -> str:
+    api_key = os.environ.get(name)
+    if not api_key:
+        api_key = setting(name, None)
+    if not api_key:
+        raise RuntimeError(f"{name} is not set in environment or Django settings.")
+    return api_key
+
+
+def _base_url(name: str):
+    """Provider endpoint override (e.g. a local stub server); None means the SDK default."""
+    return os.environ.get(name) or setting(name, None)
 
 
 # AI client wrapper (supports OpenAI and Groq)
@@ -10,47 +115,109 @@ class AIClient:
     def __init__(self, provider: str = "openai"):
         self._client = None
         self._provider = provider.lower()
+        self._stats = ConnectionStats()
+        self._api_key = None
+        # Async SDK clients are bound to the event loop their pool was opened on.
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
         
         if self._provider == "groq":
             self._init_groq()
+        elif self._provider == "stub":
+            self._init_stub()
         else:
             self._init_openai()
     
     def _init_openai(self):
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            try:
-                from django.conf import settings as dj_settings  # type: ignore
-                api_key = getattr(dj_settings, "OPENAI_API_KEY", None)
-            except Exception:
-                api_key = None
-        if not api_key:
-            raise RuntimeError("OPENAI_API_KEY is not set in environment or Django settings.")
-        
+        api_key = self._api_key = _api_key("OPENAI_API_KEY")
         try:
             from openai import OpenAI  # type: ignore
-            self._client = OpenAI(api_key=api_key)
+            # Retries are ours (resilience.py); the SDK would retry blind to rate limits.
+            self._client = OpenAI(api_key=api_key, base_url=_base_url("OPENAI_BASE_URL"), max_retries=0,
+                                  http_client=_pooled_http_client(self._stats))
         except Exception:
             raise RuntimeError("OpenAI client initialization failed")
     
     def _init_groq(self):
-        api_key = os.environ.get("GROQ_API_KEY")
-        if not api_key:
-            try:
-                from django.conf import settings as dj_settings  # type: ignore
-                api_key = getattr(dj_settings, "GROQ_API_KEY", None)
-            except Exception:
-                api_key = None
-        if not api_key:
-            raise RuntimeError("GROQ_API_KEY is not set in environment or Django settings.")
-        
+        api_key = self._api_key = _api_key("GROQ_API_KEY")
         try:
             from groq import Groq  # type: ignore
-            self._client = Groq(api_key=api_key)
+            self._client = Groq(api_key=api_key, base_url=_base_url("GROQ_BASE_URL"), max_retries=0,
+                                http_client=_pooled_http_client(self._stats))
         except Exception:
             raise RuntimeError("Groq client initialization failed")
 
-    def chat(self, model: str, messages: List[Dict[str, Any]], response_format: Dict[str, Any] = None) -> str:
+    def _init_stub(self):
+        from . import stub
+        if not stub.enabled():
+            raise RuntimeError("The stub provider is disabled (COLORSENSE_STUB['ENABLED']).")
+        self._client = stub.StubClient()
+
+    def _async_client(self):
+        if self._provider == "stub":
+            from .stub import AsyncStubClient
+            return AsyncStubClient()
+        loop = asyncio.get_running_loop()
+        entry = self._async_clients.get(loop)
+        if entry is None:
+            with self._async_lock:
+                entry = self._async_clients.get(loop)
+                if entry is None:
+                    http_client = _pooled_async_http_client(self._stats)
+                    try:
+                        if self._provider == "groq":
+                            from groq import AsyncGroq  # type: ignore
+                            client = AsyncGroq(api_key=self._api_key, base_url=_base_url("GROQ_BASE_URL"),
+                                               max_retries=0, http_client=http_client)
+                        else:
+                            from openai import AsyncOpenAI  # type: ignore
+                            client = AsyncOpenAI(api_key=self._api_key, base_url=_base_url("OPENAI_BASE_URL"),
+                                                 max_retries=0, http_client=http_client)
+                    except Exception:
+                        raise RuntimeError(f"Async {self._provider} client initialization failed")
+                    entry = self._async_clients[loop] = (client, _close_with_loop(client))
+        return entry[0]
+
+    def _per_call_loop(self) -> bool:
+        """
+        Whether the running loop only lives for this call: async_to_sync starts
+        one per async view under WSGI, so a client pooled on it would never
+        reuse a connection.
+        """
+        from asgiref.sync import AsyncToSync
+
+        return self._provider != "stub" and asyncio.get_running_loop() in AsyncToSync.loop_thread_executors
+
+    def _acreate(self, kwargs: Dict[str, Any]):
+        """
+        Awaitable completion request. On a per-call loop it goes through the
+        pooled sync client in a worker thread (cancelling then stops waiting but
+        not the request); on a long-lived loop through that loop's async client.
+        """
+        if self._per_call_loop():
+            if kwargs.get("stream"):
+                async def stream():
+                    return _iterate_in_thread(await asyncio.to_thread(self._client.chat.completions.create, **kwargs))
+                return stream()
+            return asyncio.to_thread(self._client.chat.completions.create, **kwargs)
+        return self._async_client().chat.completions.create(**kwargs)
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return self._stats.snapshot()
+
+    def _failover(self, exc: Exception, messages: List[Dict[str, Any]], failover: bool):
+        """The other provider's client and model for a call that failed here, or None."""
+        if not failover or self._provider == "stub" or not failover_enabled() or classify(exc)[0] == FATAL:
+            return None
+        other = "openai" if self._provider == "groq" else "groq"
+        try:
+            client = get_client(other)
+        except RuntimeError:
+            return None
+        get_scheduler().failed_over()
+        return client, _select_model(other, _has_images(messages))
+
+    def _request(self, model: str, messages: List[Dict[str, Any]], response_format: Dict[str, Any] = None):
         kwargs = {
             "model": model,
             "messages": messages,
@@ -58,10 +225,158 @@ class AIClient:
         }
         if response_format and self._provider == "openai":
             kwargs["response_format"] = response_format
-        
-        resp = self._client.chat.completions.create(**kwargs)
-        content = resp.choices[0].message.content or ""
-        
+
+        # Also the single-flight key, so it is built even when caching is off.
+        key = make_key(self._provider, model, messages, kwargs.get("response_format"), kwargs["temperature"])
+        return kwargs, get_response_cache(), key
+
+    async def _arequest(self, model: str, messages: List[Dict[str, Any]], response_format: Dict[str, Any] = None):
+        """
+        :meth:`_request` plus the cached reply (or None), kept off the event loop:
+        the key hashes every image, and the cache may be a database.
+        """
+        kwargs, cache, key = await asyncio.to_thread(self._request, model, messages, response_format)
+        cached = await sync_to_async(cache.get)(key) if cache is not None else None
+        return kwargs, cache, key, cached
+
+    def chat(self, model: str, messages: List[Dict[str, Any]], response_format: Dict[str, Any] = None,
+             timeout: float = None, failover: bool = True) -> str:
+        """
+        Completion text for ``messages``. Identical calls already in flight (in
+        any thread or event loop) are joined instead of sent again. Calls are
+        rate limited and retried per resilience.py; if this provider stays
+        unavailable the request fails over to the other one.
+        """
+        kwargs, cache, key = self._request(model, messages, response_format)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+
+        def call() -> str:
+            with metrics.span("provider.call", provider=self._provider, model=model):
+                resp = get_scheduler().call(
+                    self._provider, model, lambda: self._client.chat.completions.create(**kwargs))
+            metrics.record_tokens(self._provider, model, getattr(resp, "usage", None))
+            content = self._clean(resp.choices[0].message.content or "")
+            if cache is not None:
+                cache.set(key, content)
+            return content
+
+        try:
+            return get_singleflight().do(key, call)
+        except Exception as e:
+            fallback = self._failover(e, messages, failover)
+            if fallback is None:
+                raise
+            client, fallback_model = fallback
+            return client.chat(fallback_model, messages, response_format, timeout, failover=False)
+
+    async def achat(self, model: str, messages: List[Dict[str, Any]], response_format: Dict[str, Any] = None,
+                    timeout: float = None, failover: bool = True) -> str:
+        """
+        Non-blocking :meth:`chat`. Cancelling the awaiting task aborts the HTTP
+        request unless other callers are sharing it.
+        """
+        kwargs, cache, key, cached = await self._arequest(model, messages, response_format)
+        if cached is not None:
+            return cached
+
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+
+        async def call() -> str:
+            with metrics.span("provider.call", provider=self._provider, model=model):
+                resp = await get_scheduler().acall(self._provider, model, lambda: self._acreate(kwargs))
+            metrics.record_tokens(self._provider, model, getattr(resp, "usage", None))
+            content = self._clean(resp.choices[0].message.content or "")
+            if cache is not None:
+                await sync_to_async(cache.set)(key, content)
+            return content
+
+        try:
+            return await get_singleflight().ado(key, call)
+        except Exception as e:
+            fallback = self._failover(e, messages, failover)
+            if fallback is None:
+                raise
+            client, fallback_model = fallback
+            return await client.achat(fallback_model, messages, response_format, timeout, failover=False)
+
+    async def astream(self, model: str, messages: List[Dict[str, Any]], response_format: Dict[str, Any] = None,
+                      timeout: float = None, failover: bool = True):
+        """
+        Async generator of completion text deltas. A cached reply, or one shared
+        with an identical call already in flight, is yielded in one piece; a
+        streamed one is cached once it completes. Opening the stream is retried
+        and can fail over; once text has been yielded an error is final.
+        """
+        started = False
+        try:
+            async for delta in self._astream(model, messages, response_format, timeout):
+                started = True
+                yield delta
+        except Exception as e:
+            fallback = None if started else self._failover(e, messages, failover)
+            if fallback is None:
+                raise
+            client, fallback_model = fallback
+            async for delta in client.astream(fallback_model, messages, response_format, timeout, failover=False):
+                yield delta
+
+    async def _astream(self, model: str, messages: List[Dict[str, Any]], response_format: Dict[str, Any] = None,
+                       timeout: float = None):
+        kwargs, cache, key, cached = await self._arequest(model, messages, response_format)
+        if cached is not None:
+            yield cached
+            return
+
+        flight = get_singleflight()
+        call, leader = flight.join(key)
+        if not leader:
+            yield await flight.await_call(call)
+            return
+
+        content = error = None
+        try:
+            if timeout is not None:
+                kwargs["timeout"] = timeout
+            kwargs["stream"] = True
+            if self._provider == "openai":
+                # Adds a final chunk carrying token usage.
+                kwargs["stream_options"] = {"include_usage": True}
+            parts: List[str] = []
+            with metrics.span("provider.stream", provider=self._provider, model=model):
+                stream = await get_scheduler().acall(self._provider, model, lambda: self._acreate(kwargs))
+                async for chunk in stream:
+                    # OpenAI reports usage on the chunk, Groq under x_groq on the last one.
+                    usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+                    if usage is not None:
+                        metrics.record_tokens(self._provider, model, usage)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+            content = self._clean("".join(parts))
+            if cache is not None:
+                await sync_to_async(cache.set)(key, content)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Resolved exactly once: the result, the provider error, or an interruption (cancel / close).
+            if content is not None:
+                flight.resolve(key, call, content)
+            else:
+                flight.resolve(key, call, error=error or RuntimeError("The shared request was interrupted."))
+            flight.leave(call)
+
+    def _clean(self, content: str) -> str:
         # Clean Groq response - remove markdown code blocks
         if self._provider == "groq" and content.startswith("```"):
             lines = content.split("\n")
@@ -71,26 +386,250 @@ class AIClient:
         return content
 
 
+def _close_with_loop(client):
+    """
+    Close ``client`` when its event loop shuts down: asyncio.run() and
+    loop.shutdown_asyncgens() finalize suspended async generators, and this one
+    closes the client on the way out. Keep the returned generator alive.
+    """
+    async def closer():
+        try:
+            yield
+        finally:
+            await client.close()
+
+    agen = closer()
+    try:
+        agen.asend(None).send(None)
+    except StopIteration:
+        pass
+    return agen
+
+
+async def _iterate_in_thread(stream):
+    """Async iterator over a blocking SDK stream, reading each chunk in a worker thread."""
+    end = object()
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, stream, end)
+            if chunk is end:
+                return
+            yield chunk
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+
+_clients: Dict[str, AIClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(provider: str = "openai") -> AIClient:
+    """Process-wide AIClient for ``provider``, built on first use and shared across threads."""
+    name = provider.lower()
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = AIClient(name)
+                _clients[name] = client
+    return client
+
+
+def client_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Connection reuse counters for every client built so far."""
+    return {name: client.pool_stats() for name, client in list(_clients.items())}
+
+
+def resilience_stats() -> Dict[str, Any]:
+    """Retries, throttling, failovers, breaker states and adapted request rates."""
+    return get_scheduler().stats()
+
+
+def coalescing_stats() -> Dict[str, int]:
+    """Provider calls made (leaders), calls that joined one in flight (coalesced), and calls in flight."""
+    return get_singleflight().stats()
+
+
+def _image_options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_IMAGE", {}) or {}
+    return {
+        "max_edge": int(conf.get("MAX_EDGE", 1024)),
+        "format": str(conf.get("FORMAT", "JPEG")).upper(),
+        "quality": int(conf.get("QUALITY", 85)),
+    }
+
+
+def preprocess_image(data: bytes, max_edge: int = None, fmt: str = None, quality: int = None) -> Dict[str, Any]:
+    """
+    Decode an image, apply its EXIF orientation, downscale it to ``max_edge`` and
+    re-encode it without metadata. Returns the new bytes, content type, size and
+    the byte counts before and after.
+    """
+    opts = _image_options()
+    max_edge = max_edge or opts["max_edge"]
+    fmt = (fmt or opts["format"]).upper()
+    quality = quality or opts["quality"]
+    result = {
+        "data": data,
+        "content_type": "application/octet-stream",
+        "width": None,
+        "height": None,
+        "bytes_in": len(data),
+        "bytes_out": len(data),
+    }
+    try:
+        from PIL import Image, ImageOps  # type: ignore
+    except Exception:
+        return result
+
+    try:
+        with metrics.span("image.decode"):
+            img = Image.open(io.BytesIO(data))
+            source_format = img.format
+            result["content_type"] = Image.MIME.get(source_format, result["content_type"])
+            orientation = img.getexif().get(0x0112, 1)
+            has_metadata = bool(img.info.get("exif") or img.info.get("icc_profile") or img.info.get("xmp"))
+            if (source_format == fmt and max(img.size) <= max_edge and orientation == 1 and not has_metadata):
+                # Already what we would produce (e.g. an image we preprocessed earlier).
+                result["width"], result["height"] = img.size
+                return result
+
+            # Let the JPEG decoder skip DCT scales we are about to throw away.
+            img.draft("RGB", (max_edge, max_edge))
+            img = ImageOps.exif_transpose(img)
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1])
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    except Exception as e:
+        raise ValueError(f"Could not decode image: {e}")
+
+    out = io.BytesIO()
+    with metrics.span("image.encode"):
+        if fmt == "WEBP":
+            img.save(out, format="WEBP", quality=quality, method=4)
+        else:
+            fmt = "JPEG"
+            img.save(out, format="JPEG", quality=quality, optimize=True, progressive=True)
+    encoded = out.getvalue()
+    result.update({
+        "data": encoded,
+        "content_type": Image.MIME[fmt],
+        "width": img.size[0],
+        "height": img.size[1],
+        "bytes_out": len(encoded),
+    })
+    return result
+
+
+def to_data_url(data: bytes, content_type: str) -> str:
+    with metrics.span("image.base64"):
+        b64 = base64.b64encode(data).decode("utf-8")
+        return f"data:{content_type};base64,{b64}"
+
+
 def file_to_data_url(upload) -> str:
-    """Convert Django UploadedFile (image) to data URL for OpenAI vision input."""
-    content_type = getattr(upload, "content_type", "application/octet-stream")
-    data = upload.read()
-    b64 = base64.b64encode(data).decode("utf-8")
-    return f"data:{content_type};base64,{b64}"
-
-
-def build_messages(user_text: str, image_data_urls: List[str], doc_texts: List[str]) -> List[Dict[str, Any]]:
-    system_prompt = (
-        "You are PaintSense, a smart paint consultant.\n"
-        "Given a user's room description, style preferences, and optional images of the space,\n"
-        "recommend 3-5 paint color options with HEX codes (format: #RRGGBB), finishes (eggshell/matte/semi-gloss), and brief rationales.\n"
-        "If images are provided, analyze the lighting, existing furniture colors, wall colors, and undertones.\n"
-        "Be concise and practical. Always include HEX codes for each color recommendation.\n"
-        "Close with preparation tips.\n"
-        "Example format: 'Warm White (#F5F5DC) in eggshell finish would complement your space...'\n"
-        "Please provide your response in JSON format with the recommendations.\n"
-        "Recommendations should be per image."
-    )
+    """Convert Django UploadedFile (image) to a preprocessed data URL for vision input."""
+    return image_to_data_url(upload)[0]
+
+
+def image_to_data_url(image: Any):
+    """Preprocess an upload or data URL; returns ``(data_url, stats)``."""
+    if isinstance(image, str):
+        header, payload = image.split(",", 1)
+        content_type = header[len("data:"):].split(";", 1)[0] or "application/octet-stream"
+        data = base64.b64decode(payload)
+    else:
+        content_type = getattr(image, "content_type", "application/octet-stream")
+        data = image.read()
+    info = preprocess_image(data)
+    if info["content_type"] == "application/octet-stream":
+        info["content_type"] = content_type
+    stats = {k: info[k] for k in ("content_type", "width", "height", "bytes_in", "bytes_out")}
+    return to_data_url(info["data"], info["content_type"]), stats
+
+
+def prepare_images(image_uploads: List[Any]):
+    """Convert uploads, stored image refs and data/http URLs to vision-ready URLs; returns ``(urls, stats)``."""
+    from .image_store import ImageRef, load
+
+    image_data_urls: List[str] = []
+    image_stats: List[Dict[str, Any]] = []
+    for img in image_uploads:
+        try:
+            # Stored images were preprocessed on upload; just load the bytes
+            if isinstance(img, ImageRef):
+                data, content_type = load(img.id)
+                image_data_urls.append(to_data_url(data, content_type))
+                image_stats.append({"content_type": content_type, "width": None, "height": None,
+                                    "bytes_in": len(data), "bytes_out": len(data)})
+            # Handle file objects
+            elif hasattr(img, "content_type") and getattr(img, "content_type", "").startswith("image/"):
+                url, stats = image_to_data_url(img)
+                image_data_urls.append(url)
+                image_stats.append(stats)
+            # Handle data URLs
+            elif isinstance(img, str) and img.startswith("data:image/"):
+                url, stats = image_to_data_url(img)
+                image_data_urls.append(url)
+                image_stats.append(stats)
+            # Regular URLs are fetched by the provider
+            elif isinstance(img, str) and img.startswith("http"):
+                image_data_urls.append(img)
+        finally:
+            # Only seek if it's a file object
+            if hasattr(img, "seek"):
+                img.seek(0)
+    return image_data_urls, image_stats
+
+
+_SYSTEM_PROMPT = (
+    "You are PaintSense, a smart paint consultant.\n"
+    "Given a user's room description, style preferences, and optional images of the space,\n"
+    "recommend 3-5 paint color options with HEX codes (format: #RRGGBB), finishes (eggshell/matte/semi-gloss), and brief rationales.\n"
+    "If images are provided, analyze the lighting, existing furniture colors, wall colors, and undertones.\n"
+    "Be concise and practical. Always include HEX codes for each color recommendation.\n"
+    "Close with preparation tips.\n"
+    "Example format: 'Warm White (#F5F5DC) in eggshell finish would complement your space...'\n"
+    "Please provide your response in JSON format with the recommendations.\n"
+    "Recommendations should be per image."
+)
+
+# Task instructions live in the system prompt, not the user text, so they are
+# sent once per request and the prompt prefix stays identical across calls.
+_SUMMARY_INSTRUCTIONS = (
+    "Task: elaborate on and summarize the user's room description.\n"
+    'Return the response in JSON format: {"reply": {"image": string, "room_description": string}}'
+)
+
+_SUGGESTION_INSTRUCTIONS = (
+    "Please provide your response in JSON format with the recommendations, as follows:\n\n"
+    '"recommendations": [ {"image": "small description eg bed room, kitchen etc","colors": [{"color": "string",'
+    '"hex": "string","finish": "string","rationale": "string"}]}],"preparationtips": "string"'
+)
+
+
+def _system_prompt(instructions: str = None) -> str:
+    return _SYSTEM_PROMPT + "\n\n" + instructions if instructions else _SYSTEM_PROMPT
+
+
+def build_messages(user_text: str, image_data_urls: List[str], doc_texts: List[str],
+                   color_notes: List[str] = None, instructions: str = None,
+                   image_detail: str = None, preferences: str = None) -> List[Dict[str, Any]]:
+    """
+    Chat messages for one request. ``doc_texts`` are sent as given; fit them to
+    the token budget first (see :func:`_prompt_for`). ``preferences`` is the
+    user's profile summary (reflection.py); it goes in the user message so the
+    system prompt stays the same for everyone.
+    """
+    system_prompt = _system_prompt(instructions)
 
     # Build user message content
     content_parts = []
@@ -101,8 +640,16 @@ def build_messages(user_text: str, image_data_urls: List[str], doc_texts: List[s
         text_content.append(user_text)
     
     if doc_texts:
-        joined = "\n\n".join(doc_texts)[:6000]  # keep prompt size reasonable
+        joined = "\n\n".join(doc_texts)
         text_content.append(f"Additional notes from documents:\n{joined}")
+
+    if color_notes:
+        # Measured locally from the photos (see palette.py)
+        notes = "\n".join(f"Photo {i}: {note}" for i, note in enumerate(color_notes, 1))
+        text_content.append(f"Color analysis of the room photos:\n{notes}")
+
+    if preferences:
+        text_content.append(f"What this client liked and rejected before:\n{preferences}")
     
     if not text_content and not image_data_urls:
         text_content.append("Suggest paint colors for my space.")
@@ -117,11 +664,12 @@ def build_messages(user_text: str, image_data_urls: List[str], doc_texts: List[s
     # Add images for vision API
     if image_data_urls:
         for image_url in image_data_urls:
+            image = {"url": image_url}
+            if image_detail:
+                image["detail"] = image_detail
             content_parts.append({
                 "type": "image_url",
-                "image_url": {
-                    "url": image_url
-                }
+                "image_url": image
             })
 
     return [
@@ -135,82 +683,438 @@ def extract_hex_codes(text: str) -> List[str]:
 
 
 
-def run_agent(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq") -> Dict[str, Any]:
-    """
-    Orchestrate the process: summarize inputs, confirm summary, and generate paint suggestions.
-    Returns dict with 'reply' and 'swatches' (list of hex codes).
-    """
-    client = AIClient(provider)
+def match_paints(swatches: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """Nearest catalog paints for each swatch (see catalog.py); empty without a catalog."""
+    try:
+        from .catalog import match_swatches
+        return match_swatches(swatches)
+    except Exception:
+        logger.exception("Paint catalog lookup failed")
+        return {}
 
-    # Convert images to data URLs
-    image_data_urls: List[str] = []
-    for img in image_uploads:
-        try:
-            # Handle file objects
-            if hasattr(img, "content_type") and getattr(img, "content_type", "").startswith("image/"):
-                image_data_urls.append(file_to_data_url(img))
-            # Handle string URLs (data URLs or regular URLs)
-            elif isinstance(img, str) and (img.startswith("data:image/") or img.startswith("http")):
-                image_data_urls.append(img)
-        finally:
-            # Only seek if it's a file object
-            if hasattr(img, "seek"):
-                img.seek(0)
 
-    # Read document texts
-    doc_texts: List[str] = []
+def _read_docs(doc_uploads: List[Any]) -> List[str]:
+    """Paragraph chunks of the uploaded documents, streamed from the uploads (see prompt.py)."""
+    doc_chunks: List[str] = []
     for doc in doc_uploads:
         try:
             name = getattr(doc, "name", "doc")
             if name.lower().endswith((".txt", ".md")):
-                raw = doc.read().decode("utf-8", errors="ignore")
-                doc_texts.append(raw[:8000])
+                doc_chunks.extend(prompt.chunk_text(prompt.read_document(doc)))
             else:
                 # Unsupported types for now
                 pass
         finally:
             doc.seek(0)
+    return doc_chunks
+
+
+def _has_images(messages: List[Dict[str, Any]]) -> bool:
+    content = messages[-1]["content"]
+    return isinstance(content, list) and any(part.get("type") == "image_url" for part in content)
+
 
-    # Select model based on provider and image presence
+def _select_model(provider: str, has_images: bool) -> str:
     if provider == "groq":
-        model = "meta-llama/llama-4-maverick-17b-128e-instruct"
-    else:
-        model = "gpt-4o" if image_data_urls else "gpt-4o-mini"
+        return "meta-llama/llama-4-maverick-17b-128e-instruct"
+    return "gpt-4o" if has_images else "gpt-4o-mini"
+
+
+def _palette_options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_PALETTE", {}) or {}
+    return {
+        "enabled": bool(conf.get("ENABLED", True)),
+        "vision": bool(conf.get("VISION", True)),
+        "colors": int(conf.get("COLORS", 5)),
+        "sample_edge": int(conf.get("SAMPLE_EDGE", 128)),
+    }
+
+
+def analyze_colors(image_data_urls: List[str]) -> Dict[str, str]:
+    """
+    Local color analysis of each data URL image; returns ``{url: summary}``.
+    Remote URLs and images that fail to decode are left out.
+    """
+    opts = _palette_options()
+    if not opts["enabled"]:
+        return {}
+    try:
+        from . import palette
+    except ImportError:
+        return {}
+    notes: Dict[str, str] = {}
+    for url in image_data_urls:
+        if url in notes or not url.startswith("data:"):
+            continue
+        with metrics.span("image.palette"):
+            analysis = palette.analyze_many([base64.b64decode(url.split(",", 1)[1])],
+                                            colors=opts["colors"], sample_edge=opts["sample_edge"])[0]
+        if analysis is not None:
+            notes[url] = palette.summarize(analysis)
+    return notes
+
+
+def _sent_images(urls: List[str], notes: Dict[str, str], vision: bool) -> List[str]:
+    """Images sent as pixels: analysed photos are sent as text only when ``vision`` is off."""
+    return urls if vision else [url for url in urls if url not in notes]
+
+
+def _prompt_for(user_text: str, urls: List[str], doc_chunks: List[str], notes: Dict[str, str], vision: bool,
+                model: str, instructions: str = None, preferences: str = None):
+    """
+    Messages for ``urls`` fitted to ``model``'s token budget (see prompt.py), and
+    the token report for them. Returns ``(messages, report)``.
+    """
+    with metrics.span("prompt.build"):
+        images = _sent_images(urls, notes, vision)
+        color_notes = [notes[url] for url in urls if url in notes]
+        plan = prompt.plan_prompt(model, _system_prompt(instructions), user_text, color_notes, doc_chunks, images,
+                                  low_detail=model.startswith("gpt-"), preferences=preferences or "")
+        messages = build_messages(user_text=plan.user_text, image_data_urls=images, doc_texts=plan.doc_texts,
+                                  color_notes=plan.notes, instructions=instructions, image_detail=plan.image_detail,
+                                  preferences=preferences)
+        report = plan.report
+        report["tokens"]["total"] = prompt.count_messages(messages, model)
+    return messages, report
+
+
+def _request_groups(urls: List[str], vision: bool, fan_out: bool) -> List[List[str]]:
+    """Images per request: one request per image when fanning out, otherwise all in one."""
+    if vision and fan_out and len(urls) > 1:
+        return [[url] for url in urls]
+    return [urls]
+
+
+def _fanout_options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_FANOUT", {}) or {}
+    return {
+        "enabled": bool(conf.get("ENABLED", False)),
+        "concurrency": max(int(conf.get("CONCURRENCY", 4)), 1),
+        "timeout": float(conf.get("TIMEOUT", 60)),
+    }
+
+
+def merge_replies(replies: List[Any]):
+    """
+    Merge per-image JSON replies into one object in image order.
+    List values are concatenated, single objects become list entries and repeated
+    strings (e.g. preparation tips) are de-duplicated. Returns ``(merged, errors)``.
+    """
+    merged: Dict[str, Any] = {}
+    errors: List[Dict[str, Any]] = []
+    for index, reply in enumerate(replies):
+        if reply is None:
+            # Failed upstream; already reported by the caller.
+            continue
+        try:
+            with metrics.span("json.parse"):
+                data = json.loads(reply)
+        except (TypeError, ValueError):
+            errors.append({"image": index, "error": "Provider reply was not valid JSON."})
+            continue
+        if not isinstance(data, dict):
+            data = {"reply": data}
+        for key, value in data.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            elif isinstance(value, dict):
+                merged.setdefault(key, []).append(value)
+            elif isinstance(value, str):
+                existing = merged.get(key)
+                if not existing:
+                    merged[key] = value
+                elif value and value not in existing:
+                    merged[key] = existing + "\n" + value
+            else:
+                merged.setdefault(key, value)
+    return merged, errors
+
+
+def _fan_out(client: AIClient, model: str, requests: List[List[Dict[str, Any]]], response_format: Dict[str, Any]):
+    """Send one completion per image (``requests`` holds each one's messages) concurrently; returns ``(replies, errors)`` in image order."""
+    opts = _fanout_options()
+    workers = min(opts["concurrency"], len(requests))
+
+    def one(messages: List[Dict[str, Any]]) -> str:
+        return client.chat(model=model, messages=messages, response_format=response_format, timeout=opts["timeout"])
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="colorsense-fanout")
+    try:
+        futures = [executor.submit(one, messages) for messages in requests]
+        # Each call is bounded by the provider timeout; this is the backstop for queued work.
+        waves = math.ceil(len(futures) / workers)
+        wait(futures, timeout=opts["timeout"] * waves + 5)
+        replies: List[Any] = []
+        errors: List[Dict[str, Any]] = []
+        for index, future in enumerate(futures):
+            if not future.done():
+                replies.append(None)
+                errors.append({"image": index, "error": "Timed out."})
+            elif future.exception() is not None:
+                replies.append(None)
+                errors.append({"image": index, "error": str(future.exception())})
+            else:
+                replies.append(future.result())
+        return replies, errors
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _combine_fan_out(replies: List[Any], errors: List[Dict[str, Any]]) -> str:
+    if all(r is None for r in replies):
+        raise RuntimeError(errors[0]["error"] if errors else "All image requests failed.")
+    merged, parse_errors = merge_replies(replies)
+    errors.extend(parse_errors)
+    return json.dumps(merged)
+
+
+async def _afan_out(client: AIClient, model: str, requests: List[List[Dict[str, Any]]],
+                    response_format: Dict[str, Any]):
+    """Async :func:`_fan_out`: a semaphore caps concurrency and each image gets its own timeout."""
+    opts = _fanout_options()
+    semaphore = asyncio.Semaphore(opts["concurrency"])
+
+    async def one(messages: List[Dict[str, Any]]) -> str:
+        async with semaphore:
+            return await asyncio.wait_for(
+                client.achat(model=model, messages=messages, response_format=response_format, timeout=opts["timeout"]),
+                timeout=opts["timeout"] + 5,
+            )
+
+    results = await asyncio.gather(*(one(messages) for messages in requests), return_exceptions=True)
+    replies: List[Any] = []
+    errors: List[Dict[str, Any]] = []
+    for index, result in enumerate(results):
+        if isinstance(result, asyncio.TimeoutError):
+            replies.append(None)
+            errors.append({"image": index, "error": "Timed out."})
+        elif isinstance(result, BaseException):
+            replies.append(None)
+            errors.append({"image": index, "error": str(result)})
+        else:
+            replies.append(result)
+    return replies, errors
+
+
+def run_agent(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq",
+              fan_out: bool = None, vision: bool = None, instructions: str = None,
+              preferences: str = None) -> Dict[str, Any]:
+    """
+    Orchestrate the process: summarize inputs, confirm summary, and generate paint suggestions.
+    Returns dict with 'reply' and 'swatches' (list of hex codes).
+
+    With ``fan_out`` (default: COLORSENSE_FANOUT['ENABLED']) and several images, one
+    request is sent per image concurrently and the JSON replies are merged; images
+    that fail are listed under 'errors' instead of failing the whole reply.
+
+    Each photo is also analysed locally (palette.py) and the summary is added to
+    the prompt. With ``vision`` off (default: COLORSENSE_PALETTE['VISION']) only
+    that summary is sent, so the request can go to the cheaper text model.
+
+    Prompts are fitted to a token budget (prompt.py); ``instructions`` are added to
+    the system prompt and ``preferences`` (the user's profile summary, see
+    reflection.py) to the user message. 'prompt' in the result has the token
+    report of every request sent.
+    """
+    client = get_client(provider)
+    if fan_out is None:
+        fan_out = _fanout_options()["enabled"]
+
+    if vision is None:
+        vision = _palette_options()["vision"]
+
+    # Convert images to downscaled, metadata-free data URLs
+    image_data_urls, image_stats = prepare_images(image_uploads)
+    notes = analyze_colors(image_data_urls)
+
+    # Read document chunks
+    doc_chunks = _read_docs(doc_uploads)
+
+    # Select model based on provider and whether any image is still sent as pixels
+    model = _select_model(provider, bool(_sent_images(image_data_urls, notes, vision)))
+    groups = _request_groups(image_data_urls, vision, fan_out)
+    prompts = [_prompt_for(user_text, urls, doc_chunks, notes, vision, model, instructions, preferences) for urls in groups]
     
     # Generate paint suggestions directly
     response_format = { "type": "json_object" }
-    messages = build_messages(user_text=user_text, image_data_urls=image_data_urls, doc_texts=doc_texts)
-    reply = client.chat(model=model, messages=messages, response_format=response_format)
-    swatches = extract_hex_codes(reply)
+    errors: List[Dict[str, Any]] = []
+    if len(groups) > 1:
+        replies, errors = _fan_out(client, model, [messages for messages, _ in prompts], response_format)
+        reply = _combine_fan_out(replies, errors)
+    else:
+        reply = client.chat(model=model, messages=prompts[0][0], response_format=response_format)
+    with metrics.span("reply.parse"):
+        swatches = extract_hex_codes(reply)
     
 
     return {
         "reply": reply,
         "swatches": swatches,
+        "paints": match_paints(swatches),
+        "image_stats": image_stats,
+        "errors": errors,
+        "prompt": [report for _, report in prompts],
     }
     
 
+async def arun_agent(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq",
+                     fan_out: bool = None, vision: bool = None, instructions: str = None,
+                     preferences: str = None) -> Dict[str, Any]:
+    """
+    Async :func:`run_agent` for ASGI views. Image preprocessing runs in a worker
+    thread and provider calls use the async SDK clients, so the event loop is never
+    blocked; cancelling the task (e.g. on client disconnect) aborts in-flight calls.
+    """
+    client = get_client(provider)
+    if fan_out is None:
+        fan_out = _fanout_options()["enabled"]
+
+    if vision is None:
+        vision = _palette_options()["vision"]
+
+    image_data_urls, image_stats = await asyncio.to_thread(prepare_images, image_uploads)
+    notes = await asyncio.to_thread(analyze_colors, image_data_urls)
+    doc_chunks = await asyncio.to_thread(_read_docs, doc_uploads)
+    model = _select_model(provider, bool(_sent_images(image_data_urls, notes, vision)))
+    groups = _request_groups(image_data_urls, vision, fan_out)
+    prompts = await asyncio.to_thread(
+        lambda: [_prompt_for(user_text, urls, doc_chunks, notes, vision, model, instructions, preferences) for urls in groups])
+
+    response_format = { "type": "json_object" }
+    errors: List[Dict[str, Any]] = []
+    if len(groups) > 1:
+        replies, errors = await _afan_out(client, model, [messages for messages, _ in prompts], response_format)
+        reply = _combine_fan_out(replies, errors)
+    else:
+        reply = await client.achat(model=model, messages=prompts[0][0], response_format=response_format)
+    with metrics.span("reply.parse"):
+        swatches = extract_hex_codes(reply)
+
+    return {
+        "reply": reply,
+        "swatches": swatches,
+        "paints": await asyncio.to_thread(match_paints, swatches),
+        "image_stats": image_stats,
+        "errors": errors,
+        "prompt": [report for _, report in prompts],
+    }
+
+
+async def astream_agent(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq",
+                        fan_out: bool = None, vision: bool = None, instructions: str = None,
+                        preferences: str = None):
+    """
+    Streaming :func:`arun_agent`. Yields ``(event, data)`` pairs: a ``color`` event
+    for every color object as soon as it is complete in the stream, ``error`` for
+    images that failed, and a final ``done`` carrying the same dict as run_agent.
+    """
+    client = get_client(provider)
+    opts = _fanout_options()
+    if fan_out is None:
+        fan_out = opts["enabled"]
+
+    if vision is None:
+        vision = _palette_options()["vision"]
+
+    image_data_urls, image_stats = await asyncio.to_thread(prepare_images, image_uploads)
+    notes = await asyncio.to_thread(analyze_colors, image_data_urls)
+    doc_chunks = await asyncio.to_thread(_read_docs, doc_uploads)
+    model = _select_model(provider, bool(_sent_images(image_data_urls, notes, vision)))
+    response_format = { "type": "json_object" }
+    groups = _request_groups(image_data_urls, vision, fan_out)
+    prompts = await asyncio.to_thread(
+        lambda: [_prompt_for(user_text, urls, doc_chunks, notes, vision, model, instructions, preferences) for urls in groups])
+
+    queue: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(opts["concurrency"])
+
+    async def pump(index: int, messages: List[Dict[str, Any]]) -> None:
+        scanner = ColorScanner()
+
+        async def consume() -> None:
+            async for delta in client.astream(model=model, messages=messages,
+                                              response_format=response_format, timeout=opts["timeout"]):
+                for color in scanner.feed(delta):
+                    await queue.put(("color", {"image": index, "color": color}))
+
+        try:
+            async with semaphore:
+                await asyncio.wait_for(consume(), timeout=opts["timeout"] + 5)
+            await queue.put(("reply", (index, client._clean(scanner.text))))
+        except Exception as e:
+            error = "Timed out." if isinstance(e, asyncio.TimeoutError) else str(e)
+            await queue.put(("error", {"image": index, "error": error}))
+
+    tasks = [asyncio.create_task(pump(i, messages)) for i, (messages, _) in enumerate(prompts)]
+    replies: List[Any] = [None] * len(groups)
+    errors: List[Dict[str, Any]] = []
+    try:
+        pending = len(tasks)
+        while pending:
+            event, data = await queue.get()
+            if event == "reply":
+                replies[data[0]] = data[1]
+                pending -= 1
+            elif event == "error":
+                errors.append(data)
+                pending -= 1
+                yield event, data
+            else:
+                yield event, data
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if len(groups) > 1:
+        reply = _combine_fan_out(replies, errors)
+    elif replies[0] is None:
+        raise RuntimeError(errors[0]["error"] if errors else "Request failed.")
+    else:
+        reply = replies[0]
+    with metrics.span("reply.parse"):
+        swatches = extract_hex_codes(reply)
+    yield "done", {
+        "reply": reply,
+        "swatches": swatches,
+        "paints": await asyncio.to_thread(match_paints, swatches),
+        "image_stats": image_stats,
+        "errors": errors,
+        "prompt": [report for _, report in prompts],
+    }
+
+
 def summrise_input(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq") -> Dict[str, Any]:
     """Summarize user inputs with focus on room details."""
-    # Modify the user text to request summarization
-    reply = '{"reply":[{"image":"image1","room_description":"The room is a modern bedroom with a sleek design. It features a teal bed and matching chair, with striped wallpaper and green accents. The room has a polished floor, minimalistic furniture, and decorative elements like a basketball and framed pictures."},{"image":"image2","room_description":"This is a cozy living room with light yellow walls and a traditional style. The furniture is upholstered in beige and covered with patterned white and gray covers. The room has a few decorative pictures, curtains with a black and white pattern, and a small plant on the coffee table."},{"image":"image3","room_description":"The kitchen is designed in a contemporary style with a combination of white and rich red cabinetry. It features a light countertop with a speckled pattern, and the walls have a neutral tone. The kitchen is organized with hanging utensils, potted plants, and open shelving for storage."}]}'
-    # return {
-    #     "reply": reply,
-    #     "swatches": []
-    # }
-    summary_request = f"Please elaborate and summarize the following room description: {user_text}" + "retrun response in json format {'reply':{image: string,room_description:string}}"
-    return run_agent(user_text=summary_request, image_uploads=image_uploads, doc_uploads=doc_uploads)
+    # Canned replies for offline runs live in stub.py (get_client("stub")).
+    return run_agent(user_text=user_text, image_uploads=image_uploads, doc_uploads=doc_uploads, provider=provider,
+                     instructions=_SUMMARY_INSTRUCTIONS)
 
 
-def paint_suggestion(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq") -> Dict[str, Any]:
+def paint_suggestion(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq",
+                     preferences: str = None) -> Dict[str, Any]:
     """Generate paint color suggestions based on user input."""
     # The run_agent function already has the paint consultant system prompt built-in
-    # reply = {"recommendations": [{"image": 1,"colors": [{"color": "Soft White","hex": "#F0F4F8","finish": "eggshell","rationale": "Soft White will brighten the room and provide a clean contrast to the bold turquoise elements, making them pop."},{"color": "Coral Pink","hex": "#FF6F61","finish": "matte","rationale": "Coral Pink adds warmth and a playful touch that complements the turquoise without overwhelming the space."},{"color": "Charcoal Gray","hex": "#333333","finish": "semi-gloss","rationale": "Charcoal Gray can add depth and sophistication, creating a modern edge against the vibrant colors."}]},{"image": 2,"colors": [{"color": "Creamy Beige","hex": "#E6D9C9","finish": "eggshell","rationale": "Creamy Beige will enhance the warm tones already present and create a seamless flow with the furniture."},{"color": "Warm Taupe","hex": "#C2B280","finish": "matte","rationale": "Warm Taupe adds a subtle contrast to the yellow walls while maintaining a cozy and inviting atmosphere."},{"color": "Soft Sage Green","hex": "#B7C9A3","finish": "matte","rationale": "Soft Sage Green introduces a refreshing element that complements the warm tones and adds a natural touch."}]},{"image": 3,"colors": [{"color": "Pale Gray","hex": "#D3D3D3","finish": "eggshell","rationale": "Pale Gray will provide a neutral backdrop that balances the bold red cabinetry and light countertops."},{"color": "Dusty Rose","hex": "#D6A8B4","finish": "matte","rationale": "Dusty Rose adds a soft, warm accent that harmonizes with the richness of the cabinetry without clashing."},{"color": "Muted Olive","hex": "#A8B95B","finish": "matte","rationale": "Muted Olive introduces a natural element that pairs well with the red cabinetry and adds depth to the space."}]}],"preparationtips": "Ensure surfaces are clean and free of dust. Use painters tape to protect edges and achieve clean lines. Test colors on small sections of the wall before fully committing."}
+    return run_agent(user_text=user_text, image_uploads=image_uploads, doc_uploads=doc_uploads, provider=provider,
+                     instructions=_SUGGESTION_INSTRUCTIONS, preferences=preferences)
+
+
+async def asummrise_input(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq") -> Dict[str, Any]:
+    """Async :func:`summrise_input`."""
+    return await arun_agent(user_text=user_text, image_uploads=image_uploads, doc_uploads=doc_uploads,
+                            provider=provider, instructions=_SUMMARY_INSTRUCTIONS)
+
+
+async def apaint_suggestion(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq",
+                            preferences: str = None) -> Dict[str, Any]:
+    """Async :func:`paint_suggestion`."""
+    return await arun_agent(user_text=user_text, image_uploads=image_uploads, doc_uploads=doc_uploads,
+                            provider=provider, instructions=_SUGGESTION_INSTRUCTIONS, preferences=preferences)
 
-    # return {
-    #     "reply": reply,
-    #     "swatches": []
-    # }
 
-    user_text = user_text + "\n\n" + "Please provide your response in JSON format with the recommendations. as follows:\n\n"+ '"recommendations": [ {"image": "small description eg bed room, kitchen etc","colors": [{"color": "string","hex": "string","finish": "string","rationale": "string"}]}],"preparationtips": "string"'              
-    return run_agent(user_text=user_text, image_uploads=image_uploads, doc_uploads=doc_uploads)    
+async def astream_paint_suggestion(user_text: str, image_uploads: List[Any], doc_uploads: List[Any], provider: str = "groq",
+                                   preferences: str = None):
+    """Streaming :func:`apaint_suggestion`; see :func:`astream_agent`."""
+    async for event in astream_agent(user_text=user_text, image_uploads=image_uploads, doc_uploads=doc_uploads,
+                                     provider=provider, instructions=_SUGGESTION_INSTRUCTIONS,
+                                     preferences=preferences):
+        yield event
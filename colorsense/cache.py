@@ -0,0 +1,300 @@
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from .conf import setting
+
+
+# Response cache in front of AIClient.chat.
+#
+# Keys are content addressed: provider, model, system prompt and the normalized
+# user parts. Images are hashed by their decoded bytes so the same photo sent as
+# a fresh data URL still hits.
+
+DEFAULT_TTL = 24 * 3600
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+def image_digest(url: str) -> str:
+    """Digest of an image reference; data URLs are hashed by their decoded bytes."""
+    if url.startswith("data:") and "," in url:
+        header, payload = url.split(",", 1)
+        if header.endswith(";base64"):
+            try:
+                data = base64.b64decode(payload)
+            except Exception:
+                data = payload.encode("utf-8")
+        else:
+            data = payload.encode("utf-8")
+        return "sha256:" + hashlib.sha256(data).hexdigest()
+    return "url:" + url
+
+
+def _normalize_content(content: Any) -> Any:
+    if isinstance(content, str):
+        return content.strip()
+    parts = []
+    for part in content or []:
+        kind = part.get("type")
+        if kind == "text":
+            parts.append(["text", (part.get("text") or "").strip()])
+        elif kind == "image_url":
+            url = (part.get("image_url") or {}).get("url", "")
+            parts.append(["image", image_digest(url)])
+        else:
+            parts.append([kind, json.dumps(part, sort_keys=True)])
+    return parts
+
+
+def make_key(provider: str, model: str, messages: List[Dict[str, Any]],
+             response_format: Optional[Dict[str, Any]] = None, temperature: float = None) -> str:
+    """Build a stable cache key for a chat completion request."""
+    payload = {
+        "provider": provider,
+        "model": model,
+        "temperature": temperature,
+        "response_format": response_format,
+        "messages": [[m.get("role"), _normalize_content(m.get("content"))] for m in messages],
+    }
+    blob = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """In-process LRU with TTL, bounded by entry count and total bytes."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.time() + ttl)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._data.pop(key)
+        self._bytes -= len(value)
+
+    def info(self) -> Dict[str, Any]:
+        return {"entries": len(self._data), "bytes": self._bytes, "evictions": self.evictions}
+
+
+class DjangoBackend:
+    """
+    Delegates to a configured Django cache alias; eviction is the cache's own.
+    Keys carry a generation number stored in the alias, so clear() drops only
+    the response entries (they expire unreferenced) and leaves the rest of a
+    shared cache alone.
+    """
+
+    def __init__(self, alias: str = "default", prefix: str = "colorsense:resp:"):
+        from django.core.cache import caches  # type: ignore
+        self._cache = caches[alias]
+        self._prefix = prefix
+
+    def _key(self, key: str) -> str:
+        generation = self._cache.get(self._prefix + "generation")
+        if generation is None:
+            # Seeded from the clock so a generation evicted from the cache never comes back.
+            self._cache.add(self._prefix + "generation", time.time_ns(), timeout=None)
+            generation = self._cache.get(self._prefix + "generation")
+        return f"{self._prefix}{generation}:{key}"
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(self._key(key))
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        self._cache.set(self._key(key), value, timeout=ttl)
+
+    def clear(self) -> None:
+        try:
+            self._cache.incr(self._prefix + "generation")
+        except ValueError:
+            # No generation yet, so nothing was stored under one.
+            self._cache.add(self._prefix + "generation", time.time_ns(), timeout=None)
+
+    def info(self) -> Dict[str, Any]:
+        return {}
+
+
+class SQLiteBackend:
+    """On-disk cache shared by every worker on the host."""
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES * 8,
+                 max_bytes: int = DEFAULT_MAX_BYTES * 8):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now + ttl, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM responses WHERE expires < ?", (now,))
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        while count > self.max_entries or total > self.max_bytes:
+            row = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            count -= 1
+            total -= row[1]
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": count, "bytes": total, "evictions": self.evictions}
+
+
+class ResponseCache:
+    """TTL cache of completion text with hit/miss counters."""
+
+    def __init__(self, backend, ttl: int = DEFAULT_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        if not value:
+            return
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception:
+            # A broken cache must never fail a consultation.
+            pass
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        data = {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+        data.update(self.backend.info())
+        return data
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def _build_cache() -> Optional[ResponseCache]:
+    conf = setting("COLORSENSE_RESPONSE_CACHE", {}) or {}
+    kind = str(conf.get("BACKEND", "memory")).lower()
+    ttl = int(conf.get("TTL", DEFAULT_TTL))
+    if kind in ("none", "off", "disabled"):
+        return None
+    if kind == "django":
+        backend = DjangoBackend(conf.get("DJANGO_CACHE", "default"))
+    elif kind == "sqlite":
+        path = conf.get("PATH") or os.path.join(setting("MEDIA_ROOT", "media"), "cache", "responses.sqlite3")
+        backend = SQLiteBackend(
+            path,
+            max_entries=int(conf.get("MAX_ENTRIES", DEFAULT_MAX_ENTRIES * 8)),
+            max_bytes=int(conf.get("MAX_BYTES", DEFAULT_MAX_BYTES * 8)),
+        )
+    else:
+        backend = MemoryBackend(
+            max_entries=int(conf.get("MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            max_bytes=int(conf.get("MAX_BYTES", DEFAULT_MAX_BYTES)),
+        )
+    return ResponseCache(backend, ttl=ttl)
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Process-wide response cache configured by ``COLORSENSE_RESPONSE_CACHE``; None when disabled."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = _build_cache() or False
+    return _cache or None
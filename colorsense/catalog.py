@@ -0,0 +1,261 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .conf import setting
+from .palette import rgb_to_lab
+
+try:
+    from scipy.spatial import cKDTree  # type: ignore
+except ImportError:  # pragma: no cover - brute force fallback below
+    cKDTree = None
+
+logger = logging.getLogger(__name__)
+
+
+# Manufacturer paint catalog with nearest-color lookup.
+#
+# Colors are loaded from CSV or JSON (columns/keys: name, hex and optionally
+# brand and code) into a float32 CIELAB array. Candidates are found by Euclidean
+# distance in Lab (a KD-tree when scipy is installed, a chunked brute-force scan
+# otherwise) and re-ranked by CIEDE2000. The compiled arrays are saved as a
+# plain .npz (no pickles) under the catalog's content digest so restarts skip
+# parsing and color conversion; the KD-tree is rebuilt from them on load.
+
+_FORMAT_VERSION = 2
+
+# Candidates re-ranked by CIEDE2000 per query. Euclidean Lab distance and
+# CIEDE2000 disagree mostly on order, not on neighbourhood, so a small pool is
+# enough to find the true CIEDE2000 nearest.
+_CANDIDATES = 16
+
+_BRAND_KEYS = ("brand", "manufacturer", "vendor")
+_CODE_KEYS = ("code", "sku", "id", "number")
+
+
+def ciede2000(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """CIEDE2000 color difference; inputs broadcast over their leading axes, shape (..., 3)."""
+    L1, a1, b1 = np.moveaxis(np.asarray(lab1, dtype=np.float64), -1, 0)
+    L2, a2, b2 = np.moveaxis(np.asarray(lab2, dtype=np.float64), -1, 0)
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    C7 = ((C1 + C2) / 2) ** 7
+    G = 0.5 * (1 - np.sqrt(C7 / (C7 + 25.0 ** 7)))
+    a1p = (1 + G) * a1
+    a2p = (1 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+    chroma_zero = (C1p * C2p) == 0
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, np.where(dhp < -180, dhp + 360, dhp))
+    dhp = np.where(chroma_zero, 0.0, dhp)
+    dHp = 2 * np.sqrt(C1p * C2p) * np.sin(np.radians(dhp / 2))
+
+    Lbar = (L1 + L2) / 2
+    Cbar = (C1p + C2p) / 2
+    hsum = h1p + h2p
+    hbar = np.where(
+        chroma_zero, hsum,
+        np.where(np.abs(h1p - h2p) <= 180, hsum / 2, np.where(hsum < 360, (hsum + 360) / 2, (hsum - 360) / 2)),
+    )
+    T = (1 - 0.17 * np.cos(np.radians(hbar - 30)) + 0.24 * np.cos(np.radians(2 * hbar))
+         + 0.32 * np.cos(np.radians(3 * hbar + 6)) - 0.20 * np.cos(np.radians(4 * hbar - 63)))
+    dtheta = 30 * np.exp(-(((hbar - 275) / 25) ** 2))
+    Cbar7 = Cbar ** 7
+    Rc = 2 * np.sqrt(Cbar7 / (Cbar7 + 25.0 ** 7))
+    Sl = 1 + 0.015 * (Lbar - 50) ** 2 / np.sqrt(20 + (Lbar - 50) ** 2)
+    Sc = 1 + 0.045 * Cbar
+    Sh = 1 + 0.015 * Cbar * T
+    Rt = -np.sin(np.radians(2 * dtheta)) * Rc
+    return np.sqrt((dLp / Sl) ** 2 + (dCp / Sc) ** 2 + (dHp / Sh) ** 2 + Rt * (dCp / Sc) * (dHp / Sh))
+
+
+def hex_to_lab(hexes: List[str]) -> np.ndarray:
+    rgb = np.array([[int(h.lstrip("#")[i:i + 2], 16) for i in (0, 2, 4)] for h in hexes], dtype=np.float32)
+    return rgb_to_lab(rgb.reshape(-1, 3) / 255.0).astype(np.float32)
+
+
+def _normalize_hex(value: str) -> Optional[str]:
+    value = (value or "").strip().lstrip("#")
+    if len(value) == 3:
+        value = "".join(c * 2 for c in value)
+    if len(value) != 6:
+        return None
+    try:
+        int(value, 16)
+    except ValueError:
+        return None
+    return "#" + value.upper()
+
+
+def _first(row: Dict[str, Any], keys) -> str:
+    for key in keys:
+        if row.get(key):
+            return str(row[key]).strip()
+    return ""
+
+
+def _read_rows(path: str) -> List[Dict[str, Any]]:
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        if isinstance(data, dict):
+            data = data.get("colors", [])
+        return [{str(k).lower(): v for k, v in row.items()} for row in data]
+    with open(path, newline="", encoding="utf-8-sig") as fh:
+        return [{(k or "").strip().lower(): v for k, v in row.items()} for row in csv.DictReader(fh)]
+
+
+class Catalog:
+    """Array-backed paint catalog; build with :meth:`from_rows` or :func:`load_catalog`."""
+
+    def __init__(self, brands: List[str], names: List[str], codes: List[str], hexes: List[str], lab: np.ndarray):
+        self.brands = brands
+        self.names = names
+        self.codes = codes
+        self.hexes = hexes
+        self.lab = lab
+        self.tree = cKDTree(lab) if cKDTree is not None and len(lab) else None
+        self._sq_norms = (lab ** 2).sum(axis=1)
+
+    @classmethod
+    def from_rows(cls, rows: List[Dict[str, Any]]) -> "Catalog":
+        brands, names, codes, hexes = [], [], [], []
+        for row in rows:
+            hex_code = _normalize_hex(str(row.get("hex", "")))
+            if hex_code is None:
+                continue
+            brands.append(_first(row, _BRAND_KEYS))
+            names.append(_first(row, ("name", "color", "colour")))
+            codes.append(_first(row, _CODE_KEYS))
+            hexes.append(hex_code)
+        lab = hex_to_lab(hexes) if hexes else np.zeros((0, 3), dtype=np.float32)
+        return cls(brands, names, codes, hexes, lab)
+
+    def __len__(self):
+        return len(self.hexes)
+
+    def _candidates(self, query: np.ndarray, k: int) -> np.ndarray:
+        if self.tree is not None:
+            _, index = self.tree.query(query, k=k)
+            return index.reshape(len(query), k)
+        # Chunked so a large catalog never materialises a huge distance matrix.
+        out = np.empty((len(query), k), dtype=np.int64)
+        for start in range(0, len(query), 64):
+            chunk = query[start:start + 64]
+            # |q - c|^2 without the per-query constant |q|^2, which does not change the order.
+            distances = self._sq_norms[None, :] - 2 * chunk @ self.lab.T
+            out[start:start + 64] = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return out
+
+    def nearest(self, hexes: List[str], k: int = 1) -> List[List[Dict[str, Any]]]:
+        """Up to ``k`` closest catalog paints per hex code by CIEDE2000, best first."""
+        valid = [_normalize_hex(h) for h in hexes]
+        queries = [h for h in valid if h]
+        if not queries or not len(self):
+            return [[] for _ in hexes]
+        query = hex_to_lab(queries)
+        pool = min(max(k, _CANDIDATES), len(self))
+        candidates = self._candidates(query, pool)
+        delta = ciede2000(query[:, None, :], self.lab[candidates])
+        order = np.argsort(delta, axis=1)[:, :k]
+
+        matches = iter(range(len(queries)))
+        results: List[List[Dict[str, Any]]] = []
+        for h in valid:
+            if not h:
+                results.append([])
+                continue
+            q = next(matches)
+            results.append([
+                {
+                    "brand": self.brands[i],
+                    "name": self.names[i],
+                    "code": self.codes[i],
+                    "hex": self.hexes[i],
+                    "delta_e": round(float(delta[q, j]), 2),
+                }
+                for j, i in ((j, int(candidates[q, j])) for j in order[q])
+            ])
+        return results
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_CATALOG", {}) or {}
+    media_root = setting("MEDIA_ROOT", "media")
+    return {
+        "path": conf.get("PATH"),
+        "cache_dir": conf.get("CACHE_DIR") or os.path.join(media_root, "cache"),
+        "matches": int(conf.get("MATCHES", 3)),
+    }
+
+
+def load_catalog(path: str, cache_dir: Optional[str] = None) -> Catalog:
+    """
+    Load a catalog file, reusing the arrays compiled from the same bytes when
+    ``cache_dir`` has them. The cache holds only numeric and string arrays and
+    is read with ``allow_pickle=False``, so a tampered file cannot run code.
+    """
+    with open(path, "rb") as fh:
+        digest = hashlib.sha256(fh.read()).hexdigest()
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f"catalog-{_FORMAT_VERSION}-{digest[:24]}.npz")
+        try:
+            with np.load(cache_path, allow_pickle=False) as data:
+                lab = data["lab"].astype(np.float32)
+                columns = [data[key].tolist() for key in ("brands", "names", "codes", "hexes")]
+            if lab.ndim == 2 and lab.shape[1] == 3 and all(len(c) == len(lab) for c in columns):
+                return Catalog(*columns, lab)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    catalog = Catalog.from_rows(_read_rows(path))
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{cache_path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp, lab=catalog.lab, brands=np.array(catalog.brands, dtype=str),
+                     names=np.array(catalog.names, dtype=str), codes=np.array(catalog.codes, dtype=str),
+                     hexes=np.array(catalog.hexes, dtype=str))
+            os.replace(tmp, cache_path)
+        except OSError:
+            logger.warning("Could not cache catalog index in %s", cache_dir, exc_info=True)
+    return catalog
+
+
+_catalog: Optional[Catalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> Optional[Catalog]:
+    """The configured catalog (COLORSENSE_CATALOG['PATH']), or None when there is none."""
+    global _catalog
+    if _catalog is None:
+        opts = _options()
+        if not opts["path"] or not os.path.exists(opts["path"]):
+            return None
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = load_catalog(opts["path"], opts["cache_dir"])
+    return _catalog
+
+
+def match_swatches(hexes: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """Snap suggested hex codes to purchasable paints: ``{hex: [closest paints]}``."""
+    catalog = get_catalog()
+    if catalog is None or not hexes:
+        return {}
+    unique = list(dict.fromkeys(hexes))
+    return dict(zip(unique, catalog.nearest(unique, k=_options()["matches"])))
@@ -0,0 +1,10 @@
+from typing import Any
+
+
+def setting(name: str, default: Any = None) -> Any:
+    """Read a COLORSENSE_* option from Django settings, falling back to ``default``."""
+    try:
+        from django.conf import settings as dj_settings  # type: ignore
+        return getattr(dj_settings, name, default)
+    except Exception:
+        return default
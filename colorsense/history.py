@@ -0,0 +1,304 @@
+import base64
+import hashlib
+import json
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import metrics
+from .conf import setting
+
+
+# Consultation history.
+#
+# Every answered summary / suggestion is written as a Consultation with its
+# image digests, room summaries and color recommendations (children go in with
+# one bulk insert each). The inputs are hashed into request_key: with REPLAY
+# on, an identical request made within REPLAY_TTL is answered from the stored
+# row instead of calling the provider again. Any past result can always be
+# fetched by its public id. Requests that
+# ask for human review are stored as pending and show up in the review queue,
+# which pages with a (created_at, id) keyset so deep pages cost the same as
+# the first.
+
+_HEX_RE = re.compile(r"#?([0-9a-fA-F]{6})\b")
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_HISTORY", {}) or {}
+    return {
+        "enabled": bool(conf.get("ENABLED", True)),
+        "replay": bool(conf.get("REPLAY", False)),
+        "replay_ttl": float(conf.get("REPLAY_TTL", 3600) or 0),
+        "page_size": max(int(conf.get("PAGE_SIZE", 50)), 1),
+        "docs_max_chars": int(conf.get("DOCS_MAX_CHARS", 20000)),
+    }
+
+
+def enabled() -> bool:
+    return _options()["enabled"]
+
+
+def image_digests(images: List[Any]) -> List[str]:
+    """Content digests of request images: store ids as they are, data URLs by their bytes, other URLs by the URL."""
+    from .cache import image_digest
+
+    digests = []
+    for image in images:
+        if hasattr(image, "id"):
+            digests.append(image.id)
+            continue
+        digest = image_digest(image)
+        if digest.startswith("sha256:"):
+            digests.append(digest[len("sha256:"):])
+        else:
+            digests.append(hashlib.sha256(digest.encode("utf-8")).hexdigest())
+    return digests
+
+
+def read_docs(doc_uploads: List[Any]) -> Tuple[str, str]:
+    """
+    ``(text, digest)`` of the uploaded notes: the text as stored for review
+    (capped at DOCS_MAX_CHARS) and a digest of all of it for the request key.
+    """
+    from .prompt import read_document
+
+    limit = _options()["docs_max_chars"]
+    digest = hashlib.sha256()
+    parts: List[str] = []
+    size = 0
+    for doc in doc_uploads:
+        if parts:
+            parts.append("\n\n")
+        for piece in read_document(doc):
+            digest.update(piece.encode("utf-8"))
+            if size < limit:
+                parts.append(piece[:limit - size])
+                size += len(parts[-1])
+        digest.update(b"\0")
+    return "".join(parts), digest.hexdigest() if doc_uploads else ""
+
+
+def request_key(kind: str, provider: str, user_text: str, digests: List[str], docs_digest: str,
+                preferences: str = "") -> str:
+    """Hash of everything that shapes the answer, including the profile summary sent with it."""
+    payload = json.dumps([kind, provider, user_text, digests, docs_digest, preferences], separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def normalize_hexes(values: List[str]) -> List[str]:
+    """``#RRGGBB`` codes found in ``values``, upper-cased and de-duplicated in order."""
+    found = []
+    for value in values:
+        found.extend("#" + h.upper() for h in _HEX_RE.findall(value or ""))
+    return list(dict.fromkeys(found))
+
+
+def parse_reply(kind: str, reply: str, swatches: List[str]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    ``(summaries, recommendations)`` from a provider reply. Recommendations come
+    from the structured colors when the reply has them, otherwise from the
+    swatches extracted from the text.
+    """
+    try:
+        data = json.loads(reply)
+    except (TypeError, ValueError):
+        data = {}
+    if not isinstance(data, dict):
+        data = {"reply": data}
+
+    summaries = []
+    if kind == "summary":
+        entries = data.get("reply", [])
+        for entry in entries if isinstance(entries, list) else [entries]:
+            if isinstance(entry, dict) and entry.get("room_description"):
+                summaries.append({"image": str(entry.get("image", ""))[:255],
+                                  "description": str(entry["room_description"])})
+
+    recommendations = []
+    rooms = data.get("recommendations", [])
+    for room in rooms if isinstance(rooms, list) else [rooms]:
+        if not isinstance(room, dict):
+            continue
+        for color in room.get("colors") or []:
+            if not isinstance(color, dict):
+                continue
+            hexes = normalize_hexes([str(color.get("hex", ""))])
+            if hexes:
+                recommendations.append({
+                    "room": str(room.get("image", ""))[:255],
+                    "name": str(color.get("color", ""))[:128],
+                    "hex": hexes[0],
+                    "finish": str(color.get("finish", ""))[:32],
+                    "rationale": str(color.get("rationale", "")),
+                })
+    if not recommendations:
+        recommendations = [{"room": "", "name": "", "hex": h, "finish": "", "rationale": ""}
+                           for h in normalize_hexes(swatches)]
+    return summaries, recommendations
+
+
+def _children(consultation, summaries, recommendations):
+    from .catalog import hex_to_lab
+    from .models import ColorRecommendation, RoomSummary
+
+    RoomSummary.objects.bulk_create([
+        RoomSummary(consultation=consultation, position=i, **summary) for i, summary in enumerate(summaries)
+    ])
+    if recommendations:
+        labs = hex_to_lab([rec["hex"] for rec in recommendations])
+        ColorRecommendation.objects.bulk_create([
+            ColorRecommendation(consultation=consultation, position=i, lab_l=float(lab[0]), lab_a=float(lab[1]),
+                                lab_b=float(lab[2]), **rec)
+            for i, (rec, lab) in enumerate(zip(recommendations, labs))
+        ])
+
+
+def record(kind: str, provider: str, user_text: str, digests: List[str], docs: str, result: Dict[str, Any],
+           key: str, review: bool = False):
+    """Store an answered request and its children; returns the Consultation."""
+    from django.db import transaction
+    from .models import Consultation, ConsultationImage
+
+    reply = result.get("reply", "")
+    swatches = result.get("swatches", [])
+    summaries, recommendations = parse_reply(kind, reply, swatches)
+    with metrics.span("history.record"), transaction.atomic():
+        consultation = Consultation.objects.create(
+            request_key=key, kind=kind, provider=provider, user_text=user_text, docs_text=docs,
+            reply=reply, swatches=swatches, paints=result.get("paints", {}), errors=result.get("errors", []),
+            status=Consultation.PENDING if review else Consultation.COMPLETED,
+        )
+        ConsultationImage.objects.bulk_create([
+            ConsultationImage(consultation=consultation, position=i, digest=digest) for i, digest in enumerate(digests)
+        ])
+        _children(consultation, summaries, recommendations)
+    return consultation
+
+
+def replay(key: str) -> Optional[Dict[str, Any]]:
+    """
+    The stored answer to the request hashed as ``key`` (the latest completed or
+    approved one without errors, no older than REPLAY_TTL seconds) as a
+    :func:`payload`, or None. Off unless COLORSENSE_HISTORY['REPLAY'] is set.
+    """
+    from datetime import timedelta
+    from django.utils import timezone
+    from .models import Consultation
+
+    opts = _options()
+    if not opts["replay"]:
+        return None
+    rows = Consultation.objects.filter(request_key=key, status__in=[Consultation.COMPLETED, Consultation.APPROVED])
+    if opts["replay_ttl"]:
+        rows = rows.filter(created_at__gte=timezone.now() - timedelta(seconds=opts["replay_ttl"]))
+    consultation = rows.prefetch_related("images").order_by("-created_at", "-id").first()
+    if consultation is None or consultation.errors:
+        return None
+    return payload(consultation, replayed=True)
+
+
+def payload(consultation, replayed: bool = False) -> Dict[str, Any]:
+    """A stored consultation in the shape run_agent returns, plus its id and review status."""
+    return {
+        "reply": consultation.reply,
+        "swatches": consultation.swatches,
+        "paints": consultation.paints,
+        "errors": consultation.errors,
+        "image_ids": [image.digest for image in consultation.images.all()],
+        "consultation": consultation.public_id,
+        "status": consultation.status,
+        "replayed": replayed,
+    }
+
+
+def get(public_id: str):
+    """Consultation by public id; raises LookupError if there is none."""
+    from .models import Consultation
+
+    try:
+        return Consultation.objects.prefetch_related("images").get(public_id=public_id)
+    except Consultation.DoesNotExist:
+        raise LookupError("Unknown consultation.")
+
+
+def encode_cursor(consultation) -> str:
+    raw = f"{consultation.created_at.isoformat()}|{consultation.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, pk = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid page cursor.")
+
+
+def page(status: Optional[str] = None, cursor: Optional[str] = None, color: Optional[str] = None,
+         limit: Optional[int] = None):
+    """
+    One page of consultations, newest first: ``(rows, next_cursor)``. Filters by
+    ``status`` and by a recommended ``color`` (hex). Pages continue strictly
+    after the cursor row, so the query is an index range scan at any depth
+    instead of an OFFSET that reads and discards every earlier row.
+    """
+    from django.db.models import Exists, OuterRef, Q
+    from .models import ColorRecommendation, Consultation
+
+    limit = limit or _options()["page_size"]
+    rows = Consultation.objects.only("id", "created_at", "kind", "status", "provider", "user_text")
+    if status:
+        rows = rows.filter(status=status)
+    if color:
+        hexes = normalize_hexes([color])
+        if not hexes:
+            raise ValueError(f"Invalid color: {color!r}")
+        rows = rows.filter(Exists(ColorRecommendation.objects.filter(consultation=OuterRef("pk"), hex=hexes[0])))
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        rows = rows.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    rows = list(rows.order_by("-created_at", "-id")[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def review(consultation, approve: bool, reviewer=None, reply: Optional[str] = None,
+           swatches_text: Optional[str] = None, notes: str = ""):
+    """
+    Approve or reject a consultation. An approval may edit the reply and the
+    swatches; the stored recommendations are rebuilt from the edited version.
+    """
+    from django.db import transaction
+    from django.utils import timezone
+    from .models import ColorRecommendation, Consultation, RoomSummary
+
+    with transaction.atomic():
+        consultation.status = Consultation.APPROVED if approve else Consultation.REJECTED
+        consultation.review_notes = notes or ""
+        consultation.reviewed_at = timezone.now()
+        if reviewer is not None and getattr(reviewer, "is_authenticated", False):
+            consultation.reviewed_by = reviewer
+        edited = False
+        if approve and reply is not None and reply != consultation.reply:
+            consultation.reply = reply
+            edited = True
+        if approve and swatches_text is not None:
+            swatches = normalize_hexes(re.split(r"[,\s]+", swatches_text))
+            edited = edited or swatches != consultation.swatches
+            consultation.swatches = swatches
+        consultation.save()
+        if edited:
+            summaries, recommendations = parse_reply(consultation.kind, consultation.reply, consultation.swatches)
+            if swatches_text is not None:
+                # The edited swatch list is authoritative: drop colors the reviewer removed, add the ones typed in.
+                kept = [rec for rec in recommendations if rec["hex"] in consultation.swatches]
+                covered = {rec["hex"] for rec in kept}
+                recommendations = kept + [{"room": "", "name": "", "hex": h, "finish": "", "rationale": ""}
+                                          for h in consultation.swatches if h not in covered]
+            RoomSummary.objects.filter(consultation=consultation).delete()
+            ColorRecommendation.objects.filter(consultation=consultation).delete()
+            _children(consultation, summaries, recommendations)
+    return consultation
@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import metrics
+from .conf import setting
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX hosts run without store locks
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+# Content-addressed store for preprocessed chat uploads.
+#
+# agent_api preprocesses each upload once, writes it here and hands the client
+# compact ids; the confirm endpoints send those ids back instead of re-posting
+# base64 data URLs, and run_agent loads the bytes only when it builds a request.
+# Files live at <root>/<id[:2]>/<id> and are indexed by the StoredImage model,
+# whose last_used column drives TTL garbage collection. put() and purge() take
+# a store-wide file lock, so a purge never unlinks a file that a concurrent put
+# found on disk and is about to revive.
+
+_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# last_used is only rewritten when it is older than this, so hot images do not
+# cost a DB write on every request.
+_TOUCH_INTERVAL = 300
+
+
+class ImageRef:
+    """An image already in the store, resolved to bytes lazily by prepare_images."""
+
+    def __init__(self, image_id: str):
+        if not _ID_RE.match(image_id or ""):
+            raise ValueError(f"Invalid image id: {image_id!r}")
+        self.id = image_id
+
+    def __repr__(self):
+        return f"ImageRef({self.id[:12]})"
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_IMAGE_STORE", {}) or {}
+    media_root = setting("MEDIA_ROOT", "media")
+    return {
+        "root": conf.get("ROOT") or os.path.join(media_root, "image_store"),
+        "ttl": float(conf.get("TTL_HOURS", 24)) * 3600,
+        "gc_interval": float(conf.get("GC_INTERVAL", 3600)),
+    }
+
+
+def _path(root: str, image_id: str) -> str:
+    return os.path.join(root, image_id[:2], image_id)
+
+
+@contextmanager
+def _locked(root: str):
+    """Exclusive store lock, shared by every process using ``root``."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, ".lock"), "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def put(data: bytes, content_type: str, width: int = None, height: int = None) -> str:
+    """Store preprocessed image bytes and return their id; identical bytes are stored once."""
+    from django.utils import timezone
+    from .models import StoredImage
+
+    opts = _options()
+    image_id = hashlib.sha256(data).hexdigest()
+    path = _path(opts["root"], image_id)
+    with _locked(opts["root"]):
+        # Checked under the lock, so a purge cannot unlink the file once we rely on it.
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, path)
+        StoredImage.objects.update_or_create(
+            id=image_id,
+            defaults={
+                "path": os.path.relpath(path, opts["root"]),
+                "content_type": content_type,
+                "width": width,
+                "height": height,
+                "size": len(data),
+                "last_used": timezone.now(),
+            },
+        )
+    return image_id
+
+
+def store_uploads(image_uploads: List[Any]) -> Tuple[List[ImageRef], List[Dict[str, Any]]]:
+    """
+    Preprocess uploads (see agent.preprocess_image) and store them. Returns
+    ``(refs, stats)``; non-image uploads are skipped and one that does not
+    decode raises ValueError. Runs an opportunistic
+    garbage collection at most once per COLORSENSE_IMAGE_STORE['GC_INTERVAL'].
+    """
+    from .agent import preprocess_image
+
+    refs: List[ImageRef] = []
+    image_stats: List[Dict[str, Any]] = []
+    for upload in image_uploads:
+        content_type = getattr(upload, "content_type", "") or ""
+        if not content_type.startswith("image/"):
+            continue
+        with metrics.span("upload.read"):
+            data = upload.read()
+        try:
+            info = preprocess_image(data)
+        except ValueError as e:
+            raise ValueError(f"{getattr(upload, 'name', None) or 'An upload'} is not a readable image.") from e
+        if info["content_type"] == "application/octet-stream":
+            info["content_type"] = content_type
+        with metrics.span("image_store.put"):
+            image_id = put(info["data"], info["content_type"], info["width"], info["height"])
+        refs.append(ImageRef(image_id))
+        image_stats.append({k: info[k] for k in ("content_type", "width", "height", "bytes_in", "bytes_out")})
+    maybe_purge()
+    return refs, image_stats
+
+
+def load(image_id: str) -> Tuple[bytes, str]:
+    """Return ``(data, content_type)`` for a stored image; raises LookupError if it has expired."""
+    from django.utils import timezone
+    from .models import StoredImage
+
+    opts = _options()
+    try:
+        record = StoredImage.objects.get(id=image_id)
+        with open(os.path.join(opts["root"], record.path), "rb") as fh:
+            data = fh.read()
+    except (StoredImage.DoesNotExist, FileNotFoundError):
+        raise LookupError("This image has expired; please upload it again.")
+    now = timezone.now()
+    if (now - record.last_used).total_seconds() > _TOUCH_INTERVAL:
+        StoredImage.objects.filter(id=image_id).update(last_used=now)
+    return data, record.content_type
+
+
+def purge(ttl: Optional[float] = None) -> int:
+    """Delete images unused for ``ttl`` seconds (default COLORSENSE_IMAGE_STORE['TTL_HOURS']); returns the count."""
+    from django.utils import timezone
+    from .models import StoredImage
+
+    opts = _options()
+    ttl = opts["ttl"] if ttl is None else ttl
+    cutoff = timezone.now() - timedelta(seconds=ttl)
+    removed = 0
+    for record in StoredImage.objects.filter(last_used__lt=cutoff).only("id", "path").iterator():
+        with _locked(opts["root"]):
+            # Only drop the file if the row is still stale; a concurrent put may have revived it.
+            if not StoredImage.objects.filter(id=record.id, last_used__lt=cutoff).delete()[0]:
+                continue
+            try:
+                os.remove(os.path.join(opts["root"], record.path))
+            except FileNotFoundError:
+                pass
+        removed += 1
+    return removed
+
+
+_last_purge: Optional[float] = None
+_purge_lock = threading.Lock()
+
+
+def maybe_purge() -> None:
+    global _last_purge
+    interval = _options()["gc_interval"]
+    with _purge_lock:
+        if _last_purge is not None and time.monotonic() - _last_purge < interval:
+            return
+        _last_purge = time.monotonic()
+    try:
+        purge()
+    except Exception:
+        logger.exception("Image store purge failed")
@@ -0,0 +1,306 @@
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+from .conf import setting
+from .workspace import STAGES, eviction_budget
+
+logger = logging.getLogger(__name__)
+
+
+# Background 3D reconstruction jobs.
+#
+# Jobs live in a small SQLite table so their status survives restarts and is
+# visible to every web worker on the host. The pipeline runs in a local process
+# pool; there is no external broker. This module must stay importable without
+# Django so pool workers can run it directly.
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_JOBS", {}) or {}
+    media_root = setting("MEDIA_ROOT", "media")
+    return {
+        "db": conf.get("DB") or os.path.join(media_root, "jobs.sqlite3"),
+        "workers": max(int(conf.get("WORKERS", 1)), 1),
+        # inline: web processes own a local pool; external: only the
+        # reconstruction_worker command runs jobs, so web workers never load
+        # pycolmap/open3d.
+        "mode": str(conf.get("MODE", "inline")).lower(),
+        "poll_interval": float(conf.get("POLL_INTERVAL", 2)),
+    }
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " id TEXT PRIMARY KEY,"
+        " status TEXT NOT NULL,"
+        " stage TEXT,"
+        " image_dir TEXT NOT NULL,"
+        " work_dir TEXT NOT NULL,"
+        " mesh_path TEXT,"
+        " error TEXT,"
+        " timings TEXT NOT NULL DEFAULT '{}',"
+        " owner_pid INTEGER,"
+        " created REAL NOT NULL,"
+        " updated REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_work_dir ON jobs (work_dir, status)")
+    return conn
+
+
+def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job["timings"] = json.loads(job["timings"] or "{}")
+    done = sum(1 for stage in STAGES if stage in job["timings"])
+    job["progress"] = 1.0 if job["status"] == DONE else done / len(STAGES)
+    return job
+
+
+def create_job(image_dir: str, work_dir: str, mesh_path: str, status: str = QUEUED) -> str:
+    """Record a reconstruction job and return its id; pass ``status=DONE`` for a cached result."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect(_options()["db"])
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, status, image_dir, work_dir, mesh_path, created, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, status, image_dir, work_dir, mesh_path, now, now),
+        )
+    finally:
+        conn.close()
+    return job_id
+
+
+def find_active_job(work_dir: str) -> Optional[str]:
+    """Id of a queued or running job for ``work_dir``, so identical uploads share one run."""
+    conn = _connect(_options()["db"])
+    try:
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE work_dir = ? AND status IN (?, ?) ORDER BY created LIMIT 1",
+            (work_dir, QUEUED, RUNNING),
+        ).fetchone()
+    finally:
+        conn.close()
+    return row["id"] if row else None
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    conn = _connect(_options()["db"])
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return _row_to_job(row) if row else None
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # spawn: forking a threaded web worker is not safe.
+                _executor = ProcessPoolExecutor(
+                    max_workers=_options()["workers"],
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                _recover()
+    return _executor
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _requeue_orphans(conn: sqlite3.Connection) -> None:
+    for row in conn.execute("SELECT id, owner_pid FROM jobs WHERE status = ?", (RUNNING,)).fetchall():
+        if not _pid_alive(row["owner_pid"]):
+            conn.execute("UPDATE jobs SET status = ?, owner_pid = NULL WHERE id = ? AND status = ?",
+                         (QUEUED, row["id"], RUNNING))
+
+
+def _recover() -> None:
+    """Requeue jobs whose worker died and resubmit everything still queued."""
+    db_path = _options()["db"]
+    conn = _connect(db_path)
+    try:
+        _requeue_orphans(conn)
+        queued = [row["id"] for row in conn.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created", (QUEUED,))]
+    finally:
+        conn.close()
+    for job_id in queued:
+        _executor.submit(run_job, job_id, db_path, _worker_options())
+
+
+def _worker_options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_RECONSTRUCTION", {}) or {}
+    return {
+        "budget": eviction_budget(),
+        "pipeline": {key.lower(): value for key, value in conf.items()},
+    }
+
+
+def submit(job_id: str) -> None:
+    """Queue ``job_id`` on the local reconstruction pool, or leave it for an external worker."""
+    opts = _options()
+    if opts["mode"] == "external":
+        return
+    _get_executor().submit(run_job, job_id, opts["db"], _worker_options())
+
+
+def work_forever(once: bool = False) -> None:
+    """
+    Dedicated reconstruction worker loop: run queued jobs one at a time in this
+    process. Jobs are claimed atomically, so several workers can share a table.
+    """
+    opts = _options()
+    options = _worker_options()
+    conn = _connect(opts["db"])
+    try:
+        _requeue_orphans(conn)
+    finally:
+        conn.close()
+    while True:
+        conn = _connect(opts["db"])
+        try:
+            row = conn.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)).fetchone()
+        finally:
+            conn.close()
+        if row is not None:
+            run_job(row["id"], opts["db"], options)
+            continue
+        if once:
+            return
+        time.sleep(opts["poll_interval"])
+
+
+def submit_extraction(work_dir: str) -> bool:
+    """
+    Queue feature extraction for the images already in ``work_dir`` on the local
+    pool, ahead of its reconstruction job. False in external mode, where the
+    features stage does all the work.
+    """
+    if _options()["mode"] == "external":
+        return False
+    _get_executor().submit(run_extraction, work_dir, _worker_options())
+    return True
+
+
+def run_extraction(work_dir: str, options: Dict[str, Any] = None) -> None:
+    """Pool entry point: extract features for the images in a staging workspace that has not been claimed yet."""
+    from . import workspace
+    from .reconstruct import extract_features
+
+    options = options or {}
+    image_dir = os.path.join(work_dir, "images")
+    if not os.path.isdir(image_dir):
+        return
+    try:
+        with workspace.locked(work_dir):
+            # The reconstruction job moves the directory into its workspace while holding the same lock.
+            if os.path.isdir(image_dir):
+                extract_features(os.path.join(work_dir, "database.db"), image_dir, options.get("pipeline"))
+    except FileNotFoundError:
+        # The job took the directory over; the features stage does the rest.
+        return
+    except Exception:
+        # The features stage retries whatever is missing.
+        logger.exception("Feature extraction for %s failed", work_dir)
+
+
+def _adopt_staging(conn: sqlite3.Connection, job: Dict[str, Any]) -> None:
+    """
+    Move a completed upload's staging directory (the job's image_dir until then)
+    into the job's workspace. Waits for a feature extraction batch still running
+    on it, here in the worker rather than in the request that completed the upload.
+    """
+    from . import workspace
+
+    staging = os.path.dirname(job["image_dir"])
+    if staging == job["work_dir"]:
+        return
+    try:
+        with workspace.locked(staging):
+            workspace.open_workspace(os.path.basename(job["work_dir"]), staging,
+                                     root=os.path.dirname(job["work_dir"]))
+    except FileNotFoundError:
+        # Already moved by an earlier run of this job.
+        pass
+    job["image_dir"] = os.path.join(job["work_dir"], "images")
+    conn.execute("UPDATE jobs SET image_dir = ?, updated = ? WHERE id = ?", (job["image_dir"], time.time(), job["id"]))
+
+
+def run_job(job_id: str, db_path: str, options: Dict[str, Any] = None) -> None:
+    """
+    Pool entry point: claim the job and run every pipeline stage, recording timings.
+    Settings are not loaded in pool workers, so the job table path, pipeline
+    options and workspace disk budget are passed in.
+    """
+    options = options or {}
+    conn = _connect(db_path)
+    try:
+        claimed = conn.execute(
+            "UPDATE jobs SET status = ?, owner_pid = ?, updated = ? WHERE id = ? AND status = ?",
+            (RUNNING, os.getpid(), time.time(), job_id, QUEUED),
+        ).rowcount
+        if not claimed:
+            # Another web worker's pool already picked it up.
+            return
+        job = dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+        timings: Dict[str, float] = {}
+
+        def progress(stage: str, seconds: Optional[float]) -> None:
+            if seconds is not None:
+                timings[stage] = round(seconds, 3)
+            conn.execute(
+                "UPDATE jobs SET stage = ?, timings = ?, updated = ? WHERE id = ?",
+                (stage, json.dumps(timings), time.time(), job_id),
+            )
+
+        try:
+            from . import workspace
+            from .reconstruct import run_pipeline
+
+            _adopt_staging(conn, job)
+            with workspace.locked(job["work_dir"]):
+                run_pipeline(job["work_dir"], progress=progress, options=options.get("pipeline"))
+            workspace.evict(keep=[job["work_dir"]], root=os.path.dirname(job["work_dir"]),
+                            budget=options.get("budget"))
+        except Exception as e:
+            logger.exception("Reconstruction job %s failed", job_id)
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+                (FAILED, str(e) or type(e).__name__, time.time(), job_id),
+            )
+            return
+        conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (DONE, time.time(), job_id))
+    finally:
+        conn.close()
@@ -0,0 +1,393 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from django.urls import reverse
+
+
+# Offline benchmarks. Chat scenarios go through the real views (ASGI handler,
+# middleware, image store, prompt assembly) with the stub provider in place of
+# the LLM APIs; a throwaway test database and media root keep the run away from
+# real data. Every request carries a fresh nonce so the response cache and
+# request coalescing do not hide the work (--repeat-prompts measures them).
+
+SCENARIOS = ("hex", "encode", "agent_api", "confirm", "confirm_stream", "reconstruct")
+
+_IMAGE_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the kernel's peak RSS counter (Linux); False when only the process-wide peak is available."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _summary(latencies: List[float], wall: float, errors: int, concurrency: int) -> Dict[str, Any]:
+    ms = [t * 1000 for t in latencies]
+    return {
+        "ops": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "p50_ms": round(_percentile(ms, 0.5), 3),
+        "p95_ms": round(_percentile(ms, 0.95), 3),
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "max_ms": round(max(ms), 3) if ms else 0.0,
+        "throughput_ops_s": round(len(latencies) / wall, 2) if wall else 0.0,
+    }
+
+
+def _run_threads(fn: Callable[[int], Any], ops: int, concurrency: int) -> Dict[str, Any]:
+    """Run ``fn(i)`` for ``ops`` values of i on ``concurrency`` threads."""
+    def timed(i: int):
+        start = time.perf_counter()
+        try:
+            fn(i)
+            return time.perf_counter() - start, False
+        except Exception:
+            return time.perf_counter() - start, True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(ops)))
+    wall = time.perf_counter() - start
+    return _summary([t for t, _ in results], wall, sum(1 for _, failed in results if failed), concurrency)
+
+
+def _run_clients(fn: Callable[[int], Any], ops: int, concurrency: int) -> Dict[str, Any]:
+    """Run ``await fn(i)`` for ``ops`` values of i from ``concurrency`` concurrent clients."""
+    async def main():
+        counter = iter(range(ops))
+        latencies: List[float] = []
+        extras: List[Dict[str, float]] = []
+        errors = 0
+
+        async def client():
+            nonlocal errors
+            for i in counter:
+                start = time.perf_counter()
+                try:
+                    extra = await fn(i)
+                    if extra:
+                        extras.append(extra)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        result = _summary(latencies, time.perf_counter() - start, errors, concurrency)
+        if extras:
+            for key in extras[0]:
+                values = [e[key] * 1000 for e in extras if key in e]
+                result[f"{key}_p50_ms"] = round(_percentile(values, 0.5), 3)
+                result[f"{key}_p95_ms"] = round(_percentile(values, 0.95), 3)
+        return result
+
+    return asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = "Benchmark the chat and reconstruction paths offline, against the stub LLM provider."
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenarios", nargs="*",
+                            help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)}).")
+        parser.add_argument("--iterations", type=int, default=20, help="Requests per chat/encode scenario.")
+        parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients.")
+        parser.add_argument("--latency", type=float, default=0.05, help="Stub provider latency in seconds.")
+        parser.add_argument("--chunk-delay", type=float, default=0.002, help="Stub delay between streamed chunks.")
+        parser.add_argument("--images", help="Directory of sample images (default: MEDIA_ROOT/user_images).")
+        parser.add_argument("--reconstruct-iterations", type=int, default=1)
+        parser.add_argument("--repeat-prompts", action="store_true",
+                            help="Send identical prompts, so the response cache and coalescing apply.")
+        parser.add_argument("--json", dest="json_path", help="Write results as JSON to this path ('-' for stdout).")
+        parser.add_argument("--compare", help="Baseline JSON from an earlier run to compare against.")
+        parser.add_argument("--max-regression", type=float,
+                            help="With --compare, fail if any p95 is more than this many percent slower.")
+
+    def handle(self, *args, **options):
+        scenarios = options["scenarios"] or list(SCENARIOS)
+        unknown = sorted(set(scenarios) - set(SCENARIOS))
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(unknown)}. Choose from {', '.join(SCENARIOS)}.")
+        images = self._load_images(options["images"] or os.path.join(settings.MEDIA_ROOT, "user_images"))
+        tmp = tempfile.mkdtemp(prefix="colorsense-bench-")
+        overrides = {
+            "MEDIA_ROOT": tmp,
+            "ALLOWED_HOSTS": list(settings.ALLOWED_HOSTS) + ["testserver"],
+            "COLORSENSE_IMAGE_STORE": dict(getattr(settings, "COLORSENSE_IMAGE_STORE", {}),
+                                           ROOT=os.path.join(tmp, "image_store")),
+            "COLORSENSE_WORKSPACES": dict(getattr(settings, "COLORSENSE_WORKSPACES", {}),
+                                          ROOT=os.path.join(tmp, "reconstructions")),
+            "COLORSENSE_STUB": dict(getattr(settings, "COLORSENSE_STUB", {}), ENABLED=True,
+                                    LATENCY=options["latency"], CHUNK_DELAY=options["chunk_delay"]),
+            # Repeated requests are identical; measure the pipeline, not history replays.
+            "COLORSENSE_HISTORY": dict(getattr(settings, "COLORSENSE_HISTORY", {}), REPLAY=False),
+        }
+        self.options = options
+        self.images = images
+        self.tmp = tmp
+
+        results: Dict[str, Any] = {}
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(**overrides), contextlib.redirect_stdout(io.StringIO()):
+                for name in scenarios:
+                    scoped = _reset_peak_rss()
+                    try:
+                        result = getattr(self, f"bench_{name}")()
+                    except Exception as e:
+                        result = {"error": f"{type(e).__name__}: {e}"}
+                    result["peak_rss_mb"] = round(_peak_rss_kb() / 1024, 1)
+                    result["rss_scope"] = "scenario" if scoped else "process"
+                    results[name] = result
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        report = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "iterations": options["iterations"],
+                "concurrency": options["concurrency"],
+                "stub_latency_s": options["latency"],
+                "repeat_prompts": options["repeat_prompts"],
+                "images": len(images),
+            },
+            "scenarios": results,
+        }
+        if options["json_path"] == "-":
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            if options["json_path"]:
+                with open(options["json_path"], "w") as fh:
+                    json.dump(report, fh, indent=2)
+            self._print(results)
+        if options["compare"]:
+            self._compare(results, options["compare"], options["max_regression"])
+
+    # Inputs ------------------------------------------------------------------
+
+    def _load_images(self, directory: str) -> List[Dict[str, Any]]:
+        images = []
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                content_type = _IMAGE_TYPES.get(os.path.splitext(name)[1].lower())
+                if content_type:
+                    with open(os.path.join(directory, name), "rb") as fh:
+                        images.append({"name": name, "data": fh.read(), "content_type": content_type,
+                                       "path": os.path.join(directory, name)})
+        if not images:
+            raise CommandError(f"No sample images found in {directory}.")
+        return images
+
+    def _uploads(self) -> List[SimpleUploadedFile]:
+        return [SimpleUploadedFile(img["name"], img["data"], img["content_type"]) for img in self.images]
+
+    def _text(self, text: str, i: int) -> str:
+        return text if self.options["repeat_prompts"] else f"{text} (run {uuid.uuid4().hex[:8]}-{i})"
+
+    # Scenarios ---------------------------------------------------------------
+
+    def bench_hex(self) -> Dict[str, Any]:
+        from colorsense.agent import extract_hex_codes
+        from colorsense.stub import SAMPLE_SUGGESTION
+
+        reply = json.dumps(SAMPLE_SUGGESTION)
+        # Microseconds per call, so run many more of them than the request scenarios.
+        return _run_threads(lambda i: extract_hex_codes(reply), self.options["iterations"] * 100, 1)
+
+    def bench_encode(self) -> Dict[str, Any]:
+        from colorsense.agent import preprocess_image
+
+        images = self.images
+        return _run_threads(lambda i: preprocess_image(images[i % len(images)]["data"]),
+                            self.options["iterations"], self.options["concurrency"])
+
+    def bench_agent_api(self) -> Dict[str, Any]:
+        client = AsyncClient()
+        url = reverse("colorsense_agent_api")
+
+        async def one(i: int):
+            response = await client.post(url, {
+                "message": self._text("Bright living room, I like warm neutrals", i),
+                "provider": "stub",
+                "images": self._uploads(),
+            })
+            if response.status_code != 200 or not json.loads(response.content).get("ok"):
+                raise RuntimeError(response.content[:200])
+
+        return _run_clients(one, self.options["iterations"], self.options["concurrency"])
+
+    def _stored_image_ids(self) -> List[str]:
+        from colorsense import image_store
+
+        refs, _ = image_store.store_uploads(self._uploads())
+        return [ref.id for ref in refs]
+
+    def bench_confirm(self) -> Dict[str, Any]:
+        client = AsyncClient()
+        url = reverse("confirm_suggestion")
+        image_ids = self._stored_image_ids()
+
+        async def one(i: int):
+            response = await client.post(url, {
+                "confirm": "true",
+                "room_description": self._text("A cozy living room with light yellow walls", i),
+                "image_ids": image_ids,
+                "provider": "stub",
+            })
+            if response.status_code != 200 or not json.loads(response.content).get("ok"):
+                raise RuntimeError(response.content[:200])
+
+        return _run_clients(one, self.options["iterations"], self.options["concurrency"])
+
+    def bench_confirm_stream(self) -> Dict[str, Any]:
+        client = AsyncClient()
+        url = reverse("confirm_suggestion_stream")
+        image_ids = self._stored_image_ids()
+
+        async def one(i: int):
+            start = time.perf_counter()
+            response = await client.post(url, {
+                "confirm": "true",
+                "room_description": self._text("A cozy living room with light yellow walls", i),
+                "image_ids": image_ids,
+                "provider": "stub",
+            })
+            first = None
+            body = b""
+            async for chunk in response.streaming_content:
+                if first is None:
+                    first = time.perf_counter() - start
+                body += chunk
+            if b"event: done" not in body:
+                raise RuntimeError(body[-200:])
+            return {"first_event": first}
+
+        return _run_clients(one, self.options["iterations"], self.options["concurrency"])
+
+    def bench_reconstruct(self) -> Dict[str, Any]:
+        from colorsense import reconstruct
+
+        try:
+            import pycolmap  # noqa: F401
+        except ImportError:
+            return {"skipped": "pycolmap is not installed"}
+
+        stages: Dict[str, List[float]] = {}
+        latencies: List[float] = []
+        errors: List[str] = []
+        start = time.perf_counter()
+        for i in range(self.options["reconstruct_iterations"]):
+            work_dir = os.path.join(self.tmp, f"reconstruct-{i}")
+            os.makedirs(os.path.join(work_dir, "images"))
+            for img in self.images:
+                shutil.copy(img["path"], os.path.join(work_dir, "images", img["name"]))
+
+            def progress(stage, seconds):
+                if seconds is not None:
+                    stages.setdefault(stage, []).append(seconds * 1000)
+
+            began = time.perf_counter()
+            try:
+                reconstruct.run_pipeline(work_dir, progress=progress)
+            except Exception as e:
+                # Two sample photos rarely register; the earlier stages are still timed.
+                errors.append(f"{type(e).__name__}: {e}")
+            latencies.append(time.perf_counter() - began)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        result = _summary(latencies, time.perf_counter() - start, len(errors), 1)
+        result["stages_p50_ms"] = {stage: round(_percentile(values, 0.5), 1) for stage, values in stages.items()}
+        if errors:
+            result["last_error"] = errors[-1][:300]
+        return result
+
+    # Output ------------------------------------------------------------------
+
+    def _print(self, results: Dict[str, Any]) -> None:
+        self.stdout.write(f"{'scenario':<16} {'ops':>6} {'err':>4} {'p50 ms':>10} {'p95 ms':>10} "
+                          f"{'ops/s':>9} {'peak RSS':>9}")
+        for name, r in results.items():
+            if "error" in r or "skipped" in r:
+                self.stdout.write(f"{name:<16} {r.get('error') or 'skipped: ' + r['skipped']}")
+                continue
+            self.stdout.write(
+                f"{name:<16} {r['ops']:>6} {r['errors']:>4} {r['p50_ms']:>10.2f} {r['p95_ms']:>10.2f} "
+                f"{r['throughput_ops_s']:>9.2f} {r['peak_rss_mb']:>7.1f}MB"
+            )
+            if "first_event_p50_ms" in r:
+                self.stdout.write(f"{'':<16} first event p50 {r['first_event_p50_ms']:.2f} ms, "
+                                  f"p95 {r['first_event_p95_ms']:.2f} ms")
+            if r.get("stages_p50_ms"):
+                stages = ", ".join(f"{k} {v:.0f}" for k, v in r["stages_p50_ms"].items())
+                self.stdout.write(f"{'':<16} stages (ms): {stages}")
+            if r.get("last_error"):
+                self.stdout.write(f"{'':<16} last error: {r['last_error']}")
+
+    def _compare(self, results: Dict[str, Any], path: str, max_regression: float = None) -> None:
+        with open(path) as fh:
+            baseline = json.load(fh).get("scenarios", {})
+
+        def change(new, old):
+            return (new - old) / old * 100 if old else 0.0
+
+        regressions = []
+        self.stdout.write(f"\n{'vs ' + os.path.basename(path):<16} {'p50':>9} {'p95':>9} {'ops/s':>9}")
+        for name, r in results.items():
+            old = baseline.get(name)
+            if not old or "p95_ms" not in r or "p95_ms" not in old:
+                continue
+            p95 = change(r["p95_ms"], old["p95_ms"])
+            self.stdout.write(f"{name:<16} {change(r['p50_ms'], old['p50_ms']):>+8.1f}% {p95:>+8.1f}% "
+                              f"{change(r['throughput_ops_s'], old['throughput_ops_s']):>+8.1f}%")
+            if max_regression is not None and p95 > max_regression:
+                regressions.append(f"{name} p95 {p95:+.1f}%")
+        if regressions:
+            raise CommandError("Regressions over the threshold: " + ", ".join(regressions))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from colorsense import catalog
+
+
+class Command(BaseCommand):
+    help = "Compile the paint catalog index ahead of time so web workers load it from cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", help="Catalog file (default: COLORSENSE_CATALOG['PATH']).")
+
+    def handle(self, *args, **options):
+        opts = catalog._options()
+        path = options["path"] or opts["path"]
+        if not path:
+            raise CommandError("No catalog configured; pass a path or set COLORSENSE_CATALOG['PATH'].")
+        start = time.perf_counter()
+        try:
+            loaded = catalog.load_catalog(path, opts["cache_dir"])
+        except OSError as e:
+            raise CommandError(str(e))
+        index = "KD-tree" if loaded.tree is not None else "brute force"
+        self.stdout.write(f"{len(loaded)} colors ({index}) ready in {time.perf_counter() - start:.2f} s.")
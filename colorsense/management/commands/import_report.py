@@ -0,0 +1,94 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# Modules a web worker or a reconstruction worker loads. Each one is imported in
+# a fresh interpreter (after django.setup(), so Django's own cost is excluded)
+# and its wall time and resident-memory growth are reported.
+DEFAULT_MODULES = [
+    "colorsense.urls",
+    "colorsense.views",
+    "colorsense.agent",
+    "colorsense.jobs",
+    "colorsense.reconstruct",
+    "openai",
+    "groq",
+    "PIL.Image",
+    "numpy",
+    "pycolmap",
+    "open3d",
+]
+
+_PROBE = r"""
+import json, os, sys, time
+
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+import django
+django.setup()
+name = sys.argv[1]
+before_modules = set(sys.modules)
+before = rss_kb()
+start = time.perf_counter()
+error = None
+try:
+    __import__(name)
+except Exception as e:
+    error = "%s: %s" % (type(e).__name__, e)
+seconds = time.perf_counter() - start
+heavy = sorted(m for m in ("pycolmap", "open3d", "numpy", "cv2", "openai", "groq")
+               if m in sys.modules and m not in before_modules)
+print(json.dumps({
+    "module": name,
+    "seconds": round(seconds, 4),
+    "rss_kb": rss_kb() - before,
+    "new_modules": len(set(sys.modules) - before_modules),
+    "pulls_in": heavy,
+    "error": error,
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Measure import time and memory of each module in a fresh interpreter."
+
+    def add_arguments(self, parser):
+        parser.add_argument("modules", nargs="*", help="Modules to measure (default: the app's heavy hitters).")
+        parser.add_argument("--json", action="store_true", help="Print machine-readable JSON.")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        env.setdefault("DJANGO_SETTINGS_MODULE", "paintme.settings")
+        results = []
+        for name in options["modules"] or DEFAULT_MODULES:
+            proc = subprocess.run(
+                [sys.executable, "-c", _PROBE, name],
+                capture_output=True, text=True, env=env, cwd=str(settings.BASE_DIR),
+            )
+            if proc.returncode != 0 or not proc.stdout.strip():
+                raise CommandError(f"probe for {name} failed:\n{proc.stderr}")
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'module':<24} {'time (s)':>9} {'RSS (MB)':>9} {'modules':>8}  pulls in")
+        for r in results:
+            if r["error"]:
+                self.stdout.write(f"{r['module']:<24} {'-':>9} {'-':>9} {'-':>8}  {r['error']}")
+                continue
+            self.stdout.write(
+                f"{r['module']:<24} {r['seconds']:>9.3f} {r['rss_kb'] / 1024:>9.1f} "
+                f"{r['new_modules']:>8}  {', '.join(r['pulls_in']) or '-'}"
+            )
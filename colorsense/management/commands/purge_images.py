@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from colorsense import image_store
+
+
+class Command(BaseCommand):
+    help = "Delete stored chat images that have not been used within the TTL."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ttl-hours", type=float, default=None,
+                            help="Override COLORSENSE_IMAGE_STORE['TTL_HOURS']; 0 removes everything.")
+
+    def handle(self, *args, **options):
+        ttl = None if options["ttl_hours"] is None else options["ttl_hours"] * 3600
+        removed = image_store.purge(ttl)
+        self.stdout.write(f"Removed {removed} stored image(s).")
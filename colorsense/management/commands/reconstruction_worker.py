@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from colorsense import jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued 3D reconstruction jobs (use with COLORSENSE_JOBS['MODE'] = 'external')."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty.")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Reconstruction worker started.")
+        jobs.work_forever(once=options["once"])
@@ -0,0 +1,347 @@
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .conf import setting
+
+logger = logging.getLogger(__name__)
+
+
+# Lightweight instrumentation.
+#
+# span("name") times a block and records its resident-memory growth into a
+# process-wide registry (Prometheus histograms, served by the metrics view) and
+# into the current request's span list, which MetricsMiddleware turns into a
+# Server-Timing header. The request is tracked in a contextvar, so spans inside
+# asyncio tasks and asyncio.to_thread() calls are attributed to it; plain
+# thread pools (fan-out workers) only feed the registry. A request can also ask
+# for a sampling profile (X-Profile: 1 or ?profile=1) when PROFILE is allowed.
+#
+# Registries are per process: reconstruction stages running in a job worker
+# process are recorded there, and their timings and memory also go into the
+# workspace stage markers (see reconstruct._run_stage).
+
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_METRICS", {}) or {}
+    media_root = setting("MEDIA_ROOT", "media")
+    return {
+        "enabled": bool(conf.get("ENABLED", True)),
+        "server_timing": bool(conf.get("SERVER_TIMING", False)),
+        "profile": bool(conf.get("PROFILE", False)),
+        "profile_interval": float(conf.get("PROFILE_INTERVAL", 0.005)),
+        "profile_dir": conf.get("PROFILE_DIR") or os.path.join(media_root, "profiles"),
+        "token": conf.get("TOKEN"),
+    }
+
+
+def rss_bytes() -> int:
+    """Current resident set size (Linux /proc; 0 where unavailable)."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """Counters and histograms keyed by metric name and label set."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[LabelSet, Histogram]] = collections.defaultdict(dict)
+        self._counters: Dict[str, Dict[LabelSet, float]] = collections.defaultdict(dict)
+        self._help: Dict[str, str] = {}
+
+    def observe(self, name: str, value: float, help: str = "", **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help)
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, help: str = "", **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help)
+            self._counters[name][key] = self._counters[name].get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, '')}")
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, '')}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, h in series.items():
+                    cumulative = 0
+                    for bound, count in zip(_BUCKETS, h.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h.count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(h.total)}")
+                    lines.append(f"{name}_count{_labels(labels)} {h.count}")
+        return lines
+
+
+def _labels(labels: LabelSet) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+_registry = Registry()
+
+
+def get_registry() -> Registry:
+    return _registry
+
+
+class RequestMetrics:
+    """Spans recorded while handling one request, for the Server-Timing header."""
+
+    def __init__(self):
+        self.spans: List[Tuple[str, float]] = []
+
+
+_current: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar("colorsense_request", default=None)
+
+
+@contextmanager
+def span(name: str, **labels) -> Iterator[Dict[str, Any]]:
+    """
+    Time a block as ``colorsense_span_seconds{span=name, ...}`` and record its RSS
+    change. Yields a dict the block may add numbers to (e.g. item counts).
+    """
+    info: Dict[str, Any] = {}
+    if not _options()["enabled"]:
+        yield info
+        return
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - start
+        info["seconds"] = seconds
+        info["rss_delta"] = rss_bytes() - rss_before
+        _registry.observe("colorsense_span_seconds", seconds, "Time spent in instrumented stages.",
+                          span=name, **labels)
+        if info["rss_delta"] > 0:
+            _registry.inc("colorsense_span_rss_growth_bytes_total", info["rss_delta"],
+                          "Resident memory growth across instrumented stages.", span=name, **labels)
+        request = _current.get()
+        if request is not None:
+            request.spans.append((name, seconds))
+
+
+def record_tokens(provider: str, model: str, usage: Any) -> None:
+    """Count prompt/completion tokens from a provider response's ``usage``."""
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if value is None and isinstance(usage, dict):
+            value = usage.get(kind)
+        if value:
+            _registry.inc("colorsense_provider_tokens_total", value, "Tokens reported by the provider.",
+                          provider=provider, model=model, kind=kind.split("_")[0])
+
+
+class Sampler:
+    """Samples one thread's Python stack every ``interval`` seconds into collapsed-stack counts."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: collections.Counter = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="colorsense-profiler", daemon=True)
+
+    def start(self) -> "Sampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, directory: str, label: str) -> str:
+        """Write the samples in collapsed format (flamegraph.pl / speedscope); returns the file name."""
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{label}.folded"
+        with open(os.path.join(directory, name), "w") as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+        return name
+
+
+def _wants_profile(request, opts: Dict[str, Any]) -> bool:
+    if not opts["profile"]:
+        return False
+    return request.headers.get("X-Profile") == "1" or request.GET.get("profile") == "1"
+
+
+def _server_timing(metrics: RequestMetrics, total: float) -> str:
+    totals: Dict[str, List[float]] = collections.OrderedDict()
+    for name, seconds in metrics.spans:
+        entry = totals.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+    parts = [f"{name};dur={seconds * 1000:.1f}" + (f';desc="x{count}"' if count > 1 else "")
+             for name, (seconds, count) in totals.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """
+    Per-request timing: request duration histogram, multipart upload parsing as
+    its own span, an optional Server-Timing header and per-request sampling
+    profiles. Works for sync and async views.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        opts = _options()
+        if not opts["enabled"]:
+            return self.get_response(request)
+        state = self._begin(request, opts)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self._end(request, None, state, opts)
+            raise
+        return self._end(request, response, state, opts)
+
+    async def __acall__(self, request):
+        opts = _options()
+        if not opts["enabled"]:
+            return await self.get_response(request)
+        state = self._begin(request, opts)
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            self._end(request, None, state, opts)
+            raise
+        return self._end(request, response, state, opts)
+
+    def _begin(self, request, opts):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        sampler = None
+        if _wants_profile(request, opts):
+            sampler = Sampler(threading.get_ident(), opts["profile_interval"]).start()
+        start = time.perf_counter()
+        if request.method == "POST" and request.content_type == "multipart/form-data":
+            # Parse here so upload handling shows up separately from the view.
+            with span("upload.parse"):
+                request.POST, request.FILES
+        return metrics, token, sampler, start
+
+    def _end(self, request, response, state, opts):
+        metrics, token, sampler, start = state
+        total = time.perf_counter() - start
+        _current.reset(token)
+        match = getattr(request, "resolver_match", None)
+        view = match.url_name if match and match.url_name else "unmatched"
+        status = response.status_code if response is not None else 500
+        _registry.observe("colorsense_http_request_seconds", total, "Request handling time (until the response "
+                          "object is returned; streamed bodies continue after).",
+                          view=view, method=request.method, status=status)
+        if sampler is not None:
+            sampler.stop()
+            if response is not None:
+                try:
+                    response["X-Profile"] = sampler.write(opts["profile_dir"], view)
+                except OSError:
+                    logger.warning("Could not write profile to %s", opts["profile_dir"], exc_info=True)
+        if response is None:
+            return response
+        if opts["server_timing"]:
+            response["Server-Timing"] = _server_timing(metrics, total)
+        return response
+
+
+def authorized(request) -> bool:
+    """Whether ``request`` may read the metrics endpoint (bearer token when TOKEN is set)."""
+    token = _options()["token"]
+    return not token or request.headers.get("Authorization") == f"Bearer {token}"
+
+
+def render(extra: Dict[str, Any] = None) -> str:
+    """Prometheus text exposition of the registry plus ``extra`` gauges (name -> value or {labels: value})."""
+    lines = _registry.render()
+    lines.append("# HELP colorsense_process_resident_memory_bytes Resident memory of this process.")
+    lines.append("# TYPE colorsense_process_resident_memory_bytes gauge")
+    lines.append(f"colorsense_process_resident_memory_bytes {rss_bytes()}")
+    for name, value in (extra or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                lines.append(f"{name}{_labels(labels)} {_number(v)}")
+        else:
+            lines.append(f"{name} {_number(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,96 @@
+import colorsense.models
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("colorsense", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Consultation",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("public_id", models.CharField(default=colorsense.models._public_id, editable=False, max_length=32, unique=True)),
+                ("request_key", models.CharField(db_index=True, max_length=64)),
+                ("kind", models.CharField(choices=[("summary", "Summary"), ("suggestion", "Suggestion")], max_length=16)),
+                ("status", models.CharField(choices=[("completed", "Completed"), ("pending", "Pending review"), ("approved", "Approved"), ("rejected", "Rejected")], default="completed", max_length=16)),
+                ("provider", models.CharField(max_length=32)),
+                ("user_text", models.TextField(blank=True)),
+                ("docs_text", models.TextField(blank=True)),
+                ("reply", models.TextField(blank=True)),
+                ("swatches", models.JSONField(default=list)),
+                ("paints", models.JSONField(default=dict)),
+                ("errors", models.JSONField(default=list)),
+                ("review_notes", models.TextField(blank=True)),
+                ("reviewed_at", models.DateTimeField(blank=True, null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("reviewed_by", models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ColorRecommendation",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("position", models.PositiveSmallIntegerField()),
+                ("room", models.CharField(blank=True, max_length=255)),
+                ("name", models.CharField(blank=True, max_length=128)),
+                ("hex", models.CharField(max_length=7)),
+                ("lab_l", models.FloatField()),
+                ("lab_a", models.FloatField()),
+                ("lab_b", models.FloatField()),
+                ("finish", models.CharField(blank=True, max_length=32)),
+                ("rationale", models.TextField(blank=True)),
+                ("consultation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="recommendations", to="colorsense.consultation")),
+            ],
+            options={
+                "ordering": ["position"],
+            },
+        ),
+        migrations.CreateModel(
+            name="ConsultationImage",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("position", models.PositiveSmallIntegerField()),
+                ("digest", models.CharField(db_index=True, max_length=64)),
+                ("consultation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="images", to="colorsense.consultation")),
+            ],
+            options={
+                "ordering": ["position"],
+            },
+        ),
+        migrations.CreateModel(
+            name="RoomSummary",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("position", models.PositiveSmallIntegerField()),
+                ("image", models.CharField(blank=True, max_length=255)),
+                ("description", models.TextField()),
+                ("consultation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="summaries", to="colorsense.consultation")),
+            ],
+            options={
+                "ordering": ["position"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="consultation",
+            index=models.Index(fields=["status", "-created_at", "-id"], name="colorsense_consult_status_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="consultation",
+            index=models.Index(fields=["-created_at", "-id"], name="colorsense_consult_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="colorrecommendation",
+            index=models.Index(fields=["hex"], name="colorsense_rec_hex_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="colorrecommendation",
+            index=models.Index(fields=["lab_l", "lab_a", "lab_b"], name="colorsense_rec_lab_idx"),
+        ),
+    ]
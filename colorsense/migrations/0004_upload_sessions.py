@@ -0,0 +1,42 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("colorsense", "0003_preference_profiles"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadSession",
+            fields=[
+                ("id", models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ("status", models.CharField(choices=[("open", "Open"), ("complete", "Complete")], default="open", max_length=16)),
+                ("job_id", models.CharField(blank=True, max_length=32)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="UploadFile",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("index", models.PositiveIntegerField()),
+                ("name", models.CharField(blank=True, max_length=255)),
+                ("size", models.BigIntegerField()),
+                ("status", models.CharField(choices=[("pending", "Pending"), ("done", "Done"), ("duplicate", "Duplicate"), ("invalid", "Invalid")], default="pending", max_length=16)),
+                ("digest", models.CharField(blank=True, db_index=True, max_length=64)),
+                ("format", models.CharField(blank=True, max_length=16)),
+                ("width", models.PositiveIntegerField(null=True)),
+                ("height", models.PositiveIntegerField(null=True)),
+                ("error", models.CharField(blank=True, max_length=255)),
+                ("session", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="files", to="colorsense.uploadsession")),
+            ],
+            options={
+                "ordering": ["index"],
+                "constraints": [models.UniqueConstraint(fields=("session", "index"), name="colorsense_uploadfile_index_uniq")],
+            },
+        ),
+    ]
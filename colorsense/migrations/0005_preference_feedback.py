@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("colorsense", "0004_upload_sessions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PreferenceFeedback",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("profile_key", models.CharField(max_length=64)),
+                ("hex", models.CharField(max_length=7)),
+                ("accepted", models.BooleanField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("consultation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="feedback", to="colorsense.consultation")),
+            ],
+            options={
+                "constraints": [models.UniqueConstraint(fields=("profile_key", "consultation", "hex"), name="colorsense_feedback_once")],
+            },
+        ),
+    ]
@@ -1,2 +1,202 @@
+import secrets
+
 from django.db import models
 from django.conf import settings
+
+
+class StoredImage(models.Model):
+    """
+    Index row for a preprocessed upload kept in the content-addressed image store
+    (see image_store.py). The primary key is the SHA-256 of the stored bytes.
+    """
+
+    id = models.CharField(max_length=64, primary_key=True)
+    path = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=64)
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.id[:12]} ({self.content_type}, {self.size} bytes)"
+
+
+def _public_id():
+    return secrets.token_hex(16)
+
+
+class Consultation(models.Model):
+    """
+    One answered chat request (a room summary or a paint suggestion) with what
+    was asked and what came back, so it can be replayed and reviewed later.
+    ``request_key`` hashes the inputs; an identical request is served from here.
+    """
+
+    SUMMARY = "summary"
+    SUGGESTION = "suggestion"
+    KINDS = [(SUMMARY, "Summary"), (SUGGESTION, "Suggestion")]
+
+    COMPLETED = "completed"
+    PENDING = "pending"
+    APPROVED = "approved"
+    REJECTED = "rejected"
+    STATUSES = [(COMPLETED, "Completed"), (PENDING, "Pending review"), (APPROVED, "Approved"), (REJECTED, "Rejected")]
+
+    public_id = models.CharField(max_length=32, unique=True, default=_public_id, editable=False)
+    request_key = models.CharField(max_length=64, db_index=True)
+    kind = models.CharField(max_length=16, choices=KINDS)
+    status = models.CharField(max_length=16, choices=STATUSES, default=COMPLETED)
+    provider = models.CharField(max_length=32)
+    user_text = models.TextField(blank=True)
+    docs_text = models.TextField(blank=True)
+    reply = models.TextField(blank=True)
+    swatches = models.JSONField(default=list)
+    paints = models.JSONField(default=dict)
+    errors = models.JSONField(default=list)
+    review_notes = models.TextField(blank=True)
+    reviewed_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name="+")
+    reviewed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the review queue: WHERE status = ? AND (created_at, id) < (?, ?)
+            models.Index(fields=["status", "-created_at", "-id"], name="colorsense_consult_status_idx"),
+            models.Index(fields=["-created_at", "-id"], name="colorsense_consult_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} {self.kind} ({self.status})"
+
+
+class ConsultationImage(models.Model):
+    """An image sent with a consultation, by content digest (the image store id for stored uploads)."""
+
+    consultation = models.ForeignKey(Consultation, on_delete=models.CASCADE, related_name="images")
+    position = models.PositiveSmallIntegerField()
+    digest = models.CharField(max_length=64, db_index=True)
+
+    class Meta:
+        ordering = ["position"]
+
+
+class RoomSummary(models.Model):
+    """One room description from a summary reply."""
+
+    consultation = models.ForeignKey(Consultation, on_delete=models.CASCADE, related_name="summaries")
+    position = models.PositiveSmallIntegerField()
+    image = models.CharField(max_length=255, blank=True)
+    description = models.TextField()
+
+    class Meta:
+        ordering = ["position"]
+
+
+class ColorRecommendation(models.Model):
+    """
+    One recommended paint color. The CIELAB columns allow color-range queries
+    (a box around a Lab point, refined by ΔE in Python) without parsing replies.
+    """
+
+    consultation = models.ForeignKey(Consultation, on_delete=models.CASCADE, related_name="recommendations")
+    position = models.PositiveSmallIntegerField()
+    room = models.CharField(max_length=255, blank=True)
+    name = models.CharField(max_length=128, blank=True)
+    hex = models.CharField(max_length=7)
+    lab_l = models.FloatField()
+    lab_a = models.FloatField()
+    lab_b = models.FloatField()
+    finish = models.CharField(max_length=32, blank=True)
+    rationale = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ["position"]
+        indexes = [
+            models.Index(fields=["hex"], name="colorsense_rec_hex_idx"),
+            models.Index(fields=["lab_l", "lab_a", "lab_b"], name="colorsense_rec_lab_idx"),
+        ]
+
+
+class PreferenceProfile(models.Model):
+    """
+    Write-back copy of a user's color preference profile (see reflection.py).
+    ``key`` is "user:<id>" for signed-in users and "anon:<cookie>" otherwise;
+    ``vector`` holds the compact hue / lightness / finish weights.
+    """
+
+    key = models.CharField(max_length=64, primary_key=True)
+    vector = models.JSONField(default=dict)
+    accepted = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} (+{self.accepted}/-{self.rejected})"
+
+
+class PreferenceFeedback(models.Model):
+    """
+    A profile's verdict on one recommended color of a consultation, so posting
+    the same accept / reject again is not learned twice (see reflection.py).
+    """
+
+    profile_key = models.CharField(max_length=64)
+    consultation = models.ForeignKey(Consultation, on_delete=models.CASCADE, related_name="feedback")
+    hex = models.CharField(max_length=7)
+    accepted = models.BooleanField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["profile_key", "consultation", "hex"], name="colorsense_feedback_once"),
+        ]
+
+
+class UploadSession(models.Model):
+    """A resumable photo-set upload for reconstruction (see uploads.py)."""
+
+    OPEN = "open"
+    COMPLETE = "complete"
+    STATUSES = [(OPEN, "Open"), (COMPLETE, "Complete")]
+
+    id = models.CharField(max_length=32, primary_key=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=OPEN)
+    job_id = models.CharField(max_length=32, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.id[:12]} ({self.status})"
+
+
+class UploadFile(models.Model):
+    """
+    One file of an upload session. The bytes received so far are the size of
+    its part file on disk; ``digest`` is set once the last chunk arrives.
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+    DUPLICATE = "duplicate"
+    INVALID = "invalid"
+    STATUSES = [(PENDING, "Pending"), (DONE, "Done"), (DUPLICATE, "Duplicate"), (INVALID, "Invalid")]
+
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name="files")
+    index = models.PositiveIntegerField()
+    name = models.CharField(max_length=255, blank=True)
+    size = models.BigIntegerField()
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    digest = models.CharField(max_length=64, blank=True, db_index=True)
+    format = models.CharField(max_length=16, blank=True)
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    error = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        ordering = ["index"]
+        constraints = [
+            models.UniqueConstraint(fields=["session", "index"], name="colorsense_uploadfile_index_uniq"),
+        ]
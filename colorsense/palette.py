@@ -0,0 +1,233 @@
+import io
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+# Local color analysis of room photos.
+#
+# Works on a small thumbnail (COLORSENSE_PALETTE['SAMPLE_EDGE'] pixels on the
+# long edge) so an image costs a few milliseconds: dominant colors by k-means in
+# CIELAB, an illuminant / color temperature estimate, and stats for the region
+# most likely to be wall. summarize() turns the numbers into one line of prompt
+# text, which can go alongside the photo or replace it for text-only models.
+
+# sRGB (D65) -> XYZ
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+], dtype=np.float32)
+_XYZ_TO_RGB = np.linalg.inv(_RGB_TO_XYZ).astype(np.float32)
+_D65 = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+_EPS = 216 / 24389
+_KAPPA = 24389 / 27
+
+
+def srgb_to_linear(rgb: np.ndarray) -> np.ndarray:
+    return np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(rgb: np.ndarray) -> np.ndarray:
+    rgb = np.clip(rgb, 0.0, 1.0)
+    return np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * rgb ** (1 / 2.4) - 0.055)
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """sRGB in [0, 1], shape (..., 3) -> CIELAB (D65)."""
+    xyz = srgb_to_linear(rgb) @ _RGB_TO_XYZ.T / _D65
+    f = np.where(xyz > _EPS, np.cbrt(xyz), (_KAPPA * xyz + 16) / 116)
+    return np.stack([
+        116 * f[..., 1] - 16,
+        500 * (f[..., 0] - f[..., 1]),
+        200 * (f[..., 1] - f[..., 2]),
+    ], axis=-1)
+
+
+def lab_to_rgb(lab: np.ndarray) -> np.ndarray:
+    """CIELAB (D65), shape (..., 3) -> sRGB in [0, 1]."""
+    fy = (lab[..., 0] + 16) / 116
+    fx = fy + lab[..., 1] / 500
+    fz = fy - lab[..., 2] / 200
+    f = np.stack([fx, fy, fz], axis=-1)
+    xyz = np.where(f ** 3 > _EPS, f ** 3, (116 * f - 16) / _KAPPA) * _D65
+    return linear_to_srgb(xyz @ _XYZ_TO_RGB.T)
+
+
+def lab_to_hex(lab) -> str:
+    r, g, b = np.round(lab_to_rgb(np.asarray(lab, dtype=np.float32)) * 255).astype(int)
+    return f"#{r:02X}{g:02X}{b:02X}"
+
+
+def kmeans(points: np.ndarray, k: int, iterations: int = 12, seed: int = 0):
+    """
+    Plain Lloyd's k-means with k-means++ seeding. Seeded, so the same photo always
+    gives the same palette (and the same prompt, which keeps the response cache
+    effective). Returns ``(centers, labels)``.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(points)
+    k = max(1, min(k, n))
+    centers = np.empty((k, points.shape[1]), dtype=np.float32)
+    centers[0] = points[rng.integers(n)]
+    closest = ((points - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        total = closest.sum()
+        index = rng.choice(n, p=closest / total) if total > 0 else rng.integers(n)
+        centers[i] = points[index]
+        closest = np.minimum(closest, ((points - centers[i]) ** 2).sum(axis=1))
+
+    sq_norms = (points ** 2).sum(axis=1)[:, None]
+    labels = np.zeros(n, dtype=np.int64)
+    for it in range(iterations):
+        distances = sq_norms - 2 * points @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+        new_labels = distances.argmin(axis=1)
+        if it and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=k)
+        for dim in range(points.shape[1]):
+            sums = np.bincount(labels, weights=points[:, dim], minlength=k)
+            centers[:, dim] = np.where(counts > 0, sums / np.maximum(counts, 1), centers[:, dim])
+    return centers, labels
+
+
+def estimate_illuminant(rgb: np.ndarray, p: int = 6) -> Dict[str, Any]:
+    """
+    Shades-of-gray illuminant estimate (Minkowski p-norm of linear RGB, ignoring
+    near-black and clipped pixels), with the white-balance gains that would
+    neutralise it and its correlated color temperature (McCamy's approximation).
+    """
+    linear = srgb_to_linear(rgb.reshape(-1, 3))
+    usable = (linear.max(axis=1) < 0.98) & (linear.sum(axis=1) > 0.06)
+    if usable.sum() >= 16:
+        linear = linear[usable]
+    estimate = np.power(np.mean(np.power(linear, p), axis=0), 1 / p)
+    estimate = estimate / max(float(estimate.max()), 1e-6)
+    gains = float(estimate.mean()) / np.maximum(estimate, 1e-6)
+
+    X, Y, Z = _RGB_TO_XYZ @ estimate
+    total = X + Y + Z
+    cct = None
+    if total > 0:
+        x, y = X / total, Y / total
+        n = (x - 0.3320) / (0.1858 - y)
+        cct = float(np.clip(449 * n ** 3 + 3525 * n ** 2 + 6823.3 * n + 5520.33, 1500, 20000))
+    if cct is None:
+        tone = "unknown"
+    elif cct < 3500:
+        tone = "warm"
+    elif cct > 5500:
+        tone = "cool"
+    else:
+        tone = "neutral"
+    return {
+        "cct_k": round(cct) if cct is not None else None,
+        "tone": tone,
+        "wb_gains": [round(float(g), 3) for g in gains],
+    }
+
+
+def undertone(lab) -> str:
+    L, a, b = (float(v) for v in lab)
+    chroma = (a * a + b * b) ** 0.5
+    if chroma < 6:
+        return "neutral"
+    hue = np.degrees(np.arctan2(b, a)) % 360
+    if hue < 45 or hue >= 330:
+        return "red/pink"
+    if hue < 105:
+        return "warm yellow"
+    if hue < 200:
+        return "green"
+    if hue < 290:
+        return "cool blue"
+    return "violet"
+
+
+def _wall_stats(lab: np.ndarray, labels: np.ndarray, centers: np.ndarray) -> Optional[Dict[str, Any]]:
+    """
+    Walls are large, smooth and mostly in the upper part of the frame: take the
+    low-gradient pixels in the top 70% of rows and report the dominant cluster
+    among them.
+    """
+    h, w, _ = lab.shape
+    L = lab[..., 0]
+    grad = np.zeros_like(L)
+    grad[:, 1:] = np.abs(np.diff(L, axis=1))
+    grad[1:, :] = np.maximum(grad[1:, :], np.abs(np.diff(L, axis=0)))
+    candidates = grad < 2.5
+    candidates[int(h * 0.7):, :] = False
+    candidates = candidates.reshape(-1)
+    if candidates.sum() < 0.05 * h * w:
+        return None
+    wall_label = int(np.bincount(labels[candidates], minlength=len(centers)).argmax())
+    pixels = lab.reshape(-1, 3)[candidates & (labels == wall_label)]
+    mean = pixels.mean(axis=0)
+    return {
+        "hex": lab_to_hex(mean),
+        "lab": [round(float(v), 1) for v in mean],
+        "coverage": round(len(pixels) / (h * w), 3),
+        "uniformity": round(float(pixels[:, 0].std()), 2),
+        "undertone": undertone(mean),
+    }
+
+
+def analyze(data: bytes, colors: int = 5, sample_edge: int = 128) -> Dict[str, Any]:
+    """Color analysis of one encoded image; see the module comment for what is measured."""
+    from PIL import Image  # type: ignore
+
+    start = time.perf_counter()
+    img = Image.open(io.BytesIO(data))
+    # Let the JPEG decoder produce a reduced-size image directly.
+    img.draft("RGB", (sample_edge, sample_edge))
+    img = img.convert("RGB")
+    img.thumbnail((sample_edge, sample_edge), Image.BILINEAR)
+    rgb = np.asarray(img, dtype=np.float32) / 255.0
+
+    lab = rgb_to_lab(rgb).astype(np.float32)
+    points = lab.reshape(-1, 3)
+    centers, labels = kmeans(points, colors)
+    shares = np.bincount(labels, minlength=len(centers)) / len(points)
+    order = np.argsort(-shares)
+    palette = [
+        {"hex": lab_to_hex(centers[i]), "lab": [round(float(v), 1) for v in centers[i]],
+         "share": round(float(shares[i]), 3)}
+        for i in order if shares[i] > 0
+    ]
+    return {
+        "palette": palette,
+        "lighting": estimate_illuminant(rgb),
+        "wall": _wall_stats(lab, labels, centers),
+        "brightness": round(float(points[:, 0].mean()), 1),
+        "size": list(img.size),
+        "ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+def summarize(analysis: Dict[str, Any]) -> str:
+    """One line of prompt text for an :func:`analyze` result."""
+    parts = ["dominant colors " + ", ".join(f"{c['hex']} {round(c['share'] * 100)}%" for c in analysis["palette"])]
+    lighting = analysis["lighting"]
+    if lighting["cct_k"]:
+        parts.append(f"lighting about {lighting['cct_k']}K ({lighting['tone']})")
+    wall = analysis["wall"]
+    if wall:
+        parts.append(
+            f"likely wall color {wall['hex']} ({wall['undertone']} undertone, L*{wall['lab'][0]:.0f}, "
+            f"{round(wall['coverage'] * 100)}% of frame)"
+        )
+    parts.append(f"overall brightness L*{analysis['brightness']:.0f}/100")
+    return "; ".join(parts)
+
+
+def analyze_many(images: List[bytes], colors: int = 5, sample_edge: int = 128) -> List[Optional[Dict[str, Any]]]:
+    """:func:`analyze` each image; images that cannot be decoded yield None."""
+    results: List[Optional[Dict[str, Any]]] = []
+    for data in images:
+        try:
+            results.append(analyze(data, colors=colors, sample_edge=sample_edge))
+        except Exception:
+            results.append(None)
+    return results
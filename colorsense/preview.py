@@ -0,0 +1,205 @@
+import base64
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from .conf import setting
+
+try:
+    import cv2  # type: ignore
+except ImportError:  # pragma: no cover - previews need OpenCV
+    cv2 = None
+
+
+# 2D wall recolor previews.
+#
+# The wall mask comes from classical segmentation: a flood fill from a hint
+# point (the user's click, or the upper middle of the frame) over a smoothed
+# CIELAB image, bounded by Canny edges, plus any other large regions of the same
+# color (walls split by furniture or doors). Recoloring keeps each pixel's
+# lightness offset from the wall's mean lightness, so shading and texture
+# survive, and swaps in the target a*/b*. With a*/b* fixed the output color only
+# depends on L*, so each swatch is one 256-entry lookup table gathered over the
+# wall pixels. Masks are cached per image and hint, so all the swatches of one
+# suggestion render against a single segmentation.
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_PREVIEW", {}) or {}
+    return {
+        "max_edge": int(conf.get("MAX_EDGE", 768)),
+        "l_tolerance": int(conf.get("L_TOLERANCE", 30)),
+        "ab_tolerance": int(conf.get("AB_TOLERANCE", 8)),
+        "cache_entries": int(conf.get("CACHE_ENTRIES", 16)),
+        "quality": int(conf.get("QUALITY", 85)),
+    }
+
+
+class WallMask:
+    """Decoded image plus the wall pixels' indices, blend weights and lightness, ready to recolor."""
+
+    def __init__(self, bgr: np.ndarray, lightness: np.ndarray, alpha: np.ndarray, hint: Tuple[int, int]):
+        self.bgr = bgr
+        self.hint = hint
+        self.coverage = float(alpha.sum() / alpha.size)
+        self.index = np.flatnonzero(alpha > 1 / 255)
+        self.alpha = alpha.reshape(-1)[self.index][:, None]
+        self.pixels = bgr.reshape(-1, 3)[self.index].astype(np.float32)
+        wall_l = lightness.reshape(-1)[self.index]
+        weights = self.alpha[:, 0].sum()
+        self.mean_l = float((wall_l * self.alpha[:, 0]).sum() / weights) if weights else 50.0
+        self.shading = wall_l - self.mean_l
+
+
+def _decode(data: bytes, max_edge: int) -> np.ndarray:
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image.")
+    h, w = image.shape[:2]
+    scale = max_edge / max(h, w)
+    if scale < 1:
+        image = cv2.resize(image, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+    return image
+
+
+def segment_wall(bgr: np.ndarray, hint: Tuple[float, float] = None, l_tolerance: int = 30,
+                 ab_tolerance: int = 8):
+    """
+    Soft wall mask (float32, 0..1) for ``bgr``. ``hint`` is an (x, y) point in
+    0..1 image fractions on the wall; the default is the upper middle. Returns
+    ``(alpha, seed, lightness)`` with lightness as CIELAB L* (0..100).
+    """
+    h, w = bgr.shape[:2]
+    hx, hy = hint or (0.5, 0.25)
+    seed = (min(max(int(hx * w), 0), w - 1), min(max(int(hy * h), 0), h - 1))
+
+    smooth = cv2.GaussianBlur(bgr, (5, 5), 0)
+    lab8 = cv2.cvtColor(smooth, cv2.COLOR_BGR2LAB)
+    edges = cv2.Canny(cv2.cvtColor(smooth, cv2.COLOR_BGR2GRAY), 40, 120)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+
+    # floodFill never enters pixels already set in its mask, so edges act as
+    # walls. Floating range (each pixel against its neighbour) follows smooth
+    # lighting falloff across the wall; the small per-step tolerance stops it at
+    # soft boundaries the edge map missed.
+    fill = np.zeros((h + 2, w + 2), np.uint8)
+    fill[1:-1, 1:-1][edges > 0] = 1
+    fill[seed[1] + 1, seed[0] + 1] = 0
+    step = (max(l_tolerance // 8, 2), max(ab_tolerance // 4, 1), max(ab_tolerance // 4, 1))
+    cv2.floodFill(lab8, fill, seed, 0, step, step, 4 | cv2.FLOODFILL_MASK_ONLY | (255 << 8))
+    region = fill[1:-1, 1:-1] == 255
+
+    if region.sum() >= 64:
+        # Other large regions of the same color: wall visible around furniture.
+        # Judged on each region's mean, so a bright window next to a pale wall
+        # is not pulled in pixel by pixel.
+        mean = lab8[region].astype(np.float32).mean(axis=0)
+        lab_f = lab8.astype(np.float32)
+        similar = (np.abs(lab_f - mean) <= (l_tolerance, ab_tolerance, ab_tolerance)).all(axis=2) & (edges == 0)
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(similar.astype(np.uint8), connectivity=4)
+        areas = np.maximum(stats[:, cv2.CC_STAT_AREA], 1)
+        means = np.stack([np.bincount(labels.ravel(), weights=lab_f[..., c].ravel(), minlength=count)
+                          for c in range(3)], axis=1) / areas[:, None]
+        close = (np.abs(means - mean) <= (l_tolerance / 2, ab_tolerance / 2, ab_tolerance / 2)).all(axis=1)
+        keep = close & (areas >= 0.02 * h * w)
+        keep[0] = False
+        region |= keep[labels]
+
+    mask = region.astype(np.uint8) * 255
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    alpha = cv2.GaussianBlur(mask, (0, 0), 1.5).astype(np.float32) / 255.0
+    lightness = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB)[..., 0].astype(np.float32) * (100 / 255)
+    return alpha, seed, lightness
+
+
+_cache: "OrderedDict[Any, WallMask]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def wall_mask(key: Any, data: bytes, hint: Tuple[float, float] = None) -> Tuple[WallMask, bool]:
+    """Cached :func:`segment_wall` for image ``key``; returns ``(mask, cache_hit)``."""
+    opts = _options()
+    if hint is not None:
+        hint = (round(hint[0], 3), round(hint[1], 3))
+    cache_key = (key, hint, opts["max_edge"], opts["l_tolerance"], opts["ab_tolerance"])
+    with _cache_lock:
+        if cache_key in _cache:
+            _cache.move_to_end(cache_key)
+            return _cache[cache_key], True
+
+    bgr = _decode(data, opts["max_edge"])
+    alpha, seed, lightness = segment_wall(bgr, hint, opts["l_tolerance"], opts["ab_tolerance"])
+    mask = WallMask(bgr, lightness, alpha, seed)
+    with _cache_lock:
+        _cache[cache_key] = mask
+        while len(_cache) > opts["cache_entries"]:
+            _cache.popitem(last=False)
+    return mask, False
+
+
+def hex_to_lab(hex_code: str) -> np.ndarray:
+    value = hex_code.strip().lstrip("#")
+    if len(value) != 6:
+        raise ValueError(f"Invalid hex color: {hex_code!r}")
+    rgb = np.array([[[int(value[i:i + 2], 16) for i in (4, 2, 0)]]], dtype=np.float32) / 255.0
+    return cv2.cvtColor(rgb, cv2.COLOR_BGR2LAB)[0, 0]
+
+
+def _lut(target: np.ndarray) -> np.ndarray:
+    """BGR (float32, 0..255) for L* = 0..100 in 256 steps at the target's a*/b*."""
+    lab = np.empty((1, 256, 3), dtype=np.float32)
+    lab[0, :, 0] = np.linspace(0, 100, 256, dtype=np.float32)
+    lab[0, :, 1] = target[1]
+    lab[0, :, 2] = target[2]
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)[0] * 255.0
+
+
+def recolor(mask: WallMask, hexes: List[str]) -> List[np.ndarray]:
+    """Recolor the masked wall to each hex, preserving the original shading; returns BGR uint8 images."""
+    outputs = []
+    for hex_code in hexes:
+        target = hex_to_lab(hex_code)
+        steps = np.clip((target[0] + mask.shading) * 2.55 + 0.5, 0, 255).astype(np.uint8)
+        painted = _lut(target)[steps]
+        image = mask.bgr.copy()
+        image.reshape(-1, 3)[mask.index] = (mask.pixels + (painted - mask.pixels) * mask.alpha).clip(0, 255)
+        outputs.append(image)
+    return outputs
+
+
+def render_previews(key: Any, data: bytes, hexes: List[str], hint: Tuple[float, float] = None) -> Dict[str, Any]:
+    """
+    Recolor the wall of one image to every hex in ``hexes``. Returns JPEG data URLs
+    in swatch order with the mask coverage and timings in milliseconds.
+    """
+    if cv2 is None:
+        raise RuntimeError("Wall previews need OpenCV (opencv-python).")
+    opts = _options()
+    start = time.perf_counter()
+    mask, cached = wall_mask(key, data, hint)
+    segmented = time.perf_counter()
+    previews = []
+    for hex_code, image in zip(hexes, recolor(mask, hexes)):
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, opts["quality"]])
+        if not ok:
+            raise RuntimeError("Could not encode preview.")
+        previews.append({
+            "hex": hex_code,
+            "image": "data:image/jpeg;base64," + base64.b64encode(encoded.tobytes()).decode("ascii"),
+        })
+    done = time.perf_counter()
+    return {
+        "previews": previews,
+        "coverage": round(mask.coverage, 3),
+        "hint": list(mask.hint),
+        "timings": {
+            "mask_ms": round((segmented - start) * 1000, 1),
+            "mask_cached": cached,
+            "render_ms": round((done - segmented) * 1000, 1),
+        },
+    }
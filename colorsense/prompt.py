@@ -0,0 +1,352 @@
+import base64
+import codecs
+import io
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .conf import setting
+
+try:
+    import tiktoken  # type: ignore
+except ImportError:  # pragma: no cover - falls back to a length estimate
+    tiktoken = None
+
+
+# Token-budgeted prompt assembly.
+#
+# A prompt gets COLORSENSE_PROMPT['MAX_TOKENS'] input tokens (capped by the
+# model's context window minus room for the reply), split between the system
+# prompt, the user's text, documents and images by SPLIT. System and image
+# tokens are mostly fixed costs; whatever they leave of their share goes to the
+# user's text first and then to documents. Documents are streamed from the
+# upload into paragraph chunks, ranked against the user's text (BM25) and the
+# best chunks that fit are kept in their original order. Counting uses tiktoken
+# when it is installed and a characters-per-token estimate otherwise.
+
+# Context windows of the models we select (see agent._select_model).
+_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "meta-llama/llama-4-maverick-17b-128e-instruct": 131072,
+}
+
+# Per-message framing tokens (role, separators) in the chat format.
+_MESSAGE_OVERHEAD = 4
+
+_CHARS_PER_TOKEN = 4
+
+_STOPWORDS = frozenset(
+    "the and for are but not you your with this that have from they will would there their what about which "
+    "when make like can all was were been has had into more some than then them these those our out very just "
+    "also its it's i'm please want".split()
+)
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_PROMPT", {}) or {}
+    split = {"system": 0.1, "user": 0.2, "docs": 0.4, "images": 0.3}
+    split.update({k.lower(): float(v) for k, v in (conf.get("SPLIT") or {}).items()})
+    return {
+        "max_tokens": int(conf.get("MAX_TOKENS", 8000)),
+        "reply_tokens": int(conf.get("REPLY_TOKENS", 2000)),
+        "split": split,
+        "chunk_tokens": int(conf.get("CHUNK_TOKENS", 300)),
+        "doc_max_bytes": int(conf.get("DOC_MAX_BYTES", 2 * 1024 * 1024)),
+    }
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception:  # pragma: no cover - BPE files missing offline
+        return None
+    try:
+        # Llama 3/4 use tiktoken-style BPE with a vocabulary close to o200k.
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:  # pragma: no cover - BPE files missing offline
+        return None
+
+
+def tokenizer_name(model: str) -> str:
+    encoding = _encoding(model)
+    return encoding.name if encoding is not None else "estimate"
+
+
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / _CHARS_PER_TOKEN)
+
+
+def truncate_tokens(text: str, limit: int, model: str) -> str:
+    """``text`` cut to at most ``limit`` tokens, at a word boundary where possible."""
+    if limit <= 0:
+        return ""
+    if count_tokens(text, model) <= limit:
+        return text
+    encoding = _encoding(model)
+    if encoding is not None:
+        cut = encoding.decode(encoding.encode(text, disallowed_special=())[:limit])
+    else:
+        cut = text[:limit * _CHARS_PER_TOKEN]
+    space = cut.rfind(" ")
+    if space > len(cut) * 0.8:
+        cut = cut[:space]
+    return cut.rstrip() + " …"
+
+
+def _image_size(url: str) -> Tuple[int, int]:
+    """Pixel size of a data URL image from its header; remote URLs are assumed 1024x1024."""
+    if url.startswith("data:"):
+        try:
+            from PIL import Image  # type: ignore
+            encoded = url.split(",", 1)[1]
+            # The dimensions sit in the first few KB (metadata is stripped in preprocess_image).
+            head = base64.b64decode(encoded[:65536 - 65536 % 4])
+            return Image.open(io.BytesIO(head)).size
+        except Exception:
+            pass
+    return 1024, 1024
+
+
+def image_tokens(url: str, detail: str = "high") -> int:
+    """
+    Input tokens for one image using OpenAI's tile formula (85 base + 170 per
+    512px tile after fitting into 2048px and scaling the short side to 768px).
+    Used as the estimate for other providers too.
+    """
+    if detail == "low":
+        return 85
+    w, h = _image_size(url)
+    scale = min(1.0, 2048 / max(w, h))
+    w, h = w * scale, h * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+def read_document(upload, max_bytes: int = None) -> Iterator[str]:
+    """
+    Decoded text of an uploaded .txt/.md file, piece by piece from the upload's
+    chunks so a large document is never held in memory whole. Stops after
+    ``max_bytes``.
+    """
+    if max_bytes is None:
+        max_bytes = _options()["doc_max_bytes"]
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    chunks = upload.chunks() if hasattr(upload, "chunks") else iter(lambda: upload.read(64 * 1024), b"")
+    remaining = max_bytes
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+        if remaining <= 0:
+            break
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def chunk_text(pieces: Iterable[str], chunk_tokens: int = None) -> List[str]:
+    """
+    Group streamed text into chunks of about ``chunk_tokens`` tokens along
+    paragraph boundaries; paragraphs longer than a chunk are split on sentences
+    (or whitespace).
+    """
+    if chunk_tokens is None:
+        chunk_tokens = _options()["chunk_tokens"]
+    limit = max(chunk_tokens, 16) * _CHARS_PER_TOKEN
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+
+    def flush() -> None:
+        nonlocal current, size
+        if current:
+            chunks.append("\n\n".join(current))
+        current, size = [], 0
+
+    def add(paragraph: str) -> None:
+        nonlocal size
+        paragraph = paragraph.strip()
+        if not paragraph:
+            return
+        while len(paragraph) > limit:
+            cut = max(paragraph.rfind(". ", 0, limit), paragraph.rfind("\n", 0, limit))
+            if cut < limit // 2:
+                cut = paragraph.rfind(" ", 0, limit)
+            if cut < limit // 2:
+                cut = limit
+            flush()
+            chunks.append(paragraph[:cut + 1].strip())
+            paragraph = paragraph[cut + 1:].strip()
+        if size + len(paragraph) > limit:
+            flush()
+        current.append(paragraph)
+        size += len(paragraph) + 2
+
+    buffer = ""
+    for piece in pieces:
+        buffer += piece.replace("\r\n", "\n")
+        paragraphs = re.split(r"\n\s*\n", buffer)
+        buffer = paragraphs.pop()
+        for paragraph in paragraphs:
+            add(paragraph)
+        # A document without blank lines would otherwise buffer whole.
+        if len(buffer) > limit * 4:
+            add(buffer)
+            buffer = ""
+    add(buffer)
+    flush()
+    return chunks
+
+
+def _terms(text: str) -> List[str]:
+    return [w for w in re.findall(r"[a-z0-9#]+", text.lower()) if len(w) > 2 and w not in _STOPWORDS]
+
+
+def rank_chunks(chunks: List[str], query: str, k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """BM25 relevance of each chunk to ``query``; all zeros when the query has no terms."""
+    query_terms = set(_terms(query))
+    if not chunks or not query_terms:
+        return [0.0] * len(chunks)
+    docs = [Counter(_terms(chunk)) for chunk in chunks]
+    lengths = [sum(doc.values()) for doc in docs]
+    average = (sum(lengths) / len(lengths)) or 1.0
+    scores = []
+    for doc, length in zip(docs, lengths):
+        score = 0.0
+        for term in query_terms:
+            tf = doc.get(term, 0)
+            if not tf:
+                continue
+            df = sum(1 for d in docs if term in d)
+            idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average))
+        scores.append(score)
+    return scores
+
+
+def select_chunks(chunks: List[str], query: str, budget: int, model: str) -> Tuple[List[str], int]:
+    """
+    Highest ranked chunks that fit in ``budget`` tokens, in document order.
+    Ties (and a query with no usable terms) favour earlier chunks. Returns
+    ``(chunks, tokens)``.
+    """
+    scores = rank_chunks(chunks, query)
+    order = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+    chosen: List[int] = []
+    used = 0
+    for i in order:
+        # Separator between chunks costs about two tokens.
+        cost = count_tokens(chunks[i], model) + 2
+        if used + cost <= budget:
+            chosen.append(i)
+            used += cost
+    return [chunks[i] for i in sorted(chosen)], used
+
+
+def context_budget(model: str) -> int:
+    opts = _options()
+    window = _CONTEXT_WINDOWS.get(model, 128000)
+    return max(min(opts["max_tokens"], window - opts["reply_tokens"]), 0)
+
+
+class PromptPlan:
+    """What to send for one request, fitted to the model's token budget, plus the accounting."""
+
+    def __init__(self, user_text: str, notes: List[str], doc_texts: List[str], image_detail: Optional[str],
+                 report: Dict[str, Any]):
+        self.user_text = user_text
+        self.notes = notes
+        self.doc_texts = doc_texts
+        self.image_detail = image_detail
+        self.report = report
+
+
+def plan_prompt(model: str, system: str, user_text: str, notes: List[str], doc_chunks: List[str],
+                images: List[str], low_detail: bool = False, preferences: str = "") -> PromptPlan:
+    """
+    Fit the parts of a prompt into :func:`context_budget` following the configured
+    split. ``low_detail`` allows sending images at low detail when they would not
+    fit their share at full detail (OpenAI only). ``preferences`` (a profile
+    summary) is counted with the notes and, like them, never truncated.
+    """
+    opts = _options()
+    total = context_budget(model)
+    caps = {part: int(total * share) for part, share in opts["split"].items()}
+
+    system_tokens = count_tokens(system, model) + _MESSAGE_OVERHEAD
+    detail = None
+    image_costs = [image_tokens(url) for url in images]
+    if low_detail and images and sum(image_costs) > caps.get("images", 0):
+        detail = "low"
+        image_costs = [image_tokens(url, "low") for url in images]
+    image_tokens_used = sum(image_costs)
+
+    # Shares the fixed parts leave unused are spent on user text, then documents.
+    spare = max(caps.get("system", 0) - system_tokens, 0) + max(caps.get("images", 0) - image_tokens_used, 0)
+
+    notes_text = "\n".join(notes + [preferences] if preferences else notes)
+    need_user = count_tokens(user_text, model) + count_tokens(notes_text, model) + _MESSAGE_OVERHEAD
+    user_budget = caps.get("user", 0) + spare
+    if need_user > user_budget:
+        # Photo analysis lines are short and worth more than the tail of a long description.
+        room = user_budget - count_tokens(notes_text, model) - _MESSAGE_OVERHEAD
+        user_text = truncate_tokens(user_text, room, model)
+        need_user = count_tokens(user_text, model) + count_tokens(notes_text, model) + _MESSAGE_OVERHEAD
+    spare -= max(min(need_user, user_budget) - caps.get("user", 0), 0)
+
+    doc_budget = max(caps.get("docs", 0) + max(spare, 0), 0)
+    doc_texts, doc_tokens = select_chunks(doc_chunks, user_text, doc_budget, model) if doc_chunks else ([], 0)
+
+    used = system_tokens + need_user + doc_tokens + image_tokens_used
+    report = {
+        "model": model,
+        "tokenizer": tokenizer_name(model),
+        "budget": total,
+        "tokens": {
+            "system": system_tokens,
+            "user": need_user,
+            "docs": doc_tokens,
+            "images": image_tokens_used,
+            "total": used,
+        },
+        "docs": {"chunks": len(doc_chunks), "used": len(doc_texts)},
+        "image_detail": detail or "high",
+        "over_budget": used > total,
+    }
+    return PromptPlan(user_text, notes, doc_texts, detail, report)
+
+
+def count_messages(messages: List[Dict[str, Any]], model: str) -> int:
+    """Token count of a final message list, images included."""
+    total = 3  # reply priming
+    for message in messages:
+        total += _MESSAGE_OVERHEAD
+        content = message["content"]
+        if isinstance(content, str):
+            total += count_tokens(content, model)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                total += count_tokens(part["text"], model)
+            elif part.get("type") == "image_url":
+                image = part["image_url"]
+                total += image_tokens(image["url"], image.get("detail", "high"))
+    return total
@@ -1,63 +1,530 @@
-import pycolmap
-import open3d as o3d
+import importlib
+import json
+import logging
 import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
 
+from . import metrics, workspace
 
-def reconstruct_3d(image_dir, work_dir="media/reconstruction_output"):
+logger = logging.getLogger(__name__)
+
+
+class _LazyModule:
+    """
+    Import a module on first attribute access. pycolmap and open3d take seconds
+    and hundreds of MB to load, so they are only pulled in when a stage actually
+    runs; a fully cached pipeline never loads them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+pycolmap = _LazyModule("pycolmap")
+o3d = _LazyModule("open3d")
+np = _LazyModule("numpy")
+
+
+@contextmanager
+def _stage(progress, name):
+    """
+    Report ``name`` to ``progress(name, None)`` on start and ``progress(name, seconds)``
+    when done. Yields the stage's metrics span info (seconds, RSS change).
+    """
+    if progress:
+        progress(name, None)
+    start = time.perf_counter()
+    with metrics.span(f"reconstruct.{name}") as measured:
+        yield measured
+    if progress:
+        progress(name, time.perf_counter() - start)
+
+
+def _run_stage(work_dir, name, progress, fn, key=None):
+    """
+    Run one pipeline stage unless its marker says the output is already on disk
+    (and, when ``key`` is given, was produced with the same key). Re-running a
+    stage invalidates everything downstream of it.
+    """
+    if workspace.is_done(work_dir, name):
+        info = workspace.stage_info(work_dir, name)
+        if key is None or info.get("key") == key:
+            if progress:
+                progress(name, 0.0)
+            return info
+    workspace.clear_from(work_dir, workspace.STAGES[workspace.STAGES.index(name):])
+    with _stage(progress, name) as measured:
+        info = fn() or {}
+    info["rss_delta_mb"] = round(measured.get("rss_delta", 0) / (1024 * 1024), 1)
+    if key is not None:
+        info["key"] = key
+    workspace.mark_done(work_dir, name, info)
+    return info
+
+
+MATCHING_MODES = ("auto", "exhaustive", "sequential", "spatial", "vocabtree")
+
+DEFAULT_OPTIONS = {
+    "matching": "auto",
+    "threads": -1,
+    "sequential_overlap": 10,
+    "exhaustive_max_images": 40,
+    "vocab_tree": None,
+    "vocab_tree_min_images": 100,
+    "lods": (2000, 20000, 80000),
+    # Point-cloud preprocessing before meshing (see preprocess_point_cloud).
+    "voxel_size": None,
+    "target_points": 200000,
+    "outlier_removal": "statistical",
+    "outlier_neighbors": 20,
+    "outlier_std_ratio": 2.0,
+    "outlier_radius_factor": 6.0,
+    "normal_neighbors": 30,
+    "orient_max_points": 100000,
+    "poisson_depth": None,
+    "poisson_min_depth": 6,
+    "poisson_max_depth": 11,
+    "density_trim": 0.02,
+}
+
+OUTLIER_MODES = ("statistical", "radius", "none")
+MESH_OPTIONS = ("voxel_size", "target_points", "outlier_removal", "outlier_neighbors", "outlier_std_ratio",
+                "outlier_radius_factor", "normal_neighbors", "orient_max_points", "poisson_depth",
+                "poisson_min_depth", "poisson_max_depth", "density_trim")
+
+
+def _db_count(db_path, sql):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(sql).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+def choose_matching(num_images, has_location_priors, options):
+    """
+    Automatic matching policy. Small sets are matched exhaustively (O(n^2) is
+    cheap and most robust); large sets use vocabulary-tree retrieval when a tree
+    is configured, spatial matching when images carry GPS priors, and sequential
+    matching (walkthrough video frames) otherwise.
+    """
+    if num_images <= options["exhaustive_max_images"]:
+        return "exhaustive"
+    if options["vocab_tree"] and num_images >= options["vocab_tree_min_images"]:
+        return "vocabtree"
+    if has_location_priors:
+        return "spatial"
+    return "sequential"
+
+
+def match_features(db_path, mode, options):
+    """Run the requested matcher; returns the mode used and pair/match counts from the database."""
+    threads = int(options["threads"])
+    if mode == "auto":
+        num_images = (_db_count(db_path, "SELECT COUNT(*) FROM images") or (0,))[0]
+        priors = (_db_count(db_path, "SELECT COUNT(*) FROM pose_priors") or (0,))[0]
+        mode = choose_matching(num_images, priors > 0, options)
+
+    matching_options = pycolmap.FeatureMatchingOptions()
+    matching_options.num_threads = threads
+    if mode == "exhaustive":
+        pycolmap.match_exhaustive(db_path, matching_options=matching_options)
+    elif mode == "sequential":
+        pairing = pycolmap.SequentialPairingOptions()
+        pairing.overlap = int(options["sequential_overlap"])
+        pairing.num_threads = threads
+        if options["vocab_tree"]:
+            # Closes loops when a walkthrough returns to where it started.
+            pairing.loop_detection = True
+            pairing.vocab_tree_path = options["vocab_tree"]
+        pycolmap.match_sequential(db_path, matching_options=matching_options, pairing_options=pairing)
+    elif mode == "spatial":
+        pairing = pycolmap.SpatialPairingOptions()
+        pairing.num_threads = threads
+        pycolmap.match_spatial(db_path, matching_options=matching_options, pairing_options=pairing)
+    elif mode == "vocabtree":
+        if not options["vocab_tree"]:
+            raise RuntimeError("Vocabulary tree matching needs COLORSENSE_RECONSTRUCTION['VOCAB_TREE'].")
+        pairing = pycolmap.VocabTreePairingOptions()
+        pairing.vocab_tree_path = options["vocab_tree"]
+        pairing.num_threads = threads
+        pycolmap.match_vocabtree(db_path, matching_options=matching_options, pairing_options=pairing)
+    else:
+        raise ValueError(f"Unknown matching mode: {mode}")
+
+    candidates = (_db_count(db_path, "SELECT COUNT(*) FROM matches") or (0,))[0]
+    verified, inliers = _db_count(
+        db_path, "SELECT COUNT(*), COALESCE(SUM(rows), 0) FROM two_view_geometries WHERE rows > 0"
+    ) or (0, 0)
+    return {"mode": mode, "candidate_pairs": candidates, "verified_pairs": verified, "inlier_matches": inliers}
+
+
+def _extracted_images(db_path):
+    """
+    Names of images whose features are already in ``db_path``, after dropping
+    rows an interrupted extraction left half-written. None if the database is
+    unreadable.
+    """
+    if not os.path.exists(db_path):
+        return set()
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            with conn:
+                conn.execute("DELETE FROM images WHERE image_id NOT IN (SELECT image_id FROM keypoints)"
+                             " OR image_id NOT IN (SELECT image_id FROM descriptors)")
+                conn.execute("DELETE FROM keypoints WHERE image_id NOT IN (SELECT image_id FROM images)")
+                conn.execute("DELETE FROM descriptors WHERE image_id NOT IN (SELECT image_id FROM images)")
+            return {row[0] for row in conn.execute("SELECT name FROM images")}
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return None
+
+
+def extract_features(db_path, image_dir, options=None):
+    """
+    SIFT features for the images in ``image_dir`` that ``db_path`` does not have
+    yet, so extraction can run in batches as an upload's files complete (see
+    uploads.py) and the features stage only finishes the rest.
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    done = _extracted_images(db_path)
+    if done is None:
+        os.remove(db_path)
+        done = set()
+    names = sorted(name for name in os.listdir(image_dir)
+                   if os.path.splitext(name)[1].lower() in workspace.IMAGE_EXTENSIONS)
+    missing = [name for name in names if name not in done]
+    if missing:
+        extraction_options = pycolmap.FeatureExtractionOptions()
+        extraction_options.num_threads = int(options["threads"])
+        pycolmap.extract_features(db_path, image_dir, image_names=missing, extraction_options=extraction_options)
+    images, keypoints = _db_count(db_path, "SELECT COUNT(*), COALESCE(SUM(rows), 0) FROM keypoints") or (0, 0)
+    return {"images": images, "keypoints": keypoints, "extracted": len(missing)}
+
+
+def reconstruct_3d(image_dir, work_dir="media/reconstruction_output", progress=None, options=None):
+    """
+    Sparse reconstruction of ``image_dir`` into ``work_dir``. ``options`` overrides
+    DEFAULT_OPTIONS (matching mode, CPU threads, matcher tuning).
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
     os.makedirs(work_dir, exist_ok=True)
 
     db_path = os.path.join(work_dir, "database.db")
     sparse_path = os.path.join(work_dir, "sparse")
+    ply_path = os.path.join(sparse_path, "fused.ply")
    # dense_path = os.path.join(work_dir, "dense")
-    os.makedirs(sparse_path, exist_ok=True)
     #os.makedirs(dense_path, exist_ok=True)
 
-    # Step 1: Feature extraction
-    pycolmap.extract_features(db_path, image_dir)
+    # Step 1: Feature extraction (images extracted while the upload was running are kept)
+    def features():
+        return extract_features(db_path, image_dir, options)
 
     # Step 2: Feature matching
-    pycolmap.match_exhaustive(db_path)
+    def matching():
+        return match_features(db_path, options["matching"], options)
 
     # Step 3: Sparse reconstruction
-    pycolmap.incremental_mapping(db_path, image_dir, sparse_path)
+    def mapping():
+        shutil.rmtree(sparse_path, ignore_errors=True)
+        os.makedirs(sparse_path, exist_ok=True)
+        reconstructions = pycolmap.incremental_mapping(db_path, image_dir, sparse_path)
+        if not reconstructions:
+            raise RuntimeError("Sparse reconstruction failed: no images could be registered.")
+        # Keep the largest model; mapping writes each one as a binary model under sparse/<n>.
+        best = max(reconstructions.values(), key=lambda rec: rec.num_points3D())
+        best.export_PLY(ply_path)
+        return {"points": best.num_points3D(), "images": best.num_reg_images()}
+
+    _run_stage(work_dir, "features", progress, features)
+    _run_stage(work_dir, "matching", progress, matching, key=options["matching"])
+    _run_stage(work_dir, "mapping", progress, mapping)
 
     # Step 4: Dense reconstruction
     #pycolmap.stereo(image_dir, os.path.join(sparse_path, "0"), dense_path)
 
-    ply_path = os.path.join(sparse_path, "fused.ply")
     return ply_path
 
 
-def pointcloud_to_textured_mesh(ply_path, output_mesh="media/textured_mesh.obj"):
-    # Load point cloud
-    pcd = o3d.io.read_point_cloud(ply_path)
+def run_pipeline(work_dir, progress=None, options=None):
+    """
+    Images under ``work_dir/images`` to mesh LODs under ``work_dir/mesh``, skipping
+    stages already done for this workspace. Returns the LOD manifest path.
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    ply_path = reconstruct_3d(os.path.join(work_dir, "images"), work_dir, progress=progress, options=options)
+    mesh_dir = os.path.join(work_dir, "mesh")
+
+    def mesh():
+        with metrics.span("reconstruct.mesh.build"):
+            built, report = build_mesh(ply_path, options)
+        with metrics.span("reconstruct.mesh.export"):
+            manifest = export_lods(built, mesh_dir, options["lods"])
+        report["lods"] = [{"triangles": lod["triangles"], "bytes": lod["bytes"]} for lod in manifest["lods"]]
+        return report
+
+    # Changing the LOD budgets or any preprocessing option rebuilds the mesh.
+    key = json.dumps({"lods": sorted(int(n) for n in options["lods"]),
+                      **{name: options[name] for name in MESH_OPTIONS}}, sort_keys=True)
+    _run_stage(work_dir, "mesh", progress, mesh, key=key)
+    return os.path.join(mesh_dir, "manifest.json")
+
+
+@contextmanager
+def _timed(name):
+    """metrics.span that always reports ``seconds``, even with metrics disabled."""
+    start = time.perf_counter()
+    with metrics.span(f"reconstruct.mesh.{name}") as measured:
+        yield measured
+        measured.setdefault("seconds", time.perf_counter() - start)
+
+
+def _spacing(pcd):
+    """Median nearest-neighbour distance: the cloud's own length scale."""
+    distances = np.asarray(pcd.compute_nearest_neighbor_distance())
+    distances = distances[distances > 0]
+    if len(distances):
+        return float(np.median(distances))
+    extent = pcd.get_axis_aligned_bounding_box().get_max_extent()
+    return float(extent) / 100.0 or 1e-3
+
+
+def preprocess_point_cloud(pcd, options=None):
+    """
+    Downsample, denoise and orient ``pcd`` for surface reconstruction.
 
-    if not pcd.has_normals():
-        print("⚠️ No normals found — estimating...")
+    Sizes are relative to the cloud's median point spacing, so the same options
+    work whatever scale COLMAP picked. The voxel grid is sized to leave about
+    ``target_points`` points (a surface's point count grows with the square of
+    1/voxel) unless ``voxel_size`` fixes it. Returns ``(pcd, spacing, steps)``,
+    where each step records its point count and time.
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    mode = options["outlier_removal"] or "none"
+    if mode not in OUTLIER_MODES:
+        raise RuntimeError(f"Unknown outlier removal {mode!r}; expected one of {', '.join(OUTLIER_MODES)}.")
+    steps = [{"step": "input", "points": len(pcd.points), "seconds": 0.0}]
+
+    def done(name, measured, **extra):
+        steps.append({"step": name, "points": len(pcd.points), "seconds": round(measured["seconds"], 3), **extra})
+
+    with _timed("spacing") as measured:
+        spacing = _spacing(pcd)
+    done("spacing", measured, spacing=spacing)
+
+    voxel = options["voxel_size"]
+    if voxel is None and len(pcd.points) > options["target_points"]:
+        voxel = spacing * (len(pcd.points) / options["target_points"]) ** 0.5
+    if voxel:
+        with _timed("downsample") as measured:
+            pcd = pcd.voxel_down_sample(float(voxel))
+            spacing = max(spacing, float(voxel))
+        done("downsample", measured, voxel=float(voxel))
+
+    if mode != "none" and len(pcd.points) > options["outlier_neighbors"]:
+        with _timed("outliers") as measured:
+            if mode == "statistical":
+                pcd, _ = pcd.remove_statistical_outlier(nb_neighbors=int(options["outlier_neighbors"]),
+                                                        std_ratio=float(options["outlier_std_ratio"]))
+            else:
+                pcd, _ = pcd.remove_radius_outlier(nb_points=int(options["outlier_neighbors"]) // 2,
+                                                   radius=spacing * float(options["outlier_radius_factor"]))
+        done("outliers", measured, mode=mode)
+
+    # Open3D estimates normals on all cores; orientation is the slow part. The
+    # tangent-plane propagation gives consistent normals but is a spanning tree
+    # over the whole cloud, so large clouds orient towards the centroid instead:
+    # the cameras that captured a room stand inside it.
+    with _timed("normals") as measured:
         pcd.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(
-            radius=0.1, max_nn=30
-        ))
+            radius=spacing * 4.0, max_nn=int(options["normal_neighbors"])))
+        orientation = "centroid"
+        if len(pcd.points) <= options["orient_max_points"]:
+            try:
+                pcd.orient_normals_consistent_tangent_plane(min(int(options["normal_neighbors"]), 15))
+                orientation = "tangent_plane"
+            except RuntimeError:
+                # Its Qhull triangulation fails on a flat or collinear cloud (e.g. one wall).
+                pass
+        if orientation == "centroid":
+            pcd.orient_normals_towards_camera_location(pcd.get_center())
+    done("normals", measured, orientation=orientation)
+    return pcd, spacing, steps
+
+
+def poisson_depth(pcd, spacing, options=None):
+    """Octree depth whose finest cells are about one point spacing across, within the configured bounds."""
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    if options["poisson_depth"]:
+        return int(options["poisson_depth"])
+    # Open3D's octree spans the bounding box scaled by 1.1.
+    extent = float(pcd.get_axis_aligned_bounding_box().get_max_extent()) * 1.1
+    depth = int(np.ceil(np.log2(max(extent / max(spacing, 1e-9), 1.0))))
+    return int(min(max(depth, options["poisson_min_depth"]), options["poisson_max_depth"]))
+
+
+def transfer_colors(mesh, pcd):
+    """Colour each mesh vertex from its nearest cloud point (Poisson vertices do not map 1:1 to points)."""
+    if not pcd.has_colors() or not len(mesh.vertices):
+        return mesh
+    points = np.asarray(pcd.points)
+    colors = np.asarray(pcd.colors)
+    vertices = np.asarray(mesh.vertices)
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        tree = o3d.geometry.KDTreeFlann(pcd)
+        nearest = np.fromiter((tree.search_knn_vector_3d(v, 1)[1][0] for v in vertices),
+                              dtype=np.int64, count=len(vertices))
+    else:
+        _, nearest = cKDTree(points).query(vertices, k=1, workers=-1)
+    mesh.vertex_colors = o3d.utility.Vector3dVector(colors[nearest])
+    return mesh
+
+
+def build_mesh(ply_path, options=None):
+    """
+    Surface mesh from a point cloud: preprocessing, then Poisson for dense clouds
+    and an alpha shape for sparse ones, with colours transferred by nearest
+    neighbour. Returns ``(mesh, report)``; the report lists point counts and
+    timings per step.
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    pcd = o3d.io.read_point_cloud(ply_path)
+    if pcd.is_empty():
+        raise RuntimeError(f"Point cloud {ply_path} is empty.")
+    colored = pcd
+    pcd, spacing, steps = preprocess_point_cloud(pcd, options)
+    report = {"steps": steps, "spacing": spacing}
 
-    # If still too few points, fallback to Alpha Shape
     if len(pcd.points) < 500:  # Sparse recon may give very few points
-        print("⚠️ Sparse point cloud is too small, using Alpha Shape mesh.")
-        mesh = o3d.geometry.TriangleMesh.create_from_point_cloud_alpha_shape(pcd, alpha=0.03)
+        logger.warning("Sparse point cloud %s has only %d points; using an alpha shape mesh.", ply_path, len(pcd.points))
+        with _timed("surface") as measured:
+            try:
+                mesh = o3d.geometry.TriangleMesh.create_from_point_cloud_alpha_shape(pcd, alpha=spacing * 5.0)
+            except RuntimeError as e:
+                # Qhull cannot tetrahedralize a flat or collinear cloud.
+                raise RuntimeError(f"Sparse point cloud {ply_path} ({len(pcd.points)} points) is too flat "
+                                   "to mesh; add photos from more viewpoints.") from e
+        report["method"] = "alpha_shape"
     else:
-        # Poisson reconstruction
-        mesh, _ = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(pcd, depth=8)
+        depth = poisson_depth(pcd, spacing, options)
+        with _timed("surface") as measured:
+            mesh, densities = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(pcd, depth=depth)
+            densities = np.asarray(densities)
+            if not len(densities):
+                raise RuntimeError(f"Poisson reconstruction (depth {depth}) returned no surface "
+                                   f"for {len(pcd.points)} points.")
+            # Poisson closes the surface across holes with low-density vertices; drop the thinnest.
+            if options["density_trim"]:
+                mesh.remove_vertices_by_mask(densities < np.quantile(densities, float(options["density_trim"])))
+            mesh = mesh.crop(pcd.get_axis_aligned_bounding_box())
+        report.update(method="poisson", depth=depth)
+    steps.append({"step": "surface", "points": len(mesh.vertices), "triangles": len(mesh.triangles),
+                  "seconds": round(measured["seconds"], 3)})
+
+    with _timed("colors") as measured:
+        # Colours come from the full cloud, before downsampling averaged them.
+        mesh = transfer_colors(mesh, colored)
+    steps.append({"step": "colors", "points": len(mesh.vertices), "seconds": round(measured["seconds"], 3)})
+    return mesh, report
 
-        # Crop to bounding box
-        bbox = pcd.get_axis_aligned_bounding_box()
-        mesh = mesh.crop(bbox)
+
+def pointcloud_to_textured_mesh(ply_path, output_mesh="media/textured_mesh.obj"):
+    mesh, _ = build_mesh(ply_path)
 
     # Simplify mesh
     mesh = mesh.simplify_quadric_decimation(target_number_of_triangles=20000)
 
-    # Add vertex colors if available
-    if pcd.has_colors():
-        mesh.vertex_colors = pcd.colors
-
     # Save mesh
     o3d.io.write_triangle_mesh(output_mesh, mesh)
     return output_mesh
 
+
+def write_quantized_ply(path, vertices, triangles, colors=None):
+    """
+    Write a binary little-endian PLY with int16 positions, uint8 vertex colors and
+    16/32-bit face indices; about a quarter of a float OBJ. Positions decode as
+    ``offset + q * scale``; returns that quantization as a dict.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+    offset = (lo + hi) / 2.0
+    scale = float(max((hi - lo).max() / 2.0, 1e-9)) / 32767.0
+
+    index_type, index_dtype = ("ushort", "<u2") if len(vertices) <= 65535 else ("uint", "<u4")
+    vertex = np.empty(len(vertices), dtype=[("x", "<i2"), ("y", "<i2"), ("z", "<i2"),
+                                            ("red", "u1"), ("green", "u1"), ("blue", "u1")])
+    q = np.clip(np.rint((vertices - offset) / scale), -32767, 32767).astype("<i2")
+    vertex["x"], vertex["y"], vertex["z"] = q[:, 0], q[:, 1], q[:, 2]
+    if colors is not None and len(colors) == len(vertices):
+        rgb = np.clip(np.rint(np.asarray(colors) * 255.0), 0, 255).astype("u1")
+    else:
+        rgb = np.full((len(vertices), 3), 200, dtype="u1")
+    vertex["red"], vertex["green"], vertex["blue"] = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    face = np.empty(len(triangles), dtype=[("n", "u1"), ("v", index_dtype, (3,))])
+    face["n"] = 3
+    face["v"] = triangles
+
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"comment offset {offset[0]:.9g} {offset[1]:.9g} {offset[2]:.9g} scale {scale:.9g}\n"
+        f"element vertex {len(vertex)}\n"
+        "property short x\nproperty short y\nproperty short z\n"
+        "property uchar red\nproperty uchar green\nproperty uchar blue\n"
+        f"element face {len(face)}\n"
+        f"property list uchar {index_type} vertex_indices\n"
+        "end_header\n"
+    )
+    with open(path, "wb") as fh:
+        fh.write(header.encode("ascii"))
+        fh.write(vertex.tobytes())
+        fh.write(face.tobytes())
+    return {"offset": offset.tolist(), "scale": scale}
+
+
+def export_lods(mesh, out_dir, budgets):
+    """
+    Quadric-decimate ``mesh`` to each triangle budget (coarse to fine) and write
+    every level as a quantized binary PLY plus a ``manifest.json`` for the viewer.
+    """
+    if not len(mesh.vertices) or not len(mesh.triangles):
+        raise RuntimeError("Meshing produced an empty surface; the photos may not overlap enough to reconstruct.")
+    os.makedirs(out_dir, exist_ok=True)
+    total = len(mesh.triangles)
+    lods = []
+    for level, budget in enumerate(sorted(set(int(b) for b in budgets))):
+        if budget >= total:
+            lod = mesh
+        else:
+            lod = mesh.simplify_quadric_decimation(target_number_of_triangles=budget)
+        name = f"lod{level}.ply"
+        path = os.path.join(out_dir, name)
+        colors = np.asarray(lod.vertex_colors) if lod.has_vertex_colors() else None
+        quant = write_quantized_ply(path, np.asarray(lod.vertices), np.asarray(lod.triangles), colors)
+        lods.append({"file": name, "triangles": len(lod.triangles), "bytes": os.path.getsize(path),
+                     "offset": quant["offset"], "scale": quant["scale"]})
+        if budget >= total:
+            break
+
+    manifest = {"lods": lods}
+    tmp = os.path.join(out_dir, "manifest.json.tmp")
+    with open(tmp, "w") as fh:
+        json.dump(manifest, fh)
+    os.replace(tmp, os.path.join(out_dir, "manifest.json"))
+    return manifest
@@ -1,6 +1,394 @@
+import atexit
+import collections
+import logging
+import math
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
-class reflection:
+from .conf import setting
 
-    def reflection_on_userprefs(userprefs):
-        user_details = userprefs['user_profile']
-        
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+
+# Per-user color preference profiles.
+#
+# Every paint suggestion the user accepts or rejects (views.consultation_feedback)
+# nudges a compact vector: weights over twelve CIELAB hue sectors plus a
+# neutral bucket, an exponentially weighted lightness mean / variance of
+# accepted colors, and finish weights. Old
+# feedback decays, so the profile follows changing taste. summary() turns the
+# profile into a few lines of prompt text, with catalog paints pre-filtered to
+# the preferred hues and lightness, which replaces re-sending earlier turns.
+#
+# Profiles live in a per-process LRU cache and are written back to
+# PreferenceProfile rows in batches (every WRITE_BACK seconds, on eviction and
+# at exit); clean entries are reloaded after CACHE_TTL so other worker
+# processes' updates are picked up.
+
+HUE_NAMES = ("pink", "red", "orange", "yellow", "lime", "green", "teal", "cyan", "sky blue", "blue", "violet",
+             "magenta")
+_SECTOR = 360.0 / len(HUE_NAMES)
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_PROFILES", {}) or {}
+    return {
+        "enabled": bool(conf.get("ENABLED", True)),
+        "decay": float(conf.get("DECAY", 0.85)),
+        "reject_weight": float(conf.get("REJECT_WEIGHT", 0.5)),
+        "neutral_chroma": float(conf.get("NEUTRAL_CHROMA", 10)),
+        "max_cached": max(int(conf.get("MAX_CACHED", 2048)), 1),
+        "cache_ttl": float(conf.get("CACHE_TTL", 300)),
+        "write_back": float(conf.get("WRITE_BACK", 10)),
+        "catalog_candidates": int(conf.get("CATALOG_CANDIDATES", 6)),
+    }
+
+
+def enabled() -> bool:
+    return _options()["enabled"]
+
+
+def _lch(lab) -> Tuple[float, float, float]:
+    L, a, b = (float(v) for v in lab)
+    return L, math.hypot(a, b), math.degrees(math.atan2(b, a)) % 360
+
+
+class Profile:
+    """One user's preference vector; mutate through :func:`record_feedback`."""
+
+    __slots__ = ("key", "hues", "neutral", "light_mean", "light_var", "light_weight", "finishes", "accepted",
+                 "rejected", "dirty", "loaded_at")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.hues = [0.0] * len(HUE_NAMES)
+        self.neutral = 0.0
+        self.light_mean = 0.0
+        self.light_var = 0.0
+        self.light_weight = 0.0
+        self.finishes: Dict[str, float] = {}
+        self.accepted = 0
+        self.rejected = 0
+        self.dirty = False
+        self.loaded_at = time.monotonic()
+
+    @property
+    def empty(self) -> bool:
+        return not (self.accepted or self.rejected)
+
+    def update(self, colors: List[Tuple[Any, str]], accepted: bool, opts: Dict[str, Any],
+               replaced: bool = False) -> None:
+        """
+        Fold one piece of feedback in: ``colors`` are ``(lab, finish)`` pairs.
+        ``replaced`` means it reverses an earlier verdict, which stops counting.
+        """
+        decay = opts["decay"]
+        self.hues = [w * decay for w in self.hues]
+        self.neutral *= decay
+        self.finishes = {name: w * decay for name, w in self.finishes.items() if abs(w * decay) >= 0.01}
+        self.light_weight *= decay
+        self.light_var *= decay
+        sign = 1.0 if accepted else -opts["reject_weight"]
+        share = 1.0 / max(len(colors), 1)
+        for lab, finish in colors:
+            L, chroma, hue = _lch(lab)
+            if chroma < opts["neutral_chroma"]:
+                self.neutral += sign * share
+            else:
+                # Split between the two nearest sector centres so nearby hues reinforce each other.
+                position = hue / _SECTOR - 0.5
+                lower = math.floor(position)
+                frac = position - lower
+                self.hues[lower % len(HUE_NAMES)] += sign * share * (1 - frac)
+                self.hues[(lower + 1) % len(HUE_NAMES)] += sign * share * frac
+            if finish:
+                name = finish.strip().lower()[:32]
+                self.finishes[name] = self.finishes.get(name, 0.0) + sign * share
+            if accepted:
+                # Exponentially weighted lightness mean and variance (West's incremental form).
+                self.light_weight += share
+                delta = L - self.light_mean
+                self.light_mean += delta * share / self.light_weight
+                self.light_var += share * delta * (L - self.light_mean)
+        if accepted:
+            self.accepted += 1
+            if replaced:
+                self.rejected = max(self.rejected - 1, 0)
+        else:
+            self.rejected += 1
+            if replaced:
+                self.accepted = max(self.accepted - 1, 0)
+        self.dirty = True
+
+    def lightness_range(self) -> Optional[Tuple[float, float]]:
+        if self.light_weight <= 0:
+            return None
+        spread = max(math.sqrt(max(self.light_var / self.light_weight, 0.0)), 8.0)
+        return max(self.light_mean - spread, 0.0), min(self.light_mean + spread, 100.0)
+
+    def liked_hues(self) -> List[int]:
+        return [i for i in sorted(range(len(self.hues)), key=lambda i: -self.hues[i]) if self.hues[i] > 0.15][:3]
+
+    def disliked_hues(self) -> List[int]:
+        return [i for i in sorted(range(len(self.hues)), key=lambda i: self.hues[i]) if self.hues[i] < -0.15][:3]
+
+    def to_vector(self) -> Dict[str, Any]:
+        return {
+            "hues": [round(w, 4) for w in self.hues],
+            "neutral": round(self.neutral, 4),
+            "lightness": [round(self.light_mean, 2), round(self.light_var, 2), round(self.light_weight, 4)],
+            "finishes": {name: round(w, 4) for name, w in self.finishes.items()},
+        }
+
+    @classmethod
+    def from_row(cls, row) -> "Profile":
+        profile = cls(row.key)
+        vector = row.vector or {}
+        hues = vector.get("hues") or []
+        if len(hues) == len(HUE_NAMES):
+            profile.hues = [float(w) for w in hues]
+        profile.neutral = float(vector.get("neutral", 0.0))
+        lightness = vector.get("lightness") or [0.0, 0.0, 0.0]
+        profile.light_mean, profile.light_var, profile.light_weight = (float(v) for v in lightness[:3])
+        profile.finishes = {str(k): float(v) for k, v in (vector.get("finishes") or {}).items()}
+        profile.accepted = row.accepted
+        profile.rejected = row.rejected
+        return profile
+
+
+_cache: "collections.OrderedDict[str, Profile]" = collections.OrderedDict()
+_lock = threading.RLock()
+_last_flush = time.monotonic()
+
+
+def _load(key: str) -> Profile:
+    from .models import PreferenceProfile
+
+    row = PreferenceProfile.objects.filter(key=key).first()
+    return Profile.from_row(row) if row is not None else Profile(key)
+
+
+def get_profile(key: str) -> Profile:
+    """The cached profile for ``key``, loading it from the database on a miss or once it is stale."""
+    opts = _options()
+    with _lock:
+        profile = _cache.get(key)
+        if profile is not None and (profile.dirty or time.monotonic() - profile.loaded_at < opts["cache_ttl"]):
+            _cache.move_to_end(key)
+            return profile
+    profile = _load(key)
+    evicted = []
+    with _lock:
+        current = _cache.get(key)
+        if current is not None and current.dirty:
+            # Updated in this process while we were reading; the cached copy is newer.
+            profile = current
+        _cache[key] = profile
+        _cache.move_to_end(key)
+        while len(_cache) > opts["max_cached"]:
+            _, old = _cache.popitem(last=False)
+            if old.dirty:
+                evicted.append(old)
+    if evicted:
+        try:
+            _write(evicted)
+        except Exception:
+            logger.exception("Preference profile write-back failed")
+    return profile
+
+
+def _write(profiles: List[Profile]) -> None:
+    from .models import PreferenceProfile
+
+    rows = [PreferenceProfile(key=p.key, vector=p.to_vector(), accepted=p.accepted, rejected=p.rejected)
+            for p in profiles]
+    PreferenceProfile.objects.bulk_create(rows, update_conflicts=True, unique_fields=["key"],
+                                          update_fields=["vector", "accepted", "rejected", "updated_at"])
+
+
+def flush() -> int:
+    """Write every dirty cached profile back in one batch; returns how many were written."""
+    global _last_flush
+    with _lock:
+        dirty = [p for p in _cache.values() if p.dirty]
+        for profile in dirty:
+            profile.dirty = False
+        _last_flush = time.monotonic()
+    if not dirty:
+        return 0
+    try:
+        _write(dirty)
+    except Exception:
+        with _lock:
+            for profile in dirty:
+                profile.dirty = True
+        raise
+    return len(dirty)
+
+
+def _maybe_flush() -> None:
+    if time.monotonic() - _last_flush < _options()["write_back"]:
+        return
+    try:
+        flush()
+    except Exception:
+        logger.exception("Preference profile write-back failed")
+
+
+def _flush_at_exit() -> None:
+    try:
+        flush()
+    except Exception:
+        logger.exception("Preference profile write-back failed")
+
+
+atexit.register(_flush_at_exit)
+
+
+def feedback_colors(hexes: List[str], consultation_id: Optional[str] = None) -> List[Tuple[Any, str, str]]:
+    """
+    ``(lab, finish, hex)`` triples to learn from: the stored recommendations of
+    the consultation when its public id is given (they carry finishes), else ``hexes``.
+    """
+    from .catalog import hex_to_lab
+    from .history import normalize_hexes
+
+    if consultation_id:
+        from .models import ColorRecommendation
+
+        rows = list(ColorRecommendation.objects.filter(consultation__public_id=consultation_id)
+                    .values_list("lab_l", "lab_a", "lab_b", "finish", "hex"))
+        if rows:
+            return [((L, a, b), finish, hex) for L, a, b, finish, hex in rows]
+    hexes = normalize_hexes(hexes)
+    return [(lab, "", hex) for lab, hex in zip(hex_to_lab(hexes), hexes)] if hexes else []
+
+
+def _claim(key: str, consultation_id: str, colors: List[Tuple[Any, str, str]], accepted: bool):
+    """
+    Record ``key``'s verdict on each color of the consultation; returns the
+    colors it is new for and whether any of them reverses an earlier verdict.
+    A color already recorded with the same verdict is dropped, so repeating the
+    same feedback (a double click, a retried request) is learned once.
+    """
+    from django.db import IntegrityError, transaction
+    from .models import Consultation, PreferenceFeedback
+
+    consultation = Consultation.objects.only("id").get(public_id=consultation_id)
+    fresh, replaced = [], False
+    for color in dict((hex, (lab, finish, hex)) for lab, finish, hex in colors).values():
+        rows = PreferenceFeedback.objects.filter(profile_key=key, consultation=consultation, hex=color[2])
+        # The update and the unique insert are the claims, so concurrent duplicates learn once.
+        if rows.exclude(accepted=accepted).update(accepted=accepted):
+            fresh.append(color)
+            replaced = True
+            continue
+        try:
+            with transaction.atomic():
+                PreferenceFeedback.objects.create(profile_key=key, consultation=consultation, hex=color[2],
+                                                  accepted=accepted)
+        except IntegrityError:
+            continue
+        fresh.append(color)
+    return fresh, replaced
+
+
+def record_feedback(key: str, accepted: bool, hexes: List[str] = (), consultation_id: Optional[str] = None) -> bool:
+    """
+    Fold an accept / reject of the given colors into ``key``'s profile; False
+    when there was nothing (new) to learn. Feedback on a consultation is kept
+    per color, so it counts once and a changed verdict replaces the old one.
+    """
+    opts = _options()
+    if not opts["enabled"] or not key:
+        return False
+    colors = feedback_colors(list(hexes), consultation_id)
+    replaced = False
+    if colors and consultation_id:
+        colors, replaced = _claim(key, consultation_id, colors, accepted)
+    if not colors:
+        return False
+    profile = get_profile(key)
+    with _lock:
+        profile.update([(lab, finish) for lab, finish, _ in colors], accepted, opts, replaced=replaced)
+    _maybe_flush()
+    return True
+
+
+def catalog_candidates(profile: Profile, limit: int = None) -> List[Dict[str, Any]]:
+    """
+    Catalog paints inside the profile's lightness range and liked hue sectors
+    (or neutrals, when those are preferred), strongest preference first.
+    """
+    import numpy as np
+    from .catalog import get_catalog
+
+    limit = _options()["catalog_candidates"] if limit is None else limit
+    catalog = get_catalog()
+    liked = profile.liked_hues()
+    if catalog is None or not len(catalog) or limit <= 0 or not (liked or profile.neutral > 0.15):
+        return []
+    lab = catalog.lab
+    chroma = np.hypot(lab[:, 1], lab[:, 2])
+    sector = ((np.degrees(np.arctan2(lab[:, 2], lab[:, 1])) % 360) // _SECTOR).astype(int) % len(HUE_NAMES)
+    weights = np.asarray(profile.hues, dtype=np.float32)
+    neutral = chroma < _options()["neutral_chroma"]
+    score = np.where(neutral, profile.neutral, weights[sector])
+    mask = score > 0.15
+    bounds = profile.lightness_range()
+    if bounds is not None:
+        mask &= (lab[:, 0] >= bounds[0]) & (lab[:, 0] <= bounds[1])
+    index = np.flatnonzero(mask)
+    if not len(index):
+        return []
+    # Strongest sectors first; within a sector, closest to the preferred lightness.
+    closeness = -np.abs(lab[index, 0] - profile.light_mean) / 100.0 if bounds is not None else 0.0
+    order = index[np.argsort(-(score[index] + closeness * 0.1), kind="stable")]
+    picked, seen = [], set()
+    for i in order:
+        # One paint per sector and lightness band keeps the shortlist varied.
+        band = (int(sector[i]) if not neutral[i] else -1, int(lab[i, 0] // 10))
+        if band in seen:
+            continue
+        seen.add(band)
+        picked.append({"brand": catalog.brands[i], "name": catalog.names[i], "hex": catalog.hexes[i]})
+        if len(picked) >= limit:
+            break
+    return picked
+
+
+def summary(key: str) -> str:
+    """A few lines describing ``key``'s preferences for the prompt; empty without any feedback yet."""
+    if not enabled() or not key:
+        return ""
+    profile = get_profile(key)
+    if profile.empty:
+        return ""
+    with _lock:
+        liked = [HUE_NAMES[i] for i in profile.liked_hues()]
+        disliked = [HUE_NAMES[i] for i in profile.disliked_hues()]
+        bounds = profile.lightness_range()
+        finishes = [name for name, w in sorted(profile.finishes.items(), key=lambda kv: -kv[1]) if w > 0.15][:2]
+        neutral = profile.neutral
+    lines = [f"From {profile.accepted} accepted and {profile.rejected} rejected palettes:"]
+    if liked:
+        lines.append("- favours " + ", ".join(liked) + (" and neutrals" if neutral > 0.15 else ""))
+    elif neutral > 0.15:
+        lines.append("- favours neutrals")
+    if disliked or neutral < -0.15:
+        lines.append("- avoid " + ", ".join(disliked + (["neutrals"] if neutral < -0.15 else [])))
+    if bounds is not None:
+        lines.append(f"- lightness (CIELAB L*) around {bounds[0]:.0f}-{bounds[1]:.0f}")
+    if finishes:
+        lines.append("- finishes: " + ", ".join(finishes))
+    candidates = catalog_candidates(profile)
+    if candidates:
+        lines.append("- catalog paints that fit: " + "; ".join(
+            f"{c['brand'] + ' ' if c['brand'] else ''}{c['name']} {c['hex']}" for c in candidates))
+    return "\n".join(lines) if len(lines) > 1 else ""
+
+
+def reflection_on_userprefs(userprefs: Dict[str, Any]) -> str:
+    """Preference summary for ``userprefs['user_profile']`` (a profile key)."""
+    return summary(userprefs.get("user_profile", ""))
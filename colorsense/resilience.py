@@ -0,0 +1,304 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from .conf import setting
+
+
+# Client-side scheduling for provider calls.
+#
+# Every request goes through a token bucket per (provider, model) and a circuit
+# breaker per provider. Throttling (429) halves the bucket's rate and successes
+# slowly restore it (AIMD), so we settle just under the provider's real limit.
+# Retryable failures back off exponentially with full jitter, or for as long as
+# Retry-After asks. The SDKs' own retries are disabled so this is the only
+# retry loop. Failover to the other provider lives in AIClient.
+
+THROTTLED = "throttled"
+UNAVAILABLE = "unavailable"
+FATAL = "fatal"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the provider while its circuit breaker is open."""
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_RESILIENCE", {}) or {}
+    return {
+        "max_attempts": max(int(conf.get("MAX_ATTEMPTS", 4)), 1),
+        "backoff_base": float(conf.get("BACKOFF_BASE", 0.5)),
+        "backoff_max": float(conf.get("BACKOFF_MAX", 20)),
+        "breaker_failures": int(conf.get("BREAKER_FAILURES", 5)),
+        "breaker_reset": float(conf.get("BREAKER_RESET", 30)),
+        "failover": bool(conf.get("FAILOVER", True)),
+        "rate_limits": conf.get("RATE_LIMITS", {}) or {},
+    }
+
+
+class TokenBucket:
+    """Thread-safe token bucket with AIMD rate adaptation; callers reserve a slot and sleep."""
+
+    def __init__(self, rate: float, burst: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, going into debt if needed; returns how long to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.rate = max(self.rate / 2, self.max_rate / 10)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets one probe through per reset interval."""
+
+    def __init__(self, failures: int, reset: float):
+        self.threshold = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release(self) -> None:
+        """Give up a probe slot without a verdict (the call was cancelled)."""
+        with self._lock:
+            self._probing = False
+
+    def failed(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        value = headers.get("retry-after-ms")
+        if value:
+            return float(value) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(when.timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+
+
+def classify(exc: BaseException) -> Tuple[str, Optional[float]]:
+    """
+    ``(kind, retry_after)`` for a provider error: THROTTLED (429), UNAVAILABLE
+    (5xx, 408, timeouts, connection errors) or FATAL (anything else, e.g. a bad
+    request, which retrying or failing over cannot fix).
+    """
+    if isinstance(exc, CircuitOpenError):
+        return UNAVAILABLE, None
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status == 429:
+        return THROTTLED, _retry_after(exc)
+    if status is not None and (status >= 500 or status == 408):
+        return UNAVAILABLE, _retry_after(exc)
+    name = type(exc).__name__
+    if status is None and ("Timeout" in name or "Connect" in name or isinstance(exc, (TimeoutError, ConnectionError))):
+        return UNAVAILABLE, None
+    return FATAL, None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None, base: float = 0.5, cap: float = 20) -> float:
+    """Full-jitter exponential backoff; a Retry-After hint wins when it is longer."""
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+class Scheduler:
+    """Buckets, breakers and counters shared by every AIClient in the process."""
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.failovers = 0
+
+    def bucket(self, provider: str, model: str) -> Optional[TokenBucket]:
+        key = (provider, model)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            limits = _options()["rate_limits"]
+            conf = limits.get(f"{provider}:{model}") or limits.get(provider)
+            if not conf:
+                return None
+            with self._lock:
+                bucket = self._buckets.setdefault(
+                    key, TokenBucket(float(conf.get("RPS", 5)), float(conf.get("BURST", conf.get("RPS", 5)))))
+        return bucket
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            opts = _options()
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    provider, CircuitBreaker(opts["breaker_failures"], opts["breaker_reset"]))
+        return breaker
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def failed_over(self) -> None:
+        """Count a call handed to the other provider (AIClient does the failover)."""
+        self._count("failovers")
+
+    def _before(self, provider: str, model: str) -> float:
+        if not self.breaker(provider).allow():
+            self._count("rejected")
+            raise CircuitOpenError(f"{provider} is unavailable (circuit open); try again shortly.")
+        bucket = self.bucket(provider, model)
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def _after_error(self, provider: str, model: str, exc: BaseException, attempt: int) -> Optional[float]:
+        """Record a failure; returns the delay before retrying, or None to give up."""
+        kind, retry_after = classify(exc)
+        if kind != UNAVAILABLE:
+            # The provider answered, so it is up as far as the breaker is concerned.
+            self.breaker(provider).succeeded()
+        if kind == FATAL:
+            return None
+        opts = _options()
+        if kind == THROTTLED:
+            self._count("throttled")
+            bucket = self.bucket(provider, model)
+            if bucket is not None:
+                bucket.throttled()
+        else:
+            self.breaker(provider).failed()
+        if attempt + 1 >= opts["max_attempts"] or isinstance(exc, CircuitOpenError):
+            return None
+        self._count("retries")
+        return backoff_delay(attempt, retry_after, opts["backoff_base"], opts["backoff_max"])
+
+    def _after_success(self, provider: str, model: str) -> None:
+        self.breaker(provider).succeeded()
+        bucket = self.bucket(provider, model)
+        if bucket is not None:
+            bucket.succeeded()
+
+    def call(self, provider: str, model: str, fn: Callable[[], Any]) -> Any:
+        attempt = 0
+        while True:
+            wait = self._before(provider, model)
+            if wait:
+                time.sleep(wait)
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._after_error(provider, model, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Interrupted without a verdict; free the half-open probe slot.
+                self.breaker(provider).release()
+                raise
+            self._after_success(provider, model)
+            return result
+
+    async def acall(self, provider: str, model: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            wait = self._before(provider, model)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                result = await factory()
+            except Exception as e:
+                delay = self._after_error(provider, model, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Cancelled (or interrupted) without a verdict; free the half-open probe slot.
+                self.breaker(provider).release()
+                raise
+            self._after_success(provider, model)
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+            "failovers": self.failovers,
+            "breakers": {name: b.state for name, b in list(self._breakers.items())},
+            "rates": {f"{p}:{m}": round(b.rate, 3) for (p, m), b in list(self._buckets.items())},
+        }
+
+
+_scheduler = Scheduler()
+
+
+def get_scheduler() -> Scheduler:
+    return _scheduler
+
+
+def failover_enabled() -> bool:
+    return _options()["failover"]
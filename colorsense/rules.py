@@ -1,4 +1,14 @@
+from .catalog import get_catalog
 
 
 class knowledge():
-    
\ No newline at end of file
+    """Paint knowledge the agent can consult; currently the manufacturer catalog."""
+
+    def __init__(self, catalog=None):
+        self.catalog = catalog if catalog is not None else get_catalog()
+
+    def nearest_paints(self, hexes, k=3):
+        """Closest purchasable paints for each hex code, best first (empty without a catalog)."""
+        if self.catalog is None:
+            return [[] for _ in hexes]
+        return self.catalog.nearest(hexes, k=k)
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+# Request coalescing for identical in-flight provider calls.
+#
+# The first caller for a key (the leader) does the work; callers that arrive
+# while it is running wait for and share its result instead of sending their own
+# request. Keys are the response cache keys, so "identical" means the same
+# provider, model, prompt and image digests. Calls are tracked with
+# concurrent.futures.Future, so threads (sync views, fan-out workers) and
+# asyncio tasks on any event loop coalesce with each other.
+
+
+class _Call:
+    __slots__ = ("future", "waiters", "task", "loop")
+
+    def __init__(self):
+        self.future: Future = Future()
+        self.waiters = 1
+        self.task: Optional[asyncio.Task] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key: str) -> Tuple[_Call, bool]:
+        """Register interest in ``key``; returns ``(call, is_leader)``."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and not call.future.done():
+                call.waiters += 1
+                self.coalesced += 1
+                return call, False
+            call = self._calls[key] = _Call()
+            self.leaders += 1
+            return call, True
+
+    def leave(self, call: _Call) -> int:
+        with self._lock:
+            call.waiters -= 1
+            return call.waiters
+
+    def resolve(self, key: str, call: _Call, result: Any = None, error: BaseException = None) -> None:
+        """Publish the leader's outcome to every waiter and forget the key."""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        if call.future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            call.future.cancel()
+        elif error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Run ``fn`` once for all concurrent callers with the same ``key`` (threads)."""
+        call, leader = self.join(key)
+        try:
+            if leader:
+                try:
+                    result = fn()
+                except BaseException as e:
+                    self.resolve(key, call, error=e)
+                    raise
+                self.resolve(key, call, result)
+                return result
+            return call.future.result()
+        finally:
+            self.leave(call)
+
+    async def ado(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Async :meth:`do`. The leader's work runs as its own task, so one waiter
+        disconnecting does not cancel it for the others; it is only cancelled
+        when every waiter has gone.
+        """
+        call, leader = self.join(key)
+        if leader:
+            call.loop = asyncio.get_running_loop()
+            call.task = asyncio.ensure_future(factory())
+
+            def finished(task: asyncio.Task) -> None:
+                if task.cancelled():
+                    self.resolve(key, call, error=asyncio.CancelledError())
+                elif task.exception() is not None:
+                    self.resolve(key, call, error=task.exception())
+                else:
+                    self.resolve(key, call, task.result())
+
+            call.task.add_done_callback(finished)
+        cancelled = False
+        try:
+            return await self._wait(call)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            remaining = self.leave(call)
+            if cancelled and remaining == 0 and call.task is not None and not call.task.done():
+                call.loop.call_soon_threadsafe(call.task.cancel)
+
+    @staticmethod
+    async def _wait(call: _Call) -> Any:
+        inner = asyncio.wrap_future(call.future)
+        # Retrieve the outcome even if every waiter has gone by the time it lands.
+        inner.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return await asyncio.shield(inner)
+
+    async def await_call(self, call: _Call) -> Any:
+        """Wait for a call joined as a follower via :meth:`join`."""
+        try:
+            return await self._wait(call)
+        finally:
+            self.leave(call)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": in_flight}
+
+
+_flight = SingleFlight()
+
+
+def get_singleflight() -> SingleFlight:
+    return _flight
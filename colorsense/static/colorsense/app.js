@@ -215,14 +215,191 @@
 }
 
 
+  function renderPaintData(container, reply) {
+    // Parse the JSON response
+    let paintData;
+    try {
+        paintData = typeof reply === 'string' ? JSON.parse(reply) : reply;
+    } catch (e) {
+        console.error('Failed to parse paint data:', e);
+        return;
+    }
+
+    // Display paint recommendations
+    if (paintData && paintData.recommendations) {
+        paintData.recommendations.forEach(recommendation => {
+            container.appendChild(createPaintRecommendation(recommendation));
+        });
+    }
+
+    // Display preparation tips
+    if (paintData && paintData.preparationtips) {
+        const tipsDiv = document.createElement("div");
+        tipsDiv.className = "preparation-tips";
+        tipsDiv.style.cssText = 'margin: 15px 0; padding: 15px; border: 1px solid #ddd; border-radius: 8px; background: #f0f8ff;';
+
+        const tipsTitle = document.createElement("h3");
+        tipsTitle.textContent = "Preparation Tips";
+        tipsTitle.style.cssText = 'margin: 0 0 10px 0; color: #333; font-size: 16px;';
+        tipsDiv.appendChild(tipsTitle);
+
+        const tipsText = document.createElement("p");
+        tipsText.textContent = paintData.preparationtips;
+        tipsText.style.cssText = 'margin: 0; color: #555; line-height: 1.4;';
+        tipsDiv.appendChild(tipsText);
+
+        container.appendChild(tipsDiv);
+    }
+  }
+
+  // Minimal Server-Sent Events reader for POST responses (EventSource is GET-only).
+  async function readEvents(resp, onEvent) {
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let sep;
+      while ((sep = buffer.indexOf('\n\n')) !== -1) {
+        const frame = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        let event = 'message';
+        let data = '';
+        frame.split('\n').forEach(line => {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        });
+        if (data) onEvent(event, JSON.parse(data));
+      }
+    }
+  }
+
+  async function streamConfirmation(form) {
+    const csrftoken = getCookie('csrftoken');
+    const paint_suggestion = appendBubble('paint_suggestion', '');
+    // Swatches show up here as each color arrives, before the full reply is parsed.
+    const live = document.createElement('div');
+    live.className = 'swatches';
+    paint_suggestion.appendChild(live);
+
+    try {
+        const resp = await fetch('/api/agent/confirm/stream/', {
+            method: 'POST',
+            headers: { 'X-CSRFToken': csrftoken },
+            body: form,
+        });
+        if (!resp.ok || !resp.body) {
+            paint_suggestion.textContent = `Error: ${resp.statusText}`;
+            return;
+        }
+        await readEvents(resp, (event, data) => {
+            if (event === 'color' && data.color && data.color.hex) {
+                live.appendChild(hexSwatch(data.color.hex));
+            } else if (event === 'error') {
+                console.error('Suggestion error:', data);
+                if (data.image === undefined) paint_suggestion.textContent = `Error: ${data.error}`;
+            } else if (event === 'done') {
+                live.remove();
+                renderPaintData(paint_suggestion, data.reply);
+                if (data.consultation) appendFeedback(paint_suggestion, data.consultation);
+                showPreviews(paint_suggestion, form.getAll('image_ids'), data.reply);
+            }
+        });
+    } catch (err) {
+        alert(`Network error: ${err}`);
+    }
+  }
+
+  // Accept / reject buttons under a paint suggestion; the answer trains the
+  // requester's preference profile on the suggested colors.
+  function appendFeedback(container, consultation) {
+    const row = document.createElement('div');
+    row.className = 'suggestion-feedback';
+    row.style.cssText = 'margin: 10px 0;';
+    [['I like these colors', true], ['Not for me', false]].forEach(([label, accepted]) => {
+        const btn = document.createElement('button');
+        btn.type = 'button';
+        btn.textContent = label;
+        btn.style.cssText = 'margin-right: 8px;';
+        btn.addEventListener('click', async () => {
+            const form = new FormData();
+            form.append('accepted', accepted);
+            row.querySelectorAll('button').forEach(b => { b.disabled = true; });
+            try {
+                const resp = await fetch(`/api/consultations/${encodeURIComponent(consultation)}/feedback/`, {
+                    method: 'POST',
+                    headers: { 'X-CSRFToken': getCookie('csrftoken') },
+                    body: form,
+                });
+                const data = await resp.json();
+                row.textContent = data.ok ? 'Thanks, noted for your next suggestions.' : `Error: ${data.error}`;
+            } catch (err) {
+                row.querySelectorAll('button').forEach(b => { b.disabled = false; });
+                console.error('Feedback failed:', err);
+            }
+        });
+        row.appendChild(btn);
+    });
+    container.appendChild(row);
+  }
+
+  // Each recommendation belongs to the image at the same index; show that photo
+  // repainted in each of its suggested colors.
+  async function showPreviews(container, imageIds, reply) {
+    let paintData;
+    try {
+        paintData = typeof reply === 'string' ? JSON.parse(reply) : reply;
+    } catch (e) {
+        return;
+    }
+    const recommendations = (paintData && paintData.recommendations) || [];
+    for (const [index, rec] of recommendations.entries()) {
+        const hexes = (rec.colors || []).map(c => c.hex).filter(Boolean);
+        if (!imageIds[index] || hexes.length === 0) continue;
+        const form = new FormData();
+        form.append('image_id', imageIds[index]);
+        hexes.forEach(hex => form.append('hex', hex));
+        try {
+            const resp = await fetch('/api/preview/', {
+                method: 'POST',
+                headers: { 'X-CSRFToken': getCookie('csrftoken') },
+                body: form,
+            });
+            const data = await resp.json();
+            if (!data.ok) continue;
+            const row = document.createElement('div');
+            row.className = 'wall-previews';
+            data.previews.forEach(p => {
+                const img = document.createElement('img');
+                img.src = p.image;
+                img.title = p.hex;
+                img.style.cssText = 'max-width: 240px; border-radius: 5px; margin: 5px; border-bottom: 6px solid ' + p.hex + ';';
+                row.appendChild(img);
+            });
+            container.appendChild(row);
+        } catch (err) {
+            console.error('Preview failed:', err);
+        }
+    }
+  }
+
   async function sendConfirmation(confirmed, description) {
     const form = new FormData();
     form.append('confirm', confirmed);
     form.append('room_description', description.reply);
-    form.append('images', description.images);
+    // The server kept the uploaded images; send their ids, not the files.
+    for (const id of description.image_ids || []) form.append('image_ids', id);
+    // Suggestions held for review land in the staff review queue.
+    form.append('review', hitlToggle.checked);
     //form.append('style_preference', description.style_preference);
     //form.append('images', description.images);
     //form.append('docs', description.docs);
+    if (confirmed) {
+        await streamConfirmation(form);
+        return;
+    }
     const csrftoken = getCookie('csrftoken');
 
     try {
@@ -237,41 +414,8 @@
             alert('Confirmation sent successfully.');
             const paint_suggestion = appendBubble('paint_suggestion', '');
             console.log(data.reply);
-            console.log(data.reply.reply.recommendations);
-            // Parse the JSON response
-            let paintData;
-            try {
-                paintData = typeof data.reply.reply === 'string' ? JSON.parse(data.reply.reply) : data.reply.reply;
-            } catch (e) {
-                console.error('Failed to parse paint data:', e);
-                return;
-            }
-            
-            // Display paint recommendations
-            if (paintData && paintData.recommendations) {
-                paintData.recommendations.forEach(recommendation => {
-                    paint_suggestion.appendChild(createPaintRecommendation(recommendation));
-                });
-            }
-            
-            // Display preparation tips
-            if (paintData && paintData.preparationtips) {
-                const tipsDiv = document.createElement("div");
-                tipsDiv.className = "preparation-tips";
-                tipsDiv.style.cssText = 'margin: 15px 0; padding: 15px; border: 1px solid #ddd; border-radius: 8px; background: #f0f8ff;';
-                
-                const tipsTitle = document.createElement("h3");
-                tipsTitle.textContent = "Preparation Tips";
-                tipsTitle.style.cssText = 'margin: 0 0 10px 0; color: #333; font-size: 16px;';
-                tipsDiv.appendChild(tipsTitle);
-            
-                const tipsText = document.createElement("p");
-                tipsText.textContent = paintData.preparationtips;
-                tipsText.style.cssText = 'margin: 0; color: #555; line-height: 1.4;';
-                tipsDiv.appendChild(tipsText);
-            
-                paint_suggestion.appendChild(tipsDiv);
-            }
+            renderPaintData(paint_suggestion, data.reply.reply);
+            if (data.consultation) appendFeedback(paint_suggestion, data.consultation);
          
             //paint_suggestion.textContent = data.reply;
             //renderSwatches(data.swatches || []);
@@ -0,0 +1,66 @@
+import json
+from typing import Any, Dict, List
+
+
+class ColorScanner:
+    """
+    Incremental scanner over a streamed JSON completion.
+
+    Feed it text deltas as they arrive; every time a JSON object that carries a
+    ``hex`` key closes, it is parsed and returned. Each character is looked at
+    once, so the cost over a whole reply is linear in its length.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._in_string = False
+        self._escape = False
+        # Open objects as [start offset, has nested object].
+        self._stack: List[list] = []
+
+    def feed(self, delta: str) -> List[Dict[str, Any]]:
+        self.text += delta
+        found: List[Dict[str, Any]] = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                if self._stack:
+                    self._stack[-1][1] = True
+                self._stack.append([i, False])
+            elif ch == "}" and self._stack:
+                start, nested = self._stack.pop()
+                # Only leaf color objects are interesting; never re-parse containers.
+                if not nested:
+                    obj = self._parse(text[start:i + 1])
+                    if obj is not None:
+                        found.append(obj)
+        self._pos = len(text)
+        return found
+
+    @staticmethod
+    def _parse(fragment: str):
+        if '"hex"' not in fragment:
+            return None
+        try:
+            obj = json.loads(fragment)
+        except ValueError:
+            return None
+        if isinstance(obj, dict) and isinstance(obj.get("hex"), str):
+            return obj
+        return None
+
+
+def sse_event(event: str, data: Any) -> str:
+    """Format one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
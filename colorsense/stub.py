@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from .conf import setting
+
+
+# Offline stand-in for the provider SDKs, selected with get_client("stub").
+#
+# Mirrors the slice of the OpenAI/Groq client surface AIClient uses
+# (chat.completions.create, with and without stream=True) and answers with
+# canned JSON in the shape the real prompts ask for. Latency is drawn from a
+# generator seeded by the request, so the same request always takes the same
+# time and benchmark runs are repeatable. Only available when
+# COLORSENSE_STUB['ENABLED'] is set (the benchmark command enables it).
+
+SAMPLE_SUMMARY = {"reply": [
+    {"image": "image1", "room_description": "The room is a modern bedroom with a sleek design. It features a teal bed and matching chair, with striped wallpaper and green accents. The room has a polished floor, minimalistic furniture, and decorative elements like a basketball and framed pictures."},
+    {"image": "image2", "room_description": "This is a cozy living room with light yellow walls and a traditional style. The furniture is upholstered in beige and covered with patterned white and gray covers. The room has a few decorative pictures, curtains with a black and white pattern, and a small plant on the coffee table."},
+    {"image": "image3", "room_description": "The kitchen is designed in a contemporary style with a combination of white and rich red cabinetry. It features a light countertop with a speckled pattern, and the walls have a neutral tone. The kitchen is organized with hanging utensils, potted plants, and open shelving for storage."},
+]}
+
+SAMPLE_SUGGESTION = {
+    "recommendations": [
+        {"image": 1, "colors": [
+            {"color": "Soft White", "hex": "#F0F4F8", "finish": "eggshell", "rationale": "Soft White will brighten the room and provide a clean contrast to the bold turquoise elements, making them pop."},
+            {"color": "Coral Pink", "hex": "#FF6F61", "finish": "matte", "rationale": "Coral Pink adds warmth and a playful touch that complements the turquoise without overwhelming the space."},
+            {"color": "Charcoal Gray", "hex": "#333333", "finish": "semi-gloss", "rationale": "Charcoal Gray can add depth and sophistication, creating a modern edge against the vibrant colors."},
+        ]},
+        {"image": 2, "colors": [
+            {"color": "Creamy Beige", "hex": "#E6D9C9", "finish": "eggshell", "rationale": "Creamy Beige will enhance the warm tones already present and create a seamless flow with the furniture."},
+            {"color": "Warm Taupe", "hex": "#C2B280", "finish": "matte", "rationale": "Warm Taupe adds a subtle contrast to the yellow walls while maintaining a cozy and inviting atmosphere."},
+            {"color": "Soft Sage Green", "hex": "#B7C9A3", "finish": "matte", "rationale": "Soft Sage Green introduces a refreshing element that complements the warm tones and adds a natural touch."},
+        ]},
+        {"image": 3, "colors": [
+            {"color": "Pale Gray", "hex": "#D3D3D3", "finish": "eggshell", "rationale": "Pale Gray will provide a neutral backdrop that balances the bold red cabinetry and light countertops."},
+            {"color": "Dusty Rose", "hex": "#D6A8B4", "finish": "matte", "rationale": "Dusty Rose adds a soft, warm accent that harmonizes with the richness of the cabinetry without clashing."},
+            {"color": "Muted Olive", "hex": "#A8B95B", "finish": "matte", "rationale": "Muted Olive introduces a natural element that pairs well with the red cabinetry and adds depth to the space."},
+        ]},
+    ],
+    "preparationtips": "Ensure surfaces are clean and free of dust. Use painters tape to protect edges and achieve clean lines. Test colors on small sections of the wall before fully committing.",
+}
+
+
+class StubError(RuntimeError):
+    """Injected provider failure; carries a status code so resilience.classify() treats it like an HTTP 503."""
+
+    status_code = 503
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_STUB", {}) or {}
+    return {
+        "enabled": bool(conf.get("ENABLED", False)),
+        "latency": float(conf.get("LATENCY", 0.8)),
+        "jitter": float(conf.get("JITTER", 0.2)),
+        "chunk_chars": max(int(conf.get("CHUNK_CHARS", 24)), 1),
+        "chunk_delay": float(conf.get("CHUNK_DELAY", 0.01)),
+        "error_rate": float(conf.get("ERROR_RATE", 0.0)),
+        "seed": int(conf.get("SEED", 0)),
+    }
+
+
+def enabled() -> bool:
+    return _options()["enabled"]
+
+
+def canned_reply(messages: List[Dict[str, Any]]) -> str:
+    """The summary sample for summary prompts, the suggestion sample otherwise."""
+    system = messages[0]["content"] if messages and messages[0].get("role") == "system" else ""
+    sample = SAMPLE_SUMMARY if "room_description" in system else SAMPLE_SUGGESTION
+    return json.dumps(sample)
+
+
+class _Plan:
+    """Timing and outcome of one stub request, derived from the request itself."""
+
+    def __init__(self, kwargs: Dict[str, Any]):
+        opts = _options()
+        digest = hashlib.sha256(
+            json.dumps([kwargs.get("model"), kwargs.get("messages")], sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        rng = random.Random(f"{opts['seed']}:{digest}")
+        self.latency = max(opts["latency"] * (1 + rng.uniform(-opts["jitter"], opts["jitter"])), 0.0)
+        self.fail = rng.random() < opts["error_rate"]
+        self.chunk_chars = opts["chunk_chars"]
+        self.chunk_delay = opts["chunk_delay"]
+        self.model = kwargs.get("model", "stub")
+        self.content = canned_reply(kwargs.get("messages") or [])
+
+    def chunks(self) -> List[str]:
+        return [self.content[i:i + self.chunk_chars] for i in range(0, len(self.content), self.chunk_chars)]
+
+    def completion(self):
+        message = SimpleNamespace(role="assistant", content=self.content)
+        return SimpleNamespace(model=self.model, choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")])
+
+    @staticmethod
+    def chunk(piece: str):
+        return SimpleNamespace(choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=piece))])
+
+
+class _Completions:
+    def create(self, **kwargs):
+        plan = _Plan(kwargs)
+        time.sleep(plan.latency)
+        if plan.fail:
+            raise StubError("Stub provider failure (injected).")
+        if not kwargs.get("stream"):
+            return plan.completion()
+        return self._stream(plan)
+
+    @staticmethod
+    def _stream(plan: _Plan):
+        for piece in plan.chunks():
+            yield plan.chunk(piece)
+            time.sleep(plan.chunk_delay)
+
+
+class _AsyncCompletions:
+    async def create(self, **kwargs):
+        plan = _Plan(kwargs)
+        await asyncio.sleep(plan.latency)
+        if plan.fail:
+            raise StubError("Stub provider failure (injected).")
+        if not kwargs.get("stream"):
+            return plan.completion()
+        return self._stream(plan)
+
+    @staticmethod
+    async def _stream(plan: _Plan):
+        for piece in plan.chunks():
+            yield plan.chunk(piece)
+            await asyncio.sleep(plan.chunk_delay)
+
+
+class StubClient:
+    """Sync client: ``client.chat.completions.create(**kwargs)``."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=_Completions())
+
+
+class AsyncStubClient:
+    """Async client: ``await client.chat.completions.create(**kwargs)``."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=_AsyncCompletions())
@@ -1,3 +1,1431 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import cache, history, jobs, preview, reflection, resilience, uploads, workspace
+from .agent import AIClient, _afan_out, merge_replies
+from .singleflight import SingleFlight
+from .streaming import ColorScanner
+from .models import ColorRecommendation, Consultation, PreferenceFeedback, PreferenceProfile, UploadFile
+from .views import PROFILE_COOKIE
+
+try:
+    import open3d
+except (ImportError, OSError):  # the reconstruction stack is optional for chat-only installs
+    open3d = None
+
+
+class HistoryTests(TestCase):
+    """Consultation records: replay, keyset paging and review edits (history.py)."""
+
+    def record(self, text="blue room", swatches=("#AABBCC",), review=False, errors=(), kind=Consultation.SUGGESTION):
+        key = history.request_key(kind, "stub", text, [], "")
+        result = {"reply": "Try " + " ".join(swatches), "swatches": list(swatches), "errors": list(errors)}
+        return history.record(kind, "stub", text, [], "", result, key, review=review), key
+
+    def test_cursor_round_trip(self):
+        consultation, _ = self.record()
+        created_at, pk = history.decode_cursor(history.encode_cursor(consultation))
+        self.assertEqual((created_at, pk), (consultation.created_at, consultation.id))
+        with self.assertRaises(ValueError):
+            history.decode_cursor("not a cursor")
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        rows = [self.record(text=f"room {i}")[0] for i in range(5)]
+        # Two rows share a timestamp so the id breaks the tie.
+        now = timezone.now()
+        for i, row in enumerate(rows):
+            Consultation.objects.filter(pk=row.pk).update(created_at=now - timedelta(minutes=min(i, 3)))
+
+        seen, cursor = [], None
+        while True:
+            page, cursor = history.page(cursor=cursor, limit=2)
+            seen.extend(row.pk for row in page)
+            if cursor is None:
+                break
+        expected = list(Consultation.objects.order_by("-created_at", "-id").values_list("pk", flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(seen), len(rows))
+
+    def test_page_filters_by_status_and_color(self):
+        pending, _ = self.record(swatches=("#112233",), review=True)
+        self.record(swatches=("#445566",))
+        page, _ = history.page(status=Consultation.PENDING)
+        self.assertEqual([row.pk for row in page], [pending.pk])
+        page, _ = history.page(color="112233")
+        self.assertEqual([row.pk for row in page], [pending.pk])
+        with self.assertRaises(ValueError):
+            history.page(color="blue")
+
+    def test_page_edges(self):
+        self.assertEqual(history.page(), ([], None))
+        rows = [self.record(text=f"room {i}")[0] for i in range(2)]
+        page, cursor = history.page(limit=2)
+        # An exactly full page has no next cursor, and a cursor at the last row gives an empty page.
+        self.assertEqual((len(page), cursor), (2, None))
+        self.assertEqual(history.page(cursor=history.encode_cursor(page[-1])), ([], None))
+        page, cursor = history.page(limit=1)
+        self.assertIsNotNone(cursor)
+        self.assertEqual(history.page(cursor=cursor, limit=1), ([rows[0]], None))
+        self.assertEqual(history.page(status=Consultation.PENDING), ([], None))
+
+    @override_settings(COLORSENSE_HISTORY={"REPLAY": True})
+    def test_replay_returns_completed_answers_only(self):
+        consultation, key = self.record()
+        replayed = history.replay(key)
+        self.assertTrue(replayed["replayed"])
+        self.assertEqual(replayed["consultation"], consultation.public_id)
+        self.assertEqual(replayed["swatches"], ["#AABBCC"])
+
+        _, pending_key = self.record(text="pending", review=True)
+        self.assertIsNone(history.replay(pending_key))
+        _, failed_key = self.record(text="failed", errors=["image 1 failed"])
+        self.assertIsNone(history.replay(failed_key))
+        with override_settings(COLORSENSE_HISTORY={}):
+            self.assertIsNone(history.replay(key))
+
+    @override_settings(COLORSENSE_HISTORY={"REPLAY": True, "REPLAY_TTL": 60})
+    def test_replay_ignores_answers_older_than_the_ttl(self):
+        consultation, key = self.record()
+        Consultation.objects.filter(pk=consultation.pk).update(created_at=timezone.now() - timedelta(seconds=61))
+        self.assertIsNone(history.replay(key))
+        with override_settings(COLORSENSE_HISTORY={"REPLAY": True, "REPLAY_TTL": 0}):
+            self.assertEqual(history.replay(key)["consultation"], consultation.public_id)
+
+    def test_review_edits_rebuild_recommendations(self):
+        consultation, _ = self.record(swatches=("#AABBCC", "#DDEEFF"), review=True)
+        history.review(consultation, True, reply="Edited", swatches_text="#ddeeff, #010203", notes="ok")
+        consultation.refresh_from_db()
+        self.assertEqual(consultation.status, Consultation.APPROVED)
+        self.assertEqual(consultation.reply, "Edited")
+        self.assertEqual(consultation.swatches, ["#DDEEFF", "#010203"])
+        hexes = set(ColorRecommendation.objects.filter(consultation=consultation).values_list("hex", flat=True))
+        self.assertEqual(hexes, {"#DDEEFF", "#010203"})
+
+        rejected, _ = self.record(text="other", review=True)
+        history.review(rejected, False, reply="ignored", notes="no")
+        rejected.refresh_from_db()
+        self.assertEqual((rejected.status, rejected.review_notes), (Consultation.REJECTED, "no"))
+        self.assertNotEqual(rejected.reply, "ignored")
+
+    def test_review_queue_requires_staff_and_pages(self):
+        for i in range(3):
+            self.record(text=f"room {i}", review=True)
+        self.assertEqual(self.client.get("/review/queue/").status_code, 302)
+        self.client.force_login(User.objects.create_user("staff", password="x", is_staff=True))
+        with override_settings(COLORSENSE_HISTORY={"PAGE_SIZE": 2}):
+            first = self.client.get("/review/queue/")
+            self.assertEqual(len(first.context["pending"]), 2)
+            second = self.client.get("/review/queue/", {"cursor": first.context["next_cursor"]})
+        self.assertEqual(len(second.context["pending"]), 1)
+        self.assertIsNone(second.context["next_cursor"])
+        self.assertEqual(self.client.get("/review/queue/", {"cursor": "%%%"}).status_code, 400)
+
+
+@override_settings(COLORSENSE_STUB={"ENABLED": True, "LATENCY": 0, "JITTER": 0, "CHUNK_DELAY": 0})
+class ConsultationApiTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media, COLORSENSE_IMAGE_STORE={"ROOT": self.media + "/store"})
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_identical_request_gets_a_fresh_answer(self):
+        first = self.client.post("/api/agent/", {"message": "a north facing study", "provider": "stub"}).json()
+        second = self.client.post("/api/agent/", {"message": "a north facing study", "provider": "stub"}).json()
+        self.assertFalse(first["replayed"] or second["replayed"])
+        self.assertNotEqual(second["consultation"], first["consultation"])
+        self.assertEqual(Consultation.objects.count(), 2)
+
+        # Stored answers stay available by id.
+        replayed = self.client.get(f"/api/consultations/{first['consultation']}/").json()
+        self.assertEqual((replayed["consultation"], replayed["replayed"]), (first["consultation"], True))
+
+    def test_undecodable_image_is_a_bad_request(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        upload = SimpleUploadedFile("wall.jpg", b"\xff\xd8\xff not really a jpeg", content_type="image/jpeg")
+        response = self.client.post("/api/agent/", {"message": "a hallway", "provider": "stub", "images": upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"ok": False, "error": "wall.jpg is not a readable image."})
+
+    @override_settings(COLORSENSE_HISTORY={"REPLAY": True})
+    def test_identical_request_is_replayed(self):
+        first = self.client.post("/api/agent/", {"message": "a north facing study", "provider": "stub"}).json()
+        second = self.client.post("/api/agent/", {"message": "a north facing study", "provider": "stub"}).json()
+        self.assertFalse(first["replayed"])
+        self.assertTrue(second["replayed"])
+        self.assertEqual(second["consultation"], first["consultation"])
+        self.assertEqual(Consultation.objects.count(), 1)
+
+        stored = self.client.get(f"/api/consultations/{first['consultation']}/").json()
+        self.assertEqual(stored["reply"], first["reply"])
+        self.assertEqual(self.client.get("/api/consultations/missing/").status_code, 404)
+
+
+class ColorScannerTests(TestCase):
+    """Picking color objects out of a streamed JSON reply (streaming.py)."""
+
+    def feed(self, chunks):
+        scanner = ColorScanner()
+        return [color for chunk in chunks for color in scanner.feed(chunk)]
+
+    def test_object_split_across_chunks(self):
+        reply = '{"colors": [{"color": "Sage", "hex": "#B7C9A3"}, {"color": "Taupe", "hex": "#C2B280"}]}'
+        whole = self.feed([reply])
+        self.assertEqual([c["hex"] for c in whole], ["#B7C9A3", "#C2B280"])
+        # Any split, down to one character per delta, finds the same colors.
+        self.assertEqual(self.feed(list(reply)), whole)
+        self.assertEqual(self.feed([reply[:20], reply[20:33], reply[33:]]), whole)
+
+    def test_quotes_and_braces_inside_strings(self):
+        reply = ('{"colors": [{"color": "Say \\"hi\\" {not} an object", "hex": "#FFFFFF", '
+                 '"rationale": "ends with a backslash \\\\"}, {"color": "}{", "hex": "#000000"}]}')
+        colors = self.feed(list(reply))
+        self.assertEqual([c["color"] for c in colors], ['Say "hi" {not} an object', "}{"])
+        self.assertEqual(colors[0]["rationale"], "ends with a backslash \\")
+
+    def test_truncated_output(self):
+        scanner = ColorScanner()
+        colors = scanner.feed('{"colors": [{"color": "Sage", "hex": "#B7C9A3"}, {"color": "Taupe", "hex": "#C2')
+        self.assertEqual([c["hex"] for c in colors], ["#B7C9A3"])
+        # The open object never closes, so nothing more is reported for it.
+        self.assertEqual(scanner.feed(""), [])
+        # Leaf objects without a hex, or that are not JSON, are skipped.
+        self.assertEqual(self.feed(['{"note": "none"} {hex: #123456}']), [])
+
+
+@override_settings(COLORSENSE_STUB={"ENABLED": True, "LATENCY": 0, "JITTER": 0, "CHUNK_DELAY": 0})
+class SuggestionStreamTests(TestCase):
+    async def events(self, response):
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        frames = []
+        for frame in body.strip().split("\n\n"):
+            event, data = frame.split("\n", 1)
+            frames.append((event[len("event: "):], json.loads(data[len("data: "):])))
+        return frames
+
+    async def test_colors_then_done(self):
+        response = await self.async_client.post("/api/agent/confirm/stream/", {
+            "confirm": "true", "provider": "stub", "room_description": "a sunny kitchen"})
+        frames = await self.events(response)
+        names = [event for event, _ in frames]
+        self.assertEqual(names[-1], "done")
+        self.assertEqual(names.count("done"), 1)
+        self.assertNotIn("error", names)
+        colors = [data["color"]["hex"] for event, data in frames if event == "color"]
+        self.assertTrue(colors)
+
+        done = frames[-1][1]
+        # Swatches are the first eight distinct colors, in the order they were streamed.
+        self.assertEqual(done["swatches"], colors[:8])
+        self.assertTrue(done["reply"])
+        consultation = await Consultation.objects.aget(public_id=done["consultation"])
+        self.assertEqual(consultation.kind, Consultation.SUGGESTION)
+
+    def test_rejected_suggestion_is_not_streamed(self):
+        response = self.client.post("/api/agent/confirm/stream/", {"confirm": "false", "provider": "stub"})
+        self.assertEqual(response.json(), {"ok": False, "message": "Suggestion rejected."})
+
+
+@override_settings(COLORSENSE_STUB={"ENABLED": True, "LATENCY": 0, "JITTER": 0, "CHUNK_DELAY": 0},
+                   COLORSENSE_PROFILES={"WRITE_BACK": 3600})
+class PreferenceFeedbackTests(TestCase):
+    """Accepting or rejecting a paint suggestion trains the requester's profile (reflection.py)."""
+
+    def setUp(self):
+        reflection._cache.clear()
+        self.addCleanup(reflection._cache.clear)
+        self.client.get("/")
+        self.key = "anon:" + self.client.cookies[PROFILE_COOKIE].value
+
+    def suggest(self, text):
+        data = self.client.post("/api/agent/confirm/", {"confirm": "true", "room_description": text,
+                                                        "provider": "stub"}).json()
+        self.assertTrue(data["ok"])
+        return data["consultation"]
+
+    def test_accepted_suggestion_updates_profile(self):
+        consultation = self.suggest("a sunny kitchen")
+        response = self.client.post(f"/api/consultations/{consultation}/feedback/", {"accepted": "true"}).json()
+        self.assertEqual(response, {"ok": True, "learned": True})
+        profile = reflection.get_profile(self.key)
+        self.assertEqual((profile.accepted, profile.rejected), (1, 0))
+        self.assertTrue(reflection.summary(self.key))
+
+        reflection.flush()
+        row = PreferenceProfile.objects.get(key=self.key)
+        self.assertEqual(row.accepted, 1)
+
+    def test_repeated_feedback_is_learned_once(self):
+        consultation = self.suggest("a bright loft")
+        url = f"/api/consultations/{consultation}/feedback/"
+        self.assertTrue(self.client.post(url, {"accepted": "true"}).json()["learned"])
+        profile = reflection.get_profile(self.key)
+        vector = profile.to_vector()
+        self.assertEqual(self.client.post(url, {"accepted": "true"}).json(), {"ok": True, "learned": False})
+        self.assertEqual((profile.accepted, profile.to_vector()), (1, vector))
+        swatches = ColorRecommendation.objects.filter(consultation__public_id=consultation).count()
+        self.assertEqual(PreferenceFeedback.objects.filter(profile_key=self.key).count(), swatches)
+
+        # Changing one's mind replaces the verdict instead of adding to it.
+        self.assertTrue(self.client.post(url, {"accepted": "false"}).json()["learned"])
+        self.assertEqual((profile.accepted, profile.rejected), (0, 1))
+        self.assertFalse(PreferenceFeedback.objects.filter(profile_key=self.key, accepted=True).exists())
+        self.assertFalse(self.client.post(url, {"accepted": "false"}).json()["learned"])
+
+    def test_rejection_and_bad_requests(self):
+        consultation = self.suggest("a dark hallway")
+        self.client.post(f"/api/consultations/{consultation}/feedback/", {"accepted": "false"})
+        self.assertEqual(reflection.get_profile(self.key).rejected, 1)
+        self.assertEqual(self.client.post(f"/api/consultations/{consultation}/feedback/").status_code, 400)
+        self.assertEqual(self.client.post("/api/consultations/missing/feedback/", {"accepted": "true"}).status_code,
+                         404)
+
+
+def _png(color, size=(64, 48)):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class PreprocessImageTests(TestCase):
+    """Decode, orient, downscale and strip uploads before they are sent or stored (agent.preprocess_image)."""
+
+    def photo(self, orientation):
+        from PIL import Image
+
+        # Red on the left, blue on the right, as the sensor recorded it.
+        img = Image.new("RGB", (64, 32), "blue")
+        img.paste((255, 0, 0), (0, 0, 32, 32))
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        exif[0x010F] = "PhoneCo"
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", exif=exif, quality=95)
+        return buf.getvalue()
+
+    def test_orientation_is_applied_and_metadata_stripped(self):
+        from PIL import Image
+        from .agent import preprocess_image
+
+        # Orientation 6: the camera was turned, so the left edge is the top.
+        result = preprocess_image(self.photo(6))
+        self.assertEqual((result["width"], result["height"]), (32, 64))
+        self.assertEqual(result["content_type"], "image/jpeg")
+        img = Image.open(io.BytesIO(result["data"]))
+        self.assertEqual(img.size, (32, 64))
+        self.assertFalse(img.getexif())
+        self.assertNotIn(b"PhoneCo", result["data"])
+        red, green, blue = img.getpixel((16, 8))
+        self.assertGreater(red, 200)
+        self.assertLess(blue, 60)
+
+    def test_downscale_and_already_processed(self):
+        from .agent import preprocess_image
+
+        result = preprocess_image(self.photo(1), max_edge=16)
+        self.assertEqual((result["width"], result["height"]), (16, 8))
+        self.assertEqual(result["bytes_in"], len(self.photo(1)))
+        # Feeding our own output back is a no-op.
+        again = preprocess_image(result["data"], max_edge=16)
+        self.assertEqual(again["data"], result["data"])
+        with self.assertRaises(ValueError):
+            preprocess_image(b"\xff\xd8\xff truncated")
+
+
+class UploadTests(TestCase):
+    """Resumable chunked uploads (uploads.py) through the api/uploads/ endpoints."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        settings = override_settings(
+            MEDIA_ROOT=root,
+            COLORSENSE_WORKSPACES={"ROOT": os.path.join(root, "reconstructions")},
+            COLORSENSE_JOBS={"MODE": "external", "DB": os.path.join(root, "jobs.sqlite3")},
+            COLORSENSE_UPLOADS={"CHUNK_SIZE": 1024, "EXTRACT_BATCH": 0},
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.upload = self.client.post("/api/uploads/").json()["upload"]
+
+    def register(self, data, name="photo.png", sha256=""):
+        return self.client.post(f"/api/uploads/{self.upload}/files/",
+                                json.dumps({"name": name, "size": len(data), "sha256": sha256}),
+                                content_type="application/json")
+
+    def put(self, index, data, start, end):
+        return self.client.put(f"/api/uploads/{self.upload}/files/{index}/", data[start:end],
+                               content_type="application/octet-stream",
+                               headers={"Content-Range": f"bytes {start}-{end - 1}/{len(data)}"})
+
+    def send(self, index, data, chunk=1024):
+        for start in range(0, len(data), chunk):
+            response = self.put(index, data, start, min(start + chunk, len(data)))
+        return response
+
+    def staged(self):
+        return sorted(os.listdir(os.path.join(workspace.workspace_root(), ".staging", self.upload, "images")))
+
+    def test_parse_content_range(self):
+        self.assertEqual(uploads.parse_content_range("bytes 0-99/100"), (0, 99, 100))
+        for value in ("", "bytes 0-100/100", "bytes 5-4/10", "items 0-1/2"):
+            with self.assertRaises(uploads.UploadError):
+                uploads.parse_content_range(value)
+
+    def test_chunks_resume_from_server_offset(self):
+        data = _png("red", (300, 200)) + b"\0" * 3000
+        self.assertEqual(self.register(data).status_code, 201)
+        self.assertEqual(self.put(0, data, 0, 1024).json()["offset"], 1024)
+
+        # A repeated or skipped chunk is refused with the offset to resume from.
+        for start in (0, 2048):
+            response = self.put(0, data, start, start + 1024)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()["offset"], 1024)
+        self.assertEqual(self.client.get(f"/api/uploads/{self.upload}/").json()["files"][0]["offset"], 1024)
+
+        for start in range(1024, len(data), 1024):
+            response = self.put(0, data, start, min(start + 1024, len(data)))
+        result = response.json()
+        self.assertEqual((result["status"], result["offset"]), (UploadFile.DONE, len(data)))
+        self.assertEqual(result["digest"], hashlib.sha256(data).hexdigest())
+
+    def test_chunk_headers_must_match_the_file(self):
+        data = _png("red")
+        self.register(data)
+        response = self.client.put(f"/api/uploads/{self.upload}/files/0/", data[:10],
+                                   content_type="application/octet-stream",
+                                   headers={"Content-Range": f"bytes 0-19/{len(data)}"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.put(0, data + b"x", 0, 10).status_code, 400)
+        self.assertEqual(self.client.put(f"/api/uploads/{self.upload}/files/0/", data).status_code, 400)
+
+    def test_non_images_are_rejected(self):
+        text = b"definitely not an image " * 4
+        self.register(text, "notes.jpg")
+        response = self.put(0, text, 0, len(text))
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(UploadFile.objects.get(index=0).status, UploadFile.INVALID)
+
+        # Right signature, unreadable header.
+        fake = b"\xff\xd8\xff" + b"\0" * 64
+        self.register(fake, "fake.jpg")
+        self.assertEqual(self.put(1, fake, 0, len(fake)).status_code, 415)
+        self.assertEqual(self.staged(), [])
+
+    def test_duplicates_and_known_files(self):
+        data = _png("green")
+        digest = hashlib.sha256(data).hexdigest()
+        self.register(data)
+        self.assertEqual(self.send(0, data).json()["status"], UploadFile.DONE)
+        self.register(data, "copy.png")
+        self.assertEqual(self.send(1, data).json()["status"], UploadFile.DUPLICATE)
+        self.assertEqual(self.staged(), [f"00000_{digest}.png"])
+
+        # A later upload that names a stored file's sha256 sends no bytes.
+        self.upload = self.client.post("/api/uploads/").json()["upload"]
+        result = self.register(data, sha256=digest).json()
+        self.assertEqual((result["status"], result["offset"]), (UploadFile.DONE, len(data)))
+        unknown = _png("blue")
+        result = self.register(unknown, sha256=hashlib.sha256(unknown).hexdigest()).json()
+        self.assertEqual((result["status"], result["offset"]), (UploadFile.PENDING, 0))
+
+    def test_complete_starts_one_job(self):
+        images = [_png("red"), _png("blue")]
+        for index, data in enumerate(images):
+            self.register(data)
+            if index == 0:
+                self.send(index, data)
+        self.assertEqual(self.client.post(f"/api/uploads/{self.upload}/complete/").status_code, 409)
+        self.send(1, images[1])
+
+        # A job that fails to start leaves the session completable again.
+        with mock.patch("colorsense.views.jobs.create_job", side_effect=sqlite3.OperationalError("locked")):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.client.post(f"/api/uploads/{self.upload}/complete/")
+        result = self.client.post(f"/api/uploads/{self.upload}/complete/").json()
+        self.assertTrue(result["ok"])
+        self.assertEqual(result["url"], f"/reconstruct/{result['job']}/")
+        again = self.client.post(f"/api/uploads/{self.upload}/complete/").json()
+        self.assertEqual(again["job"], result["job"])
+        self.assertEqual(self.register(_png("white")).status_code, 409)
+
+        # The same photo set uploaded again reuses the job; its own staging copy is dropped.
+        first_staging = os.path.join(workspace.workspace_root(), ".staging", self.upload)
+        self.upload = self.client.post("/api/uploads/").json()["upload"]
+        for data in reversed(images):
+            self.register(data, sha256=hashlib.sha256(data).hexdigest())
+        second_staging = os.path.join(workspace.workspace_root(), ".staging", self.upload)
+        self.assertEqual(self.client.post(f"/api/uploads/{self.upload}/complete/").json()["job"], result["job"])
+
+        # The job, not the request, moves the first upload's images into the workspace.
+        with mock.patch("colorsense.reconstruct.run_pipeline"):
+            jobs.work_forever(once=True)
+        job = jobs.get_job(result["job"])
+        self.assertEqual(job["image_dir"], os.path.join(job["work_dir"], "images"))
+        self.assertEqual(len(os.listdir(job["image_dir"])), 2)
+        self.assertFalse(os.path.exists(first_staging))
+        for _ in range(500):
+            if not os.path.exists(second_staging):
+                break
+            time.sleep(0.01)
+        self.assertFalse(os.path.exists(second_staging))
+
+    def test_complete_needs_a_valid_image_and_purge_drops_idle_sessions(self):
+        self.assertEqual(self.client.post(f"/api/uploads/{self.upload}/complete/").status_code, 400)
+        self.assertEqual(uploads.purge(ttl=0)[0], 1)
+        self.assertEqual(self.client.get(f"/api/uploads/{self.upload}/").status_code, 404)
+        self.assertEqual(self.client.get("/api/uploads/not-an-id/").status_code, 404)
+
+
+class ResponseCacheTests(TestCase):
+    """Completion cache backends (cache.py)."""
+
+    def test_memory_backend_evicts_least_recently_used(self):
+        backend = cache.MemoryBackend(max_entries=2, max_bytes=10)
+        backend.set("a", "1", 60)
+        backend.set("b", "2", 60)
+        backend.get("a")
+        backend.set("c", "3", 60)
+        self.assertEqual((backend.get("a"), backend.get("b"), backend.get("c")), ("1", None, "3"))
+        # Over the byte budget the oldest entries go too; a value larger than the budget is never stored.
+        backend.set("d", "x" * 9, 60)
+        self.assertEqual((backend.get("a"), backend.get("c"), backend.get("d")), (None, "3", "x" * 9))
+        backend.set("e", "y" * 11, 60)
+        self.assertIsNone(backend.get("e"))
+        self.assertEqual(backend.info(), {"entries": 2, "bytes": 10, "evictions": 2})
+
+    def test_memory_backend_expires_entries(self):
+        backend = cache.MemoryBackend()
+        with mock.patch("colorsense.cache.time.time", return_value=1000.0):
+            backend.set("k", "v", 10)
+        with mock.patch("colorsense.cache.time.time", return_value=1009.0):
+            self.assertEqual(backend.get("k"), "v")
+        with mock.patch("colorsense.cache.time.time", return_value=1011.0):
+            self.assertIsNone(backend.get("k"))
+        self.assertEqual(backend.info()["entries"], 0)
+
+    def test_sqlite_backend_expires_and_evicts(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        backend = cache.SQLiteBackend(os.path.join(directory, "responses.sqlite3"), max_entries=2)
+        with mock.patch("colorsense.cache.time.time", return_value=1000.0):
+            backend.set("a", "1", 10)
+        with mock.patch("colorsense.cache.time.time", return_value=1001.0):
+            backend.set("b", "2", 100)
+        with mock.patch("colorsense.cache.time.time", return_value=1002.0):
+            backend.set("c", "3", 100)
+            self.assertEqual((backend.get("a"), backend.get("b"), backend.get("c")), (None, "2", "3"))
+        with mock.patch("colorsense.cache.time.time", return_value=1200.0):
+            self.assertIsNone(backend.get("b"))
+        # Shared by every process on the host: a second connection sees the same rows.
+        backend.set("d", "4", 60)
+        other = cache.SQLiteBackend(os.path.join(directory, "responses.sqlite3"))
+        self.assertEqual(other.get("d"), "4")
+        other.clear()
+        self.assertIsNone(backend.get("d"))
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                           "LOCATION": "colorsense-tests"}})
+    def test_django_backend_clear_keeps_other_entries(self):
+        from django.core.cache import caches
+
+        shared = caches["default"]
+        shared.set("unrelated", "kept")
+        backend = cache.DjangoBackend()
+        backend.set("k", "v", 60)
+        self.assertEqual(backend.get("k"), "v")
+        backend.clear()
+        self.assertIsNone(backend.get("k"))
+        self.assertEqual(shared.get("unrelated"), "kept")
+        backend.set("k", "w", 60)
+        self.assertEqual(cache.DjangoBackend().get("k"), "w")
+
+    def test_keys_hash_image_bytes_not_urls(self):
+        encoded = base64.b64encode(b"same pixels").decode()
+        first, second = ([{"role": "user", "content": [{"type": "image_url", "image_url": {"url": url}}]}]
+                         for url in (f"data:image/png;base64,{encoded}", f"data:image/jpeg;base64,{encoded}"))
+        self.assertEqual(cache.make_key("openai", "m", first), cache.make_key("openai", "m", second))
+        self.assertNotEqual(cache.make_key("openai", "m", first), cache.make_key("groq", "m", first))
+
+
+@override_settings(COLORSENSE_STUB={"ENABLED": True, "LATENCY": 0.05, "JITTER": 0, "CHUNK_DELAY": 0})
+class SingleFlightTests(TestCase):
+    """Coalescing of identical in-flight provider calls (singleflight.py)."""
+
+    messages = [{"role": "system", "content": "Suggest paint."}, {"role": "user", "content": "a blue room"}]
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        for target, value in (("colorsense.agent.get_singleflight", self.flight),
+                              ("colorsense.agent.get_response_cache", None)):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = AIClient("stub")
+
+    def count_requests(self, create):
+        calls = []
+
+        async def counted(completions, **kwargs):
+            calls.append(kwargs)
+            return await create(completions, **kwargs)
+
+        patcher = mock.patch("colorsense.stub._AsyncCompletions.create", counted)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def test_concurrent_identical_calls_send_one_request(self):
+        from .stub import _AsyncCompletions
+
+        calls = self.count_requests(_AsyncCompletions.create)
+
+        async def run():
+            return await asyncio.gather(*(self.client.achat("stub", self.messages) for _ in range(4)))
+
+        replies = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(replies)), 1)
+        self.assertEqual(self.flight.stats(), {"leaders": 1, "coalesced": 3, "in_flight": 0})
+
+    def test_provider_error_reaches_every_waiter(self):
+        async def broken(completions, **kwargs):
+            await asyncio.sleep(0.05)
+            raise ValueError("bad request")
+
+        calls = self.count_requests(broken)
+
+        async def run():
+            return await asyncio.gather(*(self.client.achat("stub", self.messages) for _ in range(3)),
+                                        return_exceptions=True)
+
+        errors = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([str(e) for e in errors], ["bad request"] * 3)
+        self.assertEqual(self.flight.stats()["in_flight"], 0)
+
+    def test_stream_error_reaches_followers_once(self):
+        async def broken_stream(completions, **kwargs):
+            async def chunks():
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="{"))])
+                await asyncio.sleep(0.05)
+                raise ValueError("stream dropped")
+            return chunks()
+
+        calls = self.count_requests(broken_stream)
+        resolve = mock.Mock(wraps=self.flight.resolve)
+
+        async def consume():
+            return "".join([delta async for delta in self.client.astream("stub", self.messages)])
+
+        async def run():
+            return await asyncio.gather(consume(), consume(), return_exceptions=True)
+
+        with mock.patch.object(self.flight, "resolve", resolve):
+            errors = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([str(e) for e in errors], ["stream dropped"] * 2)
+        self.assertEqual(resolve.call_count, 1)
+
+    def test_threads_share_one_call(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "shared"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.flight.do("k", work)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(self.flight.do("k", work))) for _ in range(2)]
+        for thread in followers:
+            thread.start()
+        while self.flight.stats()["coalesced"] < 2:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual((calls, results), ([1], ["shared"] * 3))
+        # Once resolved the key is forgotten, so a later call does the work again.
+        self.assertEqual(self.flight.do("k", lambda: "fresh"), "fresh")
+
+
+class _ProviderError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+@override_settings(COLORSENSE_RESILIENCE={"MAX_ATTEMPTS": 3, "BREAKER_FAILURES": 2, "BREAKER_RESET": 30})
+class ResilienceTests(TestCase):
+    """Rate limiting, retries, circuit breaking and failover (resilience.py)."""
+
+    def setUp(self):
+        self.clock = 1000.0
+        patcher = mock.patch("colorsense.resilience.time.monotonic", side_effect=lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sleeps = []
+        patcher = mock.patch("colorsense.resilience.time.sleep", side_effect=self.sleeps.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = resilience.Scheduler()
+
+    def test_token_bucket_adapts_rate(self):
+        bucket = resilience.TokenBucket(rate=10, burst=2)
+        self.assertEqual([bucket.reserve(), bucket.reserve()], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.clock += 0.3
+        self.assertEqual(bucket.reserve(), 0.0)
+        # Multiplicative decrease down to a tenth of the limit, additive increase back up to it.
+        for _ in range(6):
+            bucket.throttled()
+        self.assertEqual(bucket.rate, 1.0)
+        self.assertLessEqual(bucket.tokens, 0.0)
+        for _ in range(30):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 10)
+
+    def test_breaker_opens_probes_and_closes(self):
+        breaker = resilience.CircuitBreaker(failures=2, reset=30)
+        breaker.failed()
+        self.assertEqual((breaker.state, breaker.allow()), ("closed", True))
+        breaker.failed()
+        self.assertEqual((breaker.state, breaker.allow()), ("open", False))
+        self.clock += 30
+        self.assertEqual(breaker.state, "half_open")
+        self.assertEqual([breaker.allow(), breaker.allow()], [True, False])
+        # A failed probe reopens it for another interval; a successful one closes it.
+        breaker.failed()
+        self.assertEqual((breaker.state, breaker.allow()), ("open", False))
+        self.clock += 30
+        self.assertTrue(breaker.allow())
+        breaker.succeeded()
+        self.assertEqual((breaker.state, breaker.failures), ("closed", 0))
+
+    def test_call_retries_unavailable_and_gives_up_on_fatal(self):
+        outcomes = [_ProviderError(503), _ProviderError(429), "ok"]
+
+        def flaky():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        self.assertEqual(self.scheduler.call("groq", "m", flaky), "ok")
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertEqual((self.scheduler.retries, self.scheduler.throttled), (2, 1))
+        fatal = mock.Mock(side_effect=_ProviderError(400))
+        with self.assertRaises(_ProviderError):
+            self.scheduler.call("groq", "m", fatal)
+        self.assertEqual(fatal.call_count, 1)
+
+    def test_open_breaker_rejects_without_calling(self):
+        down = mock.Mock(side_effect=_ProviderError(503))
+        with self.assertRaises(resilience.CircuitOpenError):
+            self.scheduler.call("groq", "m", down)
+        self.assertEqual(down.call_count, 2)
+        with self.assertRaises(resilience.CircuitOpenError):
+            self.scheduler.call("groq", "m", down)
+        self.assertEqual(down.call_count, 2)
+        self.assertEqual(self.scheduler.stats()["breakers"], {"groq": "open"})
+        self.assertEqual(self.scheduler.rejected, 2)
+
+    def test_interrupted_probe_frees_the_breaker(self):
+        breaker = self.scheduler.breaker("groq")
+        breaker.failed()
+        breaker.failed()
+        self.clock += 30
+
+        def interrupted():
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.scheduler.call("groq", "m", interrupted)
+        self.assertEqual(self.scheduler.call("groq", "m", lambda: "ok"), "ok")
+        self.assertEqual(breaker.state, "closed")
+
+    @override_settings(GROQ_API_KEY="test", OPENAI_API_KEY="test")
+    def test_unavailable_provider_fails_over(self):
+        self.enterContext(mock.patch("colorsense.agent.get_scheduler", return_value=self.scheduler))
+        self.enterContext(mock.patch("colorsense.agent.get_singleflight", return_value=SingleFlight()))
+        self.enterContext(mock.patch("colorsense.agent.get_response_cache", return_value=None))
+        groq = AIClient("groq")
+        groq._client = mock.Mock()
+        openai = mock.Mock()
+        openai.chat.return_value = "from openai"
+        messages = [{"role": "user", "content": "a blue room"}]
+        with mock.patch("colorsense.agent.get_client", return_value=openai):
+            # A bad request is not the provider's fault, so it is not sent elsewhere.
+            groq._client.chat.completions.create.side_effect = _ProviderError(400)
+            with self.assertRaises(_ProviderError):
+                groq.chat("groq-model", messages)
+            self.assertEqual(openai.chat.call_count, 0)
+            groq._client.chat.completions.create.side_effect = _ProviderError(503)
+            self.assertEqual(groq.chat("groq-model", messages), "from openai")
+        self.assertEqual(openai.chat.call_count, 1)
+        self.assertFalse(openai.chat.call_args.kwargs["failover"])
+        self.assertEqual(self.scheduler.failovers, 1)
+
+
+@override_settings(COLORSENSE_FANOUT={"ENABLED": True, "CONCURRENCY": 2, "TIMEOUT": 30})
+class FanOutTests(TestCase):
+    """Per-image requests and merging their replies (agent.py)."""
+
+    def test_merge_replies_keeps_image_order(self):
+        replies = [
+            json.dumps({"suggestions": [{"hex": "#111111"}], "tips": "Prime first."}),
+            None,
+            "not json",
+            json.dumps({"suggestions": [{"hex": "#222222"}], "palette": {"hex": "#333333"}, "tips": "Prime first."}),
+            json.dumps({"tips": "Tape the edges.", "rooms": 1}),
+        ]
+        merged, errors = merge_replies(replies)
+        self.assertEqual(merged, {
+            "suggestions": [{"hex": "#111111"}, {"hex": "#222222"}],
+            "palette": [{"hex": "#333333"}],
+            "tips": "Prime first.\nTape the edges.",
+            "rooms": 1,
+        })
+        self.assertEqual(errors, [{"image": 2, "error": "Provider reply was not valid JSON."}])
+
+    def run_fan_out(self, outcomes):
+        """Fan out one request per outcome: a reply, an exception, or None to hang until timed out."""
+        state = {"running": 0, "peak": 0}
+
+        async def achat(model, messages, response_format=None, timeout=None):
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+            try:
+                # Later images answer first, so replies must be put back in request order.
+                await asyncio.sleep(0.01 * (len(outcomes) - messages[0]["index"]))
+                outcome = outcomes[messages[0]["index"]]
+                if outcome is None:
+                    await asyncio.sleep(10)
+                if isinstance(outcome, Exception):
+                    raise outcome
+                return outcome
+            finally:
+                state["running"] -= 1
+
+        client = mock.Mock(achat=achat)
+        requests = [[{"role": "user", "index": i}] for i in range(len(outcomes))]
+        real_wait_for = asyncio.wait_for
+
+        async def wait_for(awaitable, timeout):
+            return await real_wait_for(awaitable, 0.2)
+
+        with mock.patch("colorsense.agent.asyncio.wait_for", wait_for):
+            replies, errors = asyncio.run(_afan_out(client, "m", requests, {"type": "json_object"}))
+        return replies, errors, state["peak"]
+
+    def test_fan_out_reports_failures_per_image(self):
+        replies, errors, peak = self.run_fan_out(['{"a": 1}', RuntimeError("HTTP 503"), None, '{"a": 4}'])
+        self.assertEqual(replies, ['{"a": 1}', None, None, '{"a": 4}'])
+        self.assertEqual(errors, [{"image": 1, "error": "HTTP 503"}, {"image": 2, "error": "Timed out."}])
+        self.assertEqual(peak, 2)
+
+    def test_fan_out_preserves_order(self):
+        outcomes = [json.dumps({"suggestions": [i]}) for i in range(5)]
+        replies, errors, _ = self.run_fan_out(outcomes)
+        self.assertEqual((replies, errors), (outcomes, []))
+        self.assertEqual(merge_replies(replies)[0], {"suggestions": [0, 1, 2, 3, 4]})
+
+
+class JobTests(TestCase):
+    """The reconstruction job table (jobs.py)."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.db = os.path.join(root, "jobs.sqlite3")
+        settings = override_settings(COLORSENSE_JOBS={"MODE": "external", "DB": self.db})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.work_dir = os.path.join(root, "reconstructions", "abc")
+        os.makedirs(os.path.join(self.work_dir, "images"))
+
+    def create(self):
+        return jobs.create_job(os.path.join(self.work_dir, "images"), self.work_dir,
+                               os.path.join(self.work_dir, "mesh", "manifest.json"))
+
+    def test_job_runs_through_every_state(self):
+        job_id = self.create()
+        self.assertEqual((jobs.get_job(job_id)["status"], jobs.get_job(job_id)["progress"]), (jobs.QUEUED, 0.0))
+        self.assertEqual(jobs.find_active_job(self.work_dir), job_id)
+        seen = []
+
+        def pipeline(work_dir, progress, options):
+            progress("features", 1.5)
+            job = jobs.get_job(job_id)
+            seen.append((job["status"], job["stage"], job["owner_pid"], job["progress"]))
+
+        with mock.patch("colorsense.reconstruct.run_pipeline", side_effect=pipeline):
+            jobs.run_job(job_id, self.db)
+            # Claimed jobs are never run twice.
+            jobs.run_job(job_id, self.db)
+        self.assertEqual(seen, [(jobs.RUNNING, "features", os.getpid(), 1 / len(workspace.STAGES))])
+        job = jobs.get_job(job_id)
+        self.assertEqual((job["status"], job["timings"], job["progress"]), (jobs.DONE, {"features": 1.5}, 1.0))
+        self.assertIsNone(jobs.find_active_job(self.work_dir))
+
+    def test_failed_job_records_the_error(self):
+        job_id = self.create()
+        with mock.patch("colorsense.reconstruct.run_pipeline", side_effect=RuntimeError("too few points")), \
+                self.assertLogs("colorsense.jobs", "ERROR") as logs:
+            jobs.run_job(job_id, self.db)
+        job = jobs.get_job(job_id)
+        self.assertEqual((job["status"], job["error"]), (jobs.FAILED, "too few points"))
+        self.assertIn(job_id, logs.output[0])
+
+    def test_stale_claims_are_requeued(self):
+        orphan, alive = self.create(), self.create()
+        conn = jobs._connect(self.db)
+        try:
+            conn.execute("UPDATE jobs SET status = ?, owner_pid = ? WHERE id = ?", (jobs.RUNNING, 2 ** 22 + 1, orphan))
+            conn.execute("UPDATE jobs SET status = ?, owner_pid = ? WHERE id = ?", (jobs.RUNNING, os.getpid(), alive))
+        finally:
+            conn.close()
+        with mock.patch("colorsense.jobs._pid_alive", side_effect=lambda pid: pid == os.getpid()), \
+                mock.patch("colorsense.reconstruct.run_pipeline") as pipeline:
+            jobs.work_forever(once=True)
+        self.assertEqual(pipeline.call_count, 1)
+        self.assertEqual(jobs.get_job(orphan)["status"], jobs.DONE)
+        self.assertEqual(jobs.get_job(alive)["status"], jobs.RUNNING)
+
+
+class WorkspaceTests(TestCase):
+    """Content-hashed reconstruction workspaces and stage caching (workspace.py)."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings = override_settings(COLORSENSE_WORKSPACES={"ROOT": self.root, "BUDGET_MB": 1})
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def stage(self, *payloads):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        return workspace.stage_uploads([SimpleUploadedFile(f"IMG_{i}.JPG", data) for i, data in enumerate(payloads)])
+
+    def test_identical_uploads_share_a_workspace(self):
+        first, digest = self.stage(b"one", b"two", b"one")
+        self.assertEqual(sorted(os.listdir(os.path.join(first, "images"))),
+                         [f"00000_{hashlib.sha256(b'one').hexdigest()}.jpg",
+                          f"00001_{hashlib.sha256(b'two').hexdigest()}.jpg"])
+        second, same = self.stage(b"two", b"one")
+        self.assertEqual(same, digest)
+        path = workspace.open_workspace(digest, first)
+        self.assertEqual(workspace.open_workspace(same, second), path)
+        self.assertEqual(os.path.basename(path), digest)
+        self.assertFalse(os.path.exists(first) or os.path.exists(second))
+
+    def test_lock_is_exclusive(self):
+        path = workspace.open_workspace("a" * 64)
+        acquired = threading.Event()
+        order = []
+
+        def contender():
+            with workspace.locked(path):
+                order.append("contender")
+                acquired.set()
+
+        with workspace.locked(path):
+            self.assertTrue(workspace._is_locked(path))
+            thread = threading.Thread(target=contender)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+            order.append("holder")
+        thread.join(5)
+        self.assertEqual(order, ["holder", "contender"])
+        self.assertFalse(workspace._is_locked(path))
+
+    def test_eviction_skips_kept_and_locked_workspaces(self):
+        paths = []
+        for i, name in enumerate(("old", "locked", "kept", "new")):
+            path = workspace.open_workspace(name)
+            with open(os.path.join(path, "blob"), "wb") as fh:
+                fh.write(b"x" * 400 * 1024)
+            os.utime(os.path.join(path, ".last_used"), (1000 + i, 1000 + i))
+            paths.append(path)
+        with workspace.locked(paths[1]):
+            evicted = workspace.evict(keep=[paths[2]])
+        self.assertEqual(evicted, [paths[0], paths[3]])
+        self.assertEqual(sorted(os.listdir(self.root)), ["kept", "locked"])
+
+    def test_stages_rerun_only_when_missing_or_changed(self):
+        from .reconstruct import _run_stage
+
+        path = workspace.open_workspace("b" * 64)
+        calls = []
+        for stage in workspace.STAGES[:3]:
+            _run_stage(path, stage, None, lambda: calls.append(stage))
+        _run_stage(path, "mesh", None, lambda: calls.append("mesh"), key="lods=1")
+        _run_stage(path, "features", None, lambda: calls.append("again"))
+        _run_stage(path, "mesh", None, lambda: calls.append("same"), key="lods=1")
+        self.assertEqual(calls, ["features", "matching", "mapping", "mesh"])
+        # A changed key reruns the stage; rerunning a stage invalidates everything after it.
+        _run_stage(path, "mesh", None, lambda: calls.append("rebuilt"), key="lods=2")
+        os.remove(os.path.join(path, "stages", "matching.json"))
+        _run_stage(path, "matching", None, lambda: calls.append("rematched"))
+        self.assertEqual(calls[4:], ["rebuilt", "rematched"])
+        self.assertEqual([workspace.is_done(path, stage) for stage in workspace.STAGES], [True, True, False, False])
+
+
+class CatalogTests(TestCase):
+    """Paint catalog loading, its .npz cache and nearest-paint lookup (catalog.py)."""
+
+    # Pairs and expected differences from Sharma, Wu and Dalal (2005),
+    # "The CIEDE2000 color-difference formula", Table 1.
+    SHARMA = [
+        ((50.0000, 2.6772, -79.7751), (50.0000, 0.0000, -82.7485), 2.0425),
+        ((50.0000, 3.1571, -77.2803), (50.0000, 0.0000, -82.7485), 2.8615),
+        ((50.0000, 2.8361, -74.0200), (50.0000, 0.0000, -82.7485), 3.4412),
+        ((50.0000, 0.0000, 0.0000), (50.0000, -1.0000, 2.0000), 2.3669),
+        ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0009), 7.1792),
+        ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0011), 7.2195),
+        ((50.0000, -0.0010, 2.4900), (50.0000, 0.0009, -2.4900), 4.8045),
+        ((50.0000, -0.0010, 2.4900), (50.0000, 0.0011, -2.4900), 4.7461),
+        ((50.0000, 2.5000, 0.0000), (73.0000, 25.0000, -18.0000), 27.1492),
+        ((50.0000, 2.5000, 0.0000), (61.0000, -5.0000, 29.0000), 22.8977),
+        ((50.0000, 2.5000, 0.0000), (56.0000, -27.0000, -3.0000), 31.9030),
+        ((50.0000, 2.5000, 0.0000), (50.0000, 3.1736, 0.5854), 1.0000),
+        ((60.2574, -34.0099, 36.2677), (60.4626, -34.1751, 39.4387), 1.2644),
+        ((63.0109, -31.0961, -5.8663), (62.8187, -29.7946, -4.0864), 1.2630),
+        ((90.8027, -2.0831, 1.4410), (91.1528, -1.6435, 0.0447), 1.4441),
+        ((2.0776, 0.0795, -1.1350), (0.9033, -0.0636, -0.5514), 0.9082),
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.path = os.path.join(self.dir, "paints.csv")
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write("Brand,Name,Code,Hex\n")
+            fh.write("Acme,Soft White,AC-1,#F0F4F8\nAcme,Coral,AC-2,ff6f61\nAcme,Charcoal,AC-3,#333\n")
+            fh.write("Acme,Sage,AC-4,#B7C9A3\nAcme,Broken,AC-5,not-a-hex\n")
+
+    def test_ciede2000_matches_reference_data(self):
+        from .catalog import ciede2000
+
+        lab1, lab2, expected = (np.array(column) for column in zip(*self.SHARMA))
+        np.testing.assert_allclose(ciede2000(lab1, lab2), expected, atol=1e-4)
+        # Symmetric, and zero for identical colors.
+        np.testing.assert_allclose(ciede2000(lab2, lab1), expected, atol=1e-4)
+        self.assertEqual(float(ciede2000(lab1[0], lab1[0])), 0.0)
+
+    def test_npz_cache_is_reused(self):
+        from .catalog import Catalog, load_catalog
+
+        cache_dir = os.path.join(self.dir, "cache")
+        catalog = load_catalog(self.path, cache_dir)
+        self.assertEqual(catalog.hexes, ["#F0F4F8", "#FF6F61", "#333333", "#B7C9A3"])
+        cached = os.listdir(cache_dir)
+        self.assertEqual(len(cached), 1)
+        self.assertTrue(cached[0].endswith(".npz"))
+
+        with mock.patch.object(Catalog, "from_rows", side_effect=AssertionError("catalog re-parsed")):
+            again = load_catalog(self.path, cache_dir)
+        self.assertEqual((again.names, again.codes, again.hexes), (catalog.names, catalog.codes, catalog.hexes))
+        np.testing.assert_array_equal(again.lab, catalog.lab)
+
+        # A corrupt cache file is ignored and rewritten.
+        with open(os.path.join(cache_dir, cached[0]), "wb") as fh:
+            fh.write(b"not an npz")
+        self.assertEqual(load_catalog(self.path, cache_dir).hexes, catalog.hexes)
+
+    def test_nearest(self):
+        from .catalog import load_catalog
+
+        catalog = load_catalog(self.path)
+        exact, near, invalid = catalog.nearest(["#b7c9a3", "#FF7060", "oops"], k=2)
+        self.assertEqual((exact[0]["name"], exact[0]["code"], exact[0]["delta_e"]), ("Sage", "AC-4", 0.0))
+        self.assertEqual(near[0]["name"], "Coral")
+        self.assertLess(near[0]["delta_e"], near[1]["delta_e"])
+        self.assertEqual(invalid, [])
+
+        # The brute-force scan used without scipy agrees with the KD-tree.
+        catalog.tree = None
+        self.assertEqual(catalog.nearest(["#b7c9a3", "#FF7060", "oops"], k=2), [exact, near, invalid])
+
+
+@unittest.skipIf(preview.cv2 is None, "wall previews need OpenCV")
+class WallPreviewTests(TestCase):
+    """Recoloring the wall of an uploaded photo (preview.py, views.wall_preview)."""
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media, COLORSENSE_IMAGE_STORE={"ROOT": self.media + "/store"})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        preview._cache.clear()
+        self.addCleanup(preview._cache.clear)
+
+    def room(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image, ImageDraw
+
+        # A pale wall over a dark floor, with a blue sofa in front of the wall.
+        img = Image.new("RGB", (160, 120), (220, 210, 190))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((0, 80, 159, 119), fill=(80, 50, 30))
+        draw.rectangle((20, 50, 60, 100), fill=(40, 60, 120))
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        return SimpleUploadedFile("room.png", buf.getvalue(), content_type="image/png")
+
+    def decode(self, data_url):
+        from PIL import Image
+
+        return Image.open(io.BytesIO(base64.b64decode(data_url.split(",", 1)[1]))).convert("RGB")
+
+    def test_wall_is_recolored(self):
+        response = self.client.post("/api/preview/", {"image": self.room(), "hex": ["#C0392B", "#2E86C1"]})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([p["hex"] for p in data["previews"]], ["#C0392B", "#2E86C1"])
+        self.assertGreater(data["coverage"], 0.4)
+        self.assertLess(data["coverage"], 0.8)
+        self.assertFalse(data["timings"]["mask_cached"])
+
+        red = self.decode(data["previews"][0]["image"])
+        self.assertEqual(red.size, (160, 120))
+        r, g, b = red.getpixel((110, 30))
+        self.assertGreater(r, g + 60)
+        # The floor and the sofa keep their colors.
+        for point, color in (((110, 105), (80, 50, 30)), ((40, 70), (40, 60, 120))):
+            self.assertTrue(all(abs(a - b) < 20 for a, b in zip(red.getpixel(point), color)), point)
+
+        # Further swatches for the same image reuse its segmentation.
+        again = self.client.post("/api/preview/", {"image_id": data["image_id"], "hex": "#2E86C1"}).json()
+        self.assertTrue(again["timings"]["mask_cached"])
+        self.assertEqual(again["previews"][0]["image"], data["previews"][1]["image"])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.post("/api/preview/", {"image": self.room()}).status_code, 400)
+        response = self.client.post("/api/preview/", {"image": self.room(), "hex": "#12345"})
+        self.assertEqual((response.status_code, response.json()["error"]), (400, "Invalid hex color: '#12345'"))
+        self.assertEqual(self.client.post("/api/preview/", {"image_id": "nope", "hex": "#C0392B"}).status_code, 400)
+        missing = self.client.post("/api/preview/", {"image_id": "0" * 64, "hex": "#C0392B"})
+        self.assertEqual(missing.status_code, 410)
+
+
+class PromptPlanTests(TestCase):
+    """Token-budgeted prompt assembly and BM25 document trimming (prompt.py)."""
+
+    model = "gpt-4o"
+    chunks = [
+        "Our house was built in 1962 and the roof was replaced last spring.",
+        "The north facing bedroom gets little light, so the bedroom walls look grey and cold in winter.",
+        "The garden fence needs staining before the summer and the gate sticks.",
+        "Kitchen cabinets are oak with brass handles; the kitchen floor is terracotta tile.",
+    ]
+
+    def test_select_chunks_keeps_best_in_document_order(self):
+        from .prompt import count_tokens, select_chunks
+
+        cost = [count_tokens(chunk, self.model) + 2 for chunk in self.chunks]
+        chosen, used = select_chunks(self.chunks, "cosy north facing bedroom", cost[1], self.model)
+        self.assertEqual((chosen, used), ([self.chunks[1]], cost[1]))
+
+        chosen, used = select_chunks(self.chunks, "bedroom and kitchen colors", cost[1] + cost[3], self.model)
+        self.assertEqual(chosen, [self.chunks[1], self.chunks[3]])
+        # Without usable query terms the earliest chunks win.
+        chosen, _ = select_chunks(self.chunks, "please make it nice", cost[0] + cost[1], self.model)
+        self.assertEqual(chosen, self.chunks[:2])
+        self.assertEqual(select_chunks(self.chunks, "bedroom", 1, self.model), ([], 0))
+
+    def test_chunk_text_is_independent_of_read_size(self):
+        from .prompt import chunk_text, read_document
+
+        text = "\n\n".join(self.chunks * 20)
+        upload = SimpleNamespace(chunks=lambda: (text[i:i + 7].encode() for i in range(0, len(text), 7)))
+        chunks = chunk_text(read_document(upload), chunk_tokens=40)
+        self.assertEqual(chunks, chunk_text([text], chunk_tokens=40))
+        self.assertTrue(all(len(chunk) <= 40 * 4 for chunk in chunks))
+        self.assertEqual("\n\n".join(chunks), text)
+
+    @override_settings(COLORSENSE_PROMPT={"MAX_TOKENS": 400})
+    def test_plan_fits_the_budget(self):
+        from .prompt import plan_prompt
+
+        notes = ["Photo 1: warm light, beige walls."]
+        long_text = "We would like a calm bedroom. " + "It has a large wardrobe and a reading chair. " * 60
+        plan = plan_prompt(self.model, "Suggest paint.", long_text, notes, self.chunks * 10, [])
+        report = plan.report
+        self.assertEqual(report["budget"], 400)
+        self.assertFalse(report["over_budget"])
+        self.assertLessEqual(report["tokens"]["total"], 400)
+        self.assertTrue(plan.user_text.startswith("We would like a calm bedroom.") and plan.user_text.endswith("…"))
+        self.assertEqual(plan.notes, notes)
+        self.assertLess(report["docs"]["used"], report["docs"]["chunks"])
+        self.assertIn(self.chunks[1], plan.doc_texts)
+
+    @override_settings(COLORSENSE_PROMPT={"MAX_TOKENS": 2000})
+    def test_images_drop_to_low_detail_when_allowed(self):
+        from .prompt import plan_prompt
+
+        images = ["https://example.com/room.jpg"] * 2
+        plan = plan_prompt(self.model, "Suggest paint.", "a bedroom", [], [], images)
+        self.assertEqual((plan.image_detail, plan.report["tokens"]["images"]), (None, 2 * 765))
+        self.assertFalse(plan.report["over_budget"])
+        plan = plan_prompt(self.model, "Suggest paint.", "a bedroom", [], [], images, low_detail=True)
+        self.assertEqual((plan.image_detail, plan.report["tokens"]["images"]), ("low", 2 * 85))
+
+
+class MatchingTests(TestCase):
+    """Matching strategy selection for reconstruct_3d (reconstruct.py)."""
+
+    def options(self, **overrides):
+        from .reconstruct import DEFAULT_OPTIONS
+
+        return dict(DEFAULT_OPTIONS, **overrides)
+
+    def test_choose_matching(self):
+        from .reconstruct import choose_matching
+
+        cases = [
+            ((40, True, {}), "exhaustive"),
+            ((41, False, {}), "sequential"),
+            ((41, True, {}), "spatial"),
+            ((99, True, {"vocab_tree": "tree.bin"}), "spatial"),
+            ((100, True, {"vocab_tree": "tree.bin"}), "vocabtree"),
+            ((100, False, {"exhaustive_max_images": 100}), "exhaustive"),
+        ]
+        for (images, priors, overrides), mode in cases:
+            with self.subTest(images=images, priors=priors, **overrides):
+                self.assertEqual(choose_matching(images, priors, self.options(**overrides)), mode)
+
+    def test_auto_mode_reads_the_database(self):
+        from .reconstruct import match_features
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        db_path = os.path.join(directory, "database.db")
+        conn = sqlite3.connect(db_path)
+        conn.executescript(
+            "CREATE TABLE images (image_id INTEGER); CREATE TABLE pose_priors (image_id INTEGER);"
+            "CREATE TABLE matches (pair_id INTEGER); CREATE TABLE two_view_geometries (pair_id INTEGER, rows INTEGER);"
+            "INSERT INTO matches VALUES (1), (2); INSERT INTO two_view_geometries VALUES (1, 30), (2, 0);")
+        conn.executemany("INSERT INTO images VALUES (?)", [(i,) for i in range(50)])
+        conn.commit()
+        conn.close()
+        with mock.patch("colorsense.reconstruct.pycolmap") as pycolmap:
+            report = match_features(db_path, "auto", self.options())
+            self.assertEqual(report, {"mode": "sequential", "candidate_pairs": 2, "verified_pairs": 1,
+                                      "inlier_matches": 30})
+            pycolmap.match_sequential.assert_called_once()
+            with self.assertRaises(RuntimeError):
+                match_features(db_path, "vocabtree", self.options())
+            with self.assertRaises(ValueError):
+                match_features(db_path, "everything", self.options())
+        self.assertFalse(pycolmap.match_exhaustive.called or pycolmap.match_vocabtree.called)
+
+
+def _read_ply(path):
+    """Header lines, vertex records and face indices of a quantized PLY (write_quantized_ply)."""
+    with open(path, "rb") as fh:
+        data = fh.read()
+    end = data.index(b"end_header\n") + len(b"end_header\n")
+    header = data[:end].decode("ascii").splitlines()
+    counts = {line.split()[1]: int(line.split()[2]) for line in header if line.startswith("element")}
+    index = "<u2" if "property list uchar ushort vertex_indices" in header else "<u4"
+    vertex = np.frombuffer(data, dtype=[("x", "<i2"), ("y", "<i2"), ("z", "<i2"), ("red", "u1"), ("green", "u1"),
+                                        ("blue", "u1")], count=counts["vertex"], offset=end)
+    face = np.frombuffer(data, dtype=[("n", "u1"), ("v", index, (3,))], count=counts["face"],
+                         offset=end + vertex.nbytes)
+    return header, vertex, face
+
+
+class MeshExportTests(TestCase):
+    """Mesh LODs exported as quantized binary PLY (reconstruct.py)."""
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out_dir, ignore_errors=True)
+
+    def test_empty_mesh_is_refused(self):
+        from .reconstruct import export_lods
+
+        empty = SimpleNamespace(vertices=[], triangles=[])
+        with self.assertRaisesRegex(RuntimeError, "empty surface"):
+            export_lods(empty, self.out_dir, (100,))
+        self.assertEqual(os.listdir(self.out_dir), [])
+
+    @unittest.skipIf(open3d is None, "open3d is not installed")
+    def test_lods_are_written_coarse_to_fine(self):
+        from .reconstruct import export_lods
+
+        mesh = open3d.geometry.TriangleMesh.create_sphere(radius=2.0, resolution=20)
+        total = len(mesh.triangles)
+        manifest = export_lods(mesh, self.out_dir, (100000, 100, 400, 400))
+        with open(os.path.join(self.out_dir, "manifest.json")) as fh:
+            self.assertEqual(json.load(fh), manifest)
+        # Budgets above the full mesh collapse into one final level.
+        self.assertEqual([lod["file"] for lod in manifest["lods"]], ["lod0.ply", "lod1.ply", "lod2.ply"])
+        triangles = [lod["triangles"] for lod in manifest["lods"]]
+        self.assertLessEqual(triangles[0], 100)
+        self.assertLessEqual(triangles[1], 400)
+        self.assertEqual(triangles[2], total)
+        for lod in manifest["lods"]:
+            path = os.path.join(self.out_dir, lod["file"])
+            _, vertex, face = _read_ply(path)
+            self.assertEqual((len(face), lod["bytes"]), (lod["triangles"], os.path.getsize(path)))
+        # The full level decodes back to the input within one quantization step.
+        positions = lod["offset"] + np.stack([vertex["x"], vertex["y"], vertex["z"]], axis=1) * lod["scale"]
+        np.testing.assert_allclose(positions, np.asarray(mesh.vertices), atol=lod["scale"])
+        np.testing.assert_array_equal(face["v"], np.asarray(mesh.triangles))
+
+
+class LazyImportTests(TestCase):
+    """Web workers never load the reconstruction stack (reconstruct.py, import_report)."""
+
+    def test_web_modules_do_not_pull_in_the_3d_stack(self):
+        from django.core.management import call_command
+
+        out = io.StringIO()
+        call_command("import_report", "colorsense.urls", "colorsense.jobs", "colorsense.reconstruct", "--json",
+                     stdout=out)
+        for report in json.loads(out.getvalue()):
+            with self.subTest(module=report["module"]):
+                self.assertIsNone(report["error"])
+                self.assertFalse({"pycolmap", "open3d"} & set(report["pulls_in"]))
+
+
+class PointCloudMeshTests(TestCase):
+    """Meshing degenerate point clouds and the quantized PLY format (reconstruct.py)."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write_cloud(self, points):
+        path = os.path.join(self.directory, "fused.ply")
+        open3d.io.write_point_cloud(path, open3d.geometry.PointCloud(open3d.utility.Vector3dVector(points)))
+        return path
+
+    @unittest.skipIf(open3d is None, "open3d is not installed")
+    def test_degenerate_clouds(self):
+        from .reconstruct import build_mesh, export_lods
+
+        with self.assertRaisesRegex(RuntimeError, "is empty"):
+            build_mesh(self.write_cloud(np.zeros((0, 3))))
+        flat = np.random.default_rng(0).random((60, 3)) * [1, 1, 0]
+        with self.assertRaisesRegex(RuntimeError, "too flat"), self.assertLogs("colorsense.reconstruct", "WARNING"):
+            build_mesh(self.write_cloud(flat))
+
+        # Too sparse for Poisson: an alpha shape, which still exports.
+        sparse = np.random.default_rng(0).random((200, 3))
+        with self.assertLogs("colorsense.reconstruct", "WARNING") as logs:
+            mesh, report = build_mesh(self.write_cloud(sparse))
+        self.assertIn("alpha shape", logs.output[0])
+        self.assertEqual(report["method"], "alpha_shape")
+        manifest = export_lods(mesh, os.path.join(self.directory, "mesh"), (50, 100000))
+        self.assertEqual(manifest["lods"][-1]["triangles"], len(mesh.triangles))
+
+    def test_quantized_ply_round_trip(self):
+        from .reconstruct import write_quantized_ply
+
+        vertices = np.array([[0.0, 0.0, 0.0], [2.0, 0.0, 1.0], [0.0, 4.0, -1.0], [2.0, 4.0, 0.5]])
+        triangles = np.array([[0, 1, 2], [1, 3, 2]])
+        colors = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [0.5, 0.5, 0.5]])
+        path = os.path.join(self.directory, "lod0.ply")
+        quant = write_quantized_ply(path, vertices, triangles, colors)
+        header, vertex, face = _read_ply(path)
+        self.assertEqual(header[:2], ["ply", "format binary_little_endian 1.0"])
+        self.assertIn("element vertex 4", header)
+        self.assertIn("element face 2", header)
+        self.assertEqual(header[2], "comment offset {:.9g} {:.9g} {:.9g} scale {:.9g}".format(
+            *quant["offset"], quant["scale"]))
+        self.assertEqual(os.path.getsize(path), len("\n".join(header)) + 1 + 4 * 9 + 2 * 7)
+        decoded = quant["offset"] + np.stack([vertex["x"], vertex["y"], vertex["z"]], axis=1) * quant["scale"]
+        np.testing.assert_allclose(decoded, vertices, atol=quant["scale"])
+        np.testing.assert_array_equal(face["v"], triangles)
+        self.assertEqual(vertex["red"].tolist(), [255, 0, 0, 128])
+
+        # Past 65535 vertices the face indices widen to 32 bits; without colors vertices are grey.
+        many = np.random.default_rng(0).random((70000, 3))
+        write_quantized_ply(path, many, [[0, 69999, 1]])
+        header, vertex, face = _read_ply(path)
+        self.assertIn("property list uchar uint vertex_indices", header)
+        self.assertEqual((len(vertex), face["v"].tolist(), int(vertex["green"][0])), (70000, [[0, 69999, 1]], 200))
+
+
+class ImageStoreTests(TransactionTestCase):
+    """The content-addressed upload store (image_store.py); transactional so a second thread sees the rows."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings = override_settings(COLORSENSE_IMAGE_STORE={"ROOT": self.root})
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_purge_cannot_unlink_an_image_being_stored(self):
+        from django.db import connection
+        from . import image_store
+        from .models import StoredImage
+
+        data = _png("green")
+        image_id = image_store.put(data, "image/png")
+        StoredImage.objects.filter(id=image_id).update(last_used=timezone.now() - timedelta(days=2))
+        exists = os.path.exists
+        purged = []
+
+        def purge():
+            try:
+                purged.append(image_store.purge(ttl=3600))
+            finally:
+                connection.close()
+
+        def racing_exists(path):
+            # The purge starts right after put found the file on disk.
+            found = exists(path)
+            if path.endswith(image_id) and not purged and not thread.is_alive():
+                thread.start()
+                time.sleep(0.1)
+            return found
+
+        thread = threading.Thread(target=purge)
+        with mock.patch("colorsense.image_store.os.path.exists", side_effect=racing_exists):
+            image_store.put(data, "image/png")
+        thread.join(5)
+        self.assertEqual(purged, [0])
+        self.assertEqual(image_store.load(image_id), (data, "image/png"))
+
+        # Once it really is stale both the row and the file go.
+        StoredImage.objects.filter(id=image_id).update(last_used=timezone.now() - timedelta(days=2))
+        self.assertEqual(image_store.purge(ttl=3600), 1)
+        with self.assertRaises(LookupError):
+            image_store.load(image_id)
@@ -0,0 +1,470 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import metrics, workspace
+from .conf import setting
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX hosts run without part-file locks
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+# Resumable chunked uploads of photo sets for reconstruction.
+#
+# A client opens a session, registers each file with its size, then PUTs the
+# bytes in order with a Content-Range header; a dropped connection resumes
+# from the offset the server reports. Chunks are appended to a part file as
+# they are read from the request, never buffered whole, and hashed on the way
+# in. A finished file's header is parsed with Pillow (no pixel decoding) and
+# the file moves into a content-addressed blob store, hard-linked into the
+# session's staging workspace as <index>_<digest><ext> like stage_uploads()
+# names them. Identical photos are stored once across uploads, and a client
+# that sends a file's sha256 up front skips uploading bytes the server has.
+#
+# While later files are still arriving, completed ones are handed to the
+# reconstruction pool in batches for feature extraction (jobs.submit_extraction);
+# the features stage then only extracts what is left. Completing the session
+# closes it; its reconstruction job moves the staging directory into the
+# content-addressed workspace (jobs.run_job), so the request never waits for
+# an extraction batch.
+#
+#   <root>/.uploads/<session>/<index>.part   bytes received so far
+#   <root>/.staging/<session>/images/        finished files (hard links)
+#   <root>/.blobs/<digest[:2]>/<digest>      deduplicated originals
+
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "TIFF": ".tif", "BMP": ".bmp", "MPO": ".jpg"}
+_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"II*\x00", b"MM\x00*", b"BM")
+
+
+class UploadError(ValueError):
+    """A rejected upload request; ``status`` is the HTTP status, ``offset`` the bytes the server has."""
+
+    def __init__(self, message: str, status: int = 400, offset: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_UPLOADS", {}) or {}
+    return {
+        "chunk_size": int(conf.get("CHUNK_SIZE", 8 * 1024 * 1024)),
+        "max_chunk": int(conf.get("MAX_CHUNK", 32 * 1024 * 1024)),
+        "max_file": int(float(conf.get("MAX_FILE_MB", 200)) * 1024 * 1024),
+        "max_files": int(conf.get("MAX_FILES", 1000)),
+        "max_pixels": int(conf.get("MAX_PIXELS", 100_000_000)),
+        "formats": tuple(conf.get("FORMATS") or ("JPEG", "PNG", "WEBP", "TIFF", "BMP", "MPO")),
+        "extract_batch": int(conf.get("EXTRACT_BATCH", 8)),
+        "ttl": float(conf.get("TTL_HOURS", 24)) * 3600,
+        "gc_interval": float(conf.get("GC_INTERVAL", 3600)),
+    }
+
+
+def _session_dir(session_id: str) -> str:
+    return os.path.join(workspace.workspace_root(), ".uploads", session_id)
+
+
+def _staging_dir(session_id: str) -> str:
+    return os.path.join(workspace.workspace_root(), ".staging", session_id)
+
+
+def _part_path(session_id: str, index: int) -> str:
+    return os.path.join(_session_dir(session_id), f"{index}.part")
+
+
+def _blob_path(digest: str) -> str:
+    return os.path.join(workspace.workspace_root(), ".blobs", digest[:2], digest)
+
+
+def parse_content_range(value: str) -> Tuple[int, int, int]:
+    """``(start, end, total)`` from ``bytes start-end/total`` (end inclusive)."""
+    match = _RANGE_RE.match((value or "").strip())
+    if not match:
+        raise UploadError("Expected a 'Content-Range: bytes <start>-<end>/<total>' header.")
+    start, end, total = (int(v) for v in match.groups())
+    if end < start or end >= total:
+        raise UploadError("Invalid Content-Range.")
+    return start, end, total
+
+
+def create_session():
+    from .models import UploadSession
+
+    maybe_purge()
+    session = UploadSession.objects.create(id=uuid.uuid4().hex)
+    os.makedirs(_session_dir(session.id), exist_ok=True)
+    os.makedirs(os.path.join(_staging_dir(session.id), "images"), exist_ok=True)
+    return session
+
+
+def get_session(session_id: str):
+    """Upload session by id; raises LookupError for unknown or expired sessions."""
+    from .models import UploadSession
+
+    if not _ID_RE.match(session_id or ""):
+        raise LookupError("Unknown upload.")
+    try:
+        return UploadSession.objects.get(id=session_id)
+    except UploadSession.DoesNotExist:
+        raise LookupError("Unknown upload.")
+
+
+def get_file(session, index: int):
+    from .models import UploadFile
+
+    try:
+        return session.files.get(index=index)
+    except UploadFile.DoesNotExist:
+        raise LookupError("Unknown file.")
+
+
+def offset(upload_file) -> int:
+    """Bytes the server has for ``upload_file`` (its full size once finished)."""
+    if upload_file.status != upload_file.PENDING:
+        return upload_file.size
+    try:
+        return os.path.getsize(_part_path(upload_file.session_id, upload_file.index))
+    except FileNotFoundError:
+        return 0
+
+
+def _file_payload(upload_file) -> Dict[str, Any]:
+    return {
+        "file": upload_file.index,
+        "name": upload_file.name,
+        "size": upload_file.size,
+        "offset": offset(upload_file),
+        "status": upload_file.status,
+        "digest": upload_file.digest or None,
+        "error": upload_file.error or None,
+    }
+
+
+def session_payload(session) -> Dict[str, Any]:
+    """Session state for resuming: every file with the offset to continue from."""
+    return {
+        "upload": session.id,
+        "status": session.status,
+        "job": session.job_id or None,
+        "chunk_size": _options()["chunk_size"],
+        "files": [_file_payload(f) for f in session.files.all()],
+    }
+
+
+def add_file(session, name: str, size: int, sha256: str = "") -> Dict[str, Any]:
+    """
+    Register the next file of ``session``. With a ``sha256`` the server already
+    has, the file is attached from the blob store and needs no bytes at all.
+    """
+    from django.db import IntegrityError, transaction
+    from django.db.models import Max
+    from .models import UploadFile, UploadSession
+
+    opts = _options()
+    if session.status != UploadSession.OPEN:
+        raise UploadError("This upload is already complete.", status=409)
+    if size <= 0 or size > opts["max_file"]:
+        raise UploadError(f"Files must be between 1 byte and {opts['max_file'] // (1024 * 1024)} MB.", status=413)
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                count = session.files.count()
+                if count >= opts["max_files"]:
+                    raise UploadError(f"At most {opts['max_files']} files per upload.", status=413)
+                last = session.files.aggregate(n=Max("index"))["n"]
+                index = 0 if last is None else last + 1
+                upload_file = UploadFile.objects.create(session=session, index=index, name=(name or "")[:255],
+                                                        size=size)
+            break
+        except IntegrityError:
+            # Two registrations raced for the same index; take the next one.
+            continue
+    else:
+        raise UploadError("Could not register the file; please retry.", status=409)
+
+    sha256 = (sha256 or "").lower()
+    if _DIGEST_RE.match(sha256) and os.path.exists(_blob_path(sha256)):
+        with metrics.span("upload.finalize"):
+            _finish(session, upload_file, sha256, None)
+    return _file_payload(upload_file)
+
+
+_hashers: Dict[str, Tuple[int, Any]] = {}
+_hashers_lock = threading.Lock()
+
+
+def _hasher(path: str, received: int):
+    """The running sha256 of a part file; rebuilt from disk after a restart or on another worker."""
+    with _hashers_lock:
+        entry = _hashers.pop(path, None)
+    if entry is not None and entry[0] == received:
+        return entry[1]
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(block)
+    return h
+
+
+def write_chunk(session, upload_file, content_range: str, stream, length: int) -> Dict[str, Any]:
+    """
+    Append the chunk in ``stream`` (``length`` bytes, read in small pieces) at the
+    offset given by ``content_range``, which must be where the file left off.
+    A connection that drops mid-chunk keeps the bytes that arrived.
+    """
+    from django.utils import timezone
+    from .models import UploadSession
+
+    opts = _options()
+    if session.status != UploadSession.OPEN:
+        raise UploadError("This upload is already complete.", status=409)
+    if upload_file.status != upload_file.PENDING:
+        return _file_payload(upload_file)
+    start, end, total = parse_content_range(content_range)
+    if total != upload_file.size:
+        raise UploadError(f"This file was registered as {upload_file.size} bytes.")
+    if end - start + 1 != length:
+        raise UploadError("Content-Length does not match Content-Range.")
+    if length > opts["max_chunk"]:
+        raise UploadError(f"Chunks are limited to {opts['max_chunk']} bytes.", status=413)
+
+    path = _part_path(session.id, upload_file.index)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with metrics.span("upload.chunk"), open(path, "ab") as fh:
+        if fcntl is not None:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise UploadError("Another chunk of this file is being written.", status=409)
+        received = fh.tell()
+        if start != received:
+            raise UploadError(f"Expected the chunk at offset {received}.", status=409, offset=received)
+        h = _hasher(path, received)
+        remaining = length
+        first = received == 0
+        try:
+            while remaining:
+                piece = stream.read(min(remaining, 256 * 1024))
+                if not piece:
+                    break
+                if first:
+                    first = False
+                    if len(piece) >= 12 and not (piece.startswith(_SIGNATURES) or piece[8:12] == b"WEBP"):
+                        upload_file.status = upload_file.INVALID
+                        upload_file.error = "Not a supported image file."
+                        upload_file.save(update_fields=["status", "error"])
+                        raise UploadError(upload_file.error, status=415)
+                fh.write(piece)
+                h.update(piece)
+                remaining -= len(piece)
+        finally:
+            fh.flush()
+            received = fh.tell()
+            with _hashers_lock:
+                _hashers[path] = (received, h)
+    UploadSession.objects.filter(id=session.id).update(updated_at=timezone.now())
+
+    if received == upload_file.size:
+        with _hashers_lock:
+            _hashers.pop(path, None)
+        with metrics.span("upload.finalize"):
+            _finish(session, upload_file, h.hexdigest(), path)
+    elif remaining:
+        raise UploadError("The connection closed before the chunk was complete.", offset=received)
+    return _file_payload(upload_file)
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    """Format and size from the image header, without decoding pixels; raises UploadError if it is not an image."""
+    from PIL import Image
+
+    opts = _options()
+    try:
+        with Image.open(path) as img:
+            fmt, (width, height) = img.format, img.size
+    except Exception:
+        raise UploadError("Not a readable image.", status=415)
+    if fmt not in opts["formats"] or fmt not in _EXTENSIONS:
+        raise UploadError(f"Unsupported image format {fmt}.", status=415)
+    if width * height > opts["max_pixels"]:
+        raise UploadError(f"Image is too large ({width}x{height}).", status=413)
+    return {"format": fmt, "width": width, "height": height}
+
+
+def _link(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        # No hard links here (e.g. another filesystem); fall back to a copy.
+        shutil.copyfile(source, target)
+
+
+def _finish(session, upload_file, digest: str, part_path: Optional[str]) -> None:
+    """Validate a complete file, move it into the blob store and link it into the staging workspace."""
+    blob = _blob_path(digest)
+    source = part_path or blob
+    try:
+        header = read_header(source)
+    except UploadError as e:
+        upload_file.status = upload_file.INVALID
+        upload_file.error = str(e)[:255]
+        upload_file.save(update_fields=["status", "error"])
+        if part_path:
+            os.remove(part_path)
+        raise
+
+    if part_path:
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            os.remove(part_path)
+        else:
+            os.replace(part_path, blob)
+    os.utime(blob, None)
+
+    upload_file.digest = digest
+    upload_file.format = header["format"]
+    upload_file.width = header["width"]
+    upload_file.height = header["height"]
+    if session.files.filter(digest=digest, status=upload_file.DONE).exclude(pk=upload_file.pk).exists():
+        upload_file.status = upload_file.DUPLICATE
+    else:
+        upload_file.status = upload_file.DONE
+        images = os.path.join(_staging_dir(session.id), "images")
+        os.makedirs(images, exist_ok=True)
+        _link(blob, os.path.join(images, f"{upload_file.index:05d}_{digest}{_EXTENSIONS[header['format']]}"))
+    upload_file.save(update_fields=["digest", "format", "width", "height", "status"])
+
+    batch = _options()["extract_batch"]
+    if upload_file.status == upload_file.DONE and batch > 0:
+        done = session.files.filter(status=upload_file.DONE).count()
+        if done % batch == 0:
+            from . import jobs
+            jobs.submit_extraction(_staging_dir(session.id))
+
+
+def complete(session) -> Tuple[str, str]:
+    """
+    Close ``session``; returns ``(work_dir, staging)``, the content-addressed
+    workspace its files belong in and the staging directory holding them for
+    the reconstruction job to move over. Until a job is recorded on the session,
+    completing again returns the same paths, so a failed job start can be retried.
+    """
+    from .models import UploadSession
+
+    if session.job_id:
+        raise UploadError("This upload is already complete.", status=409)
+    files = list(session.files.all())
+    pending = [f.index for f in files if f.status == f.PENDING]
+    if pending:
+        raise UploadError(f"{len(pending)} file(s) are not finished.", status=409)
+    staging = _staging_dir(session.id)
+    images = os.path.join(staging, "images")
+    digests: List[str] = []
+    for f in files:
+        if f.status != f.DONE:
+            continue
+        if f.digest in digests:
+            # Finished concurrently with an identical file; keep the first.
+            f.status = f.DUPLICATE
+            f.save(update_fields=["status"])
+            try:
+                os.remove(os.path.join(images, f"{f.index:05d}_{f.digest}{_EXTENSIONS.get(f.format, '.jpg')}"))
+            except FileNotFoundError:
+                pass
+            continue
+        digests.append(f.digest)
+    if not digests:
+        raise UploadError("No valid images were uploaded.")
+
+    UploadSession.objects.filter(id=session.id).update(status=UploadSession.COMPLETE)
+    session.status = UploadSession.COMPLETE
+    shutil.rmtree(_session_dir(session.id), ignore_errors=True)
+    return os.path.join(workspace.workspace_root(), workspace.set_digest(digests)), staging
+
+
+def discard_staging(staging: str) -> None:
+    """
+    Delete a completed upload's staging directory that no job will take over
+    (its workspace already has a mesh or a job), in the background once no
+    extraction batch holds it.
+    """
+    def discard():
+        try:
+            with workspace.locked(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Discarding upload staging %s failed", staging)
+
+    threading.Thread(target=discard, name="colorsense-discard-staging", daemon=True).start()
+
+
+def purge(ttl: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Drop sessions idle for ``ttl`` seconds (default TTL_HOURS) with their parts
+    and staging files, and blobs no workspace links to any more. Returns
+    ``(sessions, blobs)`` removed.
+    """
+    from django.utils import timezone
+    from .models import UploadSession
+
+    ttl = _options()["ttl"] if ttl is None else ttl
+    stale = list(UploadSession.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=ttl))
+                 .values_list("id", "status"))
+    for session_id, status in stale:
+        shutil.rmtree(_session_dir(session_id), ignore_errors=True)
+        if status == UploadSession.OPEN:
+            shutil.rmtree(_staging_dir(session_id), ignore_errors=True)
+    UploadSession.objects.filter(id__in=[session_id for session_id, _ in stale]).delete()
+    with _hashers_lock:
+        for path in [p for p in _hashers if not os.path.exists(p)]:
+            del _hashers[path]
+
+    removed = 0
+    cutoff = time.time() - ttl
+    for dirpath, _, filenames in os.walk(os.path.join(workspace.workspace_root(), ".blobs")):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+                if st.st_nlink <= 1 and st.st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return len(stale), removed
+
+
+_last_purge: Optional[float] = None
+_purge_lock = threading.Lock()
+
+
+def maybe_purge() -> None:
+    global _last_purge
+    interval = _options()["gc_interval"]
+    with _purge_lock:
+        if _last_purge is not None and time.monotonic() - _last_purge < interval:
+            return
+        _last_purge = time.monotonic()
+    try:
+        purge()
+    except Exception:
+        logger.exception("Upload purge failed")
@@ -6,7 +6,23 @@ urlpatterns = [
     path('upload/', views.upload, name='upload'),
     path('api/agent/', views.agent_api, name='colorsense_agent_api'),
     path('upload_images/', views.upload_images, name='upload_images'),
+    path('reconstruct/<str:job_id>/', views.reconstruction_viewer, name='reconstruction_viewer'),
+    path('api/uploads/', views.upload_session, name='upload_session'),
+    path('api/uploads/<str:upload_id>/', views.upload_status, name='upload_status'),
+    path('api/uploads/<str:upload_id>/files/', views.upload_file, name='upload_file'),
+    path('api/uploads/<str:upload_id>/files/<int:index>/', views.upload_chunk, name='upload_chunk'),
+    path('api/uploads/<str:upload_id>/complete/', views.upload_complete, name='upload_complete'),
+    path('api/reconstruct/<str:job_id>/', views.reconstruction_status, name='reconstruction_status'),
     path('api/agent/confirm/', views.confirm_suggestion, name='confirm_suggestion'),
+    path('api/agent/confirm/stream/', views.confirm_suggestion_stream, name='confirm_suggestion_stream'),
+    path('api/preview/', views.wall_preview, name='wall_preview'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('api/consultations/<str:public_id>/', views.consultation_replay, name='consultation_replay'),
+    path('api/consultations/<str:public_id>/feedback/', views.consultation_feedback, name='consultation_feedback'),
+    path('review/queue/', views.review_queue, name='review_queue'),
+    path('review/<int:consultation_id>/', views.review_detail, name='review_detail'),
+    path('review/<int:consultation_id>/approve/', views.review_approve, name='review_approve'),
+    path('review/<int:consultation_id>/reject/', views.review_reject, name='review_reject'),
     #path('review/', views.review_suggestion, name='review_suggestion'),
     # User review flow
 ]
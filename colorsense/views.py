@@ -1,72 +1,338 @@
-from django.shortcuts import render, redirect
-from django.http import JsonResponse, HttpResponseBadRequest
-from django.views.decorators.http import require_POST
+from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_POST, require_http_methods
 from django.views.decorators.csrf import ensure_csrf_cookie
-from .agent import run_agent, summrise_input, paint_suggestion
-from .reconstruct import reconstruct_3d, pointcloud_to_textured_mesh
+from django.contrib.admin.views.decorators import staff_member_required
+from .agent import asummrise_input, apaint_suggestion, astream_paint_suggestion
+from .streaming import sse_event
+from .models import Consultation
+from . import agent, history, image_store, jobs, metrics, reflection, uploads, workspace
+from asgiref.sync import sync_to_async
 from django.conf import settings
 import os
+import re
+import secrets
 import time
-import pdb
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Anonymous visitors get a random id cookie so their preference profile (reflection.py)
+# survives across requests; signed-in users are keyed by their user id.
+PROFILE_COOKIE = "colorsense_profile"
+_PROFILE_COOKIE_RE = re.compile(r"^[0-9a-f]{32}$")
 
 @ensure_csrf_cookie
 def index(request):
     """Render the chat UI."""
-    return render(request, "colorsense/index.html")
+    response = render(request, "colorsense/index.html")
+    if not _PROFILE_COOKIE_RE.match(request.COOKIES.get(PROFILE_COOKIE, "")):
+        response.set_cookie(PROFILE_COOKIE, secrets.token_hex(16), max_age=365 * 24 * 3600, httponly=True,
+                            samesite="Lax")
+    return response
+
+async def _profile_key(request):
+    """Preference profile key for the requester, or "" when there is nothing to key it on."""
+    user = await request.auser()
+    if user.is_authenticated:
+        return f"user:{user.pk}"
+    cookie = request.COOKIES.get(PROFILE_COOKIE, "")
+    return f"anon:{cookie}" if _PROFILE_COOKIE_RE.match(cookie) else ""
+
+async def _preferences(request):
+    """The requester's profile summary for a suggestion prompt ("" without a profile)."""
+    if not reflection.enabled():
+        return ""
+    key = await _profile_key(request)
+    if not key:
+        return ""
+    try:
+        return await sync_to_async(reflection.summary)(key)
+    except Exception:
+        logger.exception("Preference profile lookup failed")
+        return ""
+
+async def _history(kind, provider, user_text, images, docs, review, preferences=""):
+    """
+    ``(replayed, save)`` for a chat request: the stored answer to an identical
+    earlier request (None when there is none, or when review is requested), and
+    an async ``save(result)`` that records this one and returns its id and status.
+    """
+    if not history.enabled():
+        async def skip(result):
+            return {}
+        return None, skip
+
+    digests = history.image_digests(images)
+    docs_text, docs_digest = await sync_to_async(history.read_docs)(docs) if docs else ("", "")
+    key = history.request_key(kind, provider, user_text, digests, docs_digest, preferences)
+    replayed = None if review else await sync_to_async(history.replay)(key)
+
+    async def save(result):
+        try:
+            consultation = await sync_to_async(history.record)(kind, provider, user_text, digests, docs_text,
+                                                               result, key, review=review)
+        except Exception:
+            logger.exception("Could not record consultation")
+            return {}
+        return {"consultation": consultation.public_id, "status": consultation.status}
+
+    return replayed, save
 
 @require_POST
-def agent_api(request):
+async def agent_api(request):
     """
     Accepts multipart/form-data with fields:
     - message: str
     - images: multiple image files
     - docs: multiple text files (.txt/.md)
-    Returns JSON with 'reply' and 'swatches'.
+    Returns JSON with 'reply', 'swatches' and 'image_ids'.
+
+    Images are preprocessed once and kept in the image store; the confirm
+    endpoints take the returned 'image_ids' instead of the image data.
+
+    Answers are recorded (see history.py) and an identical request is answered
+    from the record; 'consultation' in the response is its replay id.
+
+    Async so the provider round trip does not hold a worker thread under ASGI;
+    if the client disconnects the view task is cancelled along with its calls.
     """
     message = request.POST.get("message", "").strip()
     images = request.FILES.getlist("images") or []
     docs = request.FILES.getlist("docs") or []
     provider = request.POST.get("provider", "groq")
+    review = request.POST.get("review", "false").strip().lower() == "true"
     if not message and not images and not docs:
         return HttpResponseBadRequest("Please provide a message, image(s), or document(s).")
 
     try:
-        # Run the agent workflow
-        result = summrise_input(user_text=message, image_uploads=images, doc_uploads=docs, provider=provider)
-        print(result)
+        refs, _ = await sync_to_async(image_store.store_uploads)(images)
+    except ValueError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+    try:
+        result, save = await _history(Consultation.SUMMARY, provider, message, refs, docs, review)
+        if result is None:
+            # Run the agent workflow
+            result = await asummrise_input(user_text=message, image_uploads=refs, doc_uploads=docs, provider=provider)
+            result.update(await save(result))
         return JsonResponse({
             "ok": True,
             "reply": result.get("reply", ""),
             "swatches": result.get("swatches", []),
+            "paints": result.get("paints", {}),
+            "errors": result.get("errors", []),
+            "image_ids": [ref.id for ref in refs],
+            "consultation": result.get("consultation"),
+            "status": result.get("status"),
+            "replayed": result.get("replayed", False),
         })
     except Exception as e:
         return JsonResponse({"ok": False, "error": str(e)}, status=500)
 
+def _confirm_images(request):
+    """Images for the confirm endpoints: stored 'image_ids', plus any legacy data URLs in 'images'."""
+    refs = [image_store.ImageRef(image_id) for image_id in request.POST.getlist("image_ids") if image_id]
+    return refs + [url for url in request.POST.getlist("images") if url.startswith(("data:image/", "http"))]
+
 @require_POST
-def confirm_suggestion(request):
-    """Handle user confirmation of the suggestion."""
+async def confirm_suggestion(request):
+    """
+    Handle user confirmation of the room summary by asking for paint
+    suggestions, with the requester's preference profile in the prompt. The
+    response carries the suggestion's 'consultation' id for
+    consultation_feedback.
+    """
     confirm = request.POST.get("confirm", "false").strip().lower()
     if confirm == "true":
+        preferences = await _preferences(request)
         room_description = request.POST.get("room_description", "").strip()
-        print(room_description)
-        images = request.POST.getlist("images") or []
+        try:
+            images = _confirm_images(request)
+        except ValueError as e:
+            return JsonResponse({"ok": False, "error": str(e)}, status=400)
         docs = []
-        # Run the agent workflow
-        result = paint_suggestion(user_text=room_description, image_uploads=images, doc_uploads=docs)
+        provider = request.POST.get("provider", "groq")
+        review = request.POST.get("review", "false").strip().lower() == "true"
+        result, save = await _history(Consultation.SUGGESTION, provider, room_description, images, docs, review,
+                                      preferences)
+        if result is None:
+            # Run the agent workflow
+            try:
+                result = await apaint_suggestion(user_text=room_description, image_uploads=images, doc_uploads=docs,
+                                                 provider=provider, preferences=preferences)
+            except LookupError as e:
+                return JsonResponse({"ok": False, "error": str(e)}, status=410)
+            result.update(await save(result))
         #result = parse_response(result['reply'])
-        print(result)
-        return JsonResponse({"ok": True, "message": "Suggestion confirmed.", "reply": result})
+        return JsonResponse({"ok": True, "message": "Suggestion confirmed.", "reply": result,
+                             "consultation": result.get("consultation")})
     else:
         return JsonResponse({"ok": False, "message": "Suggestion rejected."})
 
+@require_POST
+async def confirm_suggestion_stream(request):
+    """
+    Streaming variant of confirm_suggestion. Responds with Server-Sent Events:
+    'color' for each recommended color as soon as it is complete, 'error' for
+    images that failed, and a final 'done' carrying the full reply, swatches
+    and 'consultation' id.
+    """
+    confirm = request.POST.get("confirm", "false").strip().lower()
+    if confirm != "true":
+        return JsonResponse({"ok": False, "message": "Suggestion rejected."})
+    preferences = await _preferences(request)
+    room_description = request.POST.get("room_description", "").strip()
+    provider = request.POST.get("provider", "groq")
+    review = request.POST.get("review", "false").strip().lower() == "true"
+    try:
+        images = _confirm_images(request)
+    except ValueError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+    replayed, save = await _history(Consultation.SUGGESTION, provider, room_description, images, [], review,
+                                    preferences)
+
+    async def events():
+        if replayed is not None:
+            yield sse_event("done", replayed)
+            return
+        try:
+            async for event, data in astream_paint_suggestion(user_text=room_description, image_uploads=images,
+                                                              doc_uploads=[], provider=provider,
+                                                              preferences=preferences):
+                if event == "done":
+                    data.update(await save(data))
+                yield sse_event(event, data)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@require_POST
+def wall_preview(request):
+    """
+    Recolor the wall of a stored image to each suggested color.
+    Fields: image_id (or an 'image' upload), hex (repeated, up to 8) and an
+    optional x/y hint point on the wall in 0..1 image fractions.
+    """
+    from .preview import render_previews
+
+    hexes = [h for h in request.POST.getlist("hex") if h][:8]
+    if not hexes:
+        return HttpResponseBadRequest("Please provide at least one hex color.")
+    hint = None
+    try:
+        if request.POST.get("x") and request.POST.get("y"):
+            hint = (float(request.POST["x"]), float(request.POST["y"]))
+        if "image" in request.FILES:
+            refs, _ = image_store.store_uploads([request.FILES["image"]])
+            if not refs:
+                return HttpResponseBadRequest("Please upload an image.")
+            image_id = refs[0].id
+        else:
+            image_id = image_store.ImageRef(request.POST.get("image_id", "")).id
+        data, _ = image_store.load(image_id)
+        result = render_previews(image_id, data, hexes, hint)
+    except LookupError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=410)
+    except ValueError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=500)
+    return JsonResponse(dict(result, ok=True, image_id=image_id))
+
+
+@require_GET
+def consultation_replay(request, public_id):
+    """A past consultation's result, as first returned, without calling the provider."""
+    try:
+        consultation = history.get(public_id)
+    except LookupError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=404)
+    return JsonResponse(dict(history.payload(consultation, replayed=True), ok=True))
+
+
+@require_POST
+async def consultation_feedback(request, public_id):
+    """
+    Accept or reject a paint suggestion ('accepted': true/false). Its
+    recommended colors train the requester's preference profile (reflection.py).
+    'learned' is false when there was nothing to learn from, e.g. a summary or
+    a verdict already recorded for this consultation.
+    """
+    accepted = request.POST.get("accepted", "").strip().lower()
+    if accepted not in ("true", "false"):
+        return JsonResponse({"ok": False, "error": "Send accepted=true or accepted=false."}, status=400)
+    try:
+        await sync_to_async(history.get)(public_id)
+    except LookupError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=404)
+    key = await _profile_key(request)
+    if not key or not reflection.enabled():
+        return JsonResponse({"ok": True, "learned": False})
+    learned = await sync_to_async(reflection.record_feedback)(key, accepted == "true", consultation_id=public_id)
+    return JsonResponse({"ok": True, "learned": learned})
+
+
+@staff_member_required
+def review_queue(request):
+    """
+    Consultations awaiting review, newest first (?status= for the other states,
+    ?color=#RRGGBB for those recommending a color), one keyset page at a time.
+    """
+    status = request.GET.get("status", Consultation.PENDING)
+    if status not in dict(Consultation.STATUSES):
+        return HttpResponseBadRequest("Unknown status.")
+    try:
+        pending, next_cursor = history.page(status=status, cursor=request.GET.get("cursor"),
+                                            color=request.GET.get("color"))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return render(request, "colorsense/review_queue.html", {
+        "pending": pending,
+        "status": status,
+        "statuses": Consultation.STATUSES,
+        "color": request.GET.get("color", ""),
+        "next_cursor": next_cursor,
+    })
+
+
+@staff_member_required
+def review_detail(request, consultation_id):
+    s = get_object_or_404(Consultation, pk=consultation_id)
+    return render(request, "colorsense/review_detail.html", {"s": s})
+
+
+def _review(request, consultation_id, approve):
+    consultation = get_object_or_404(Consultation, pk=consultation_id)
+    if approve:
+        history.review(consultation, True, request.user, reply=request.POST.get("reply"),
+                       swatches_text=request.POST.get("swatches_text"), notes=request.POST.get("review_notes", ""))
+    else:
+        history.review(consultation, False, request.user, notes=request.POST.get("review_notes", ""))
+    return redirect("review_queue")
+
+
+@staff_member_required
+@require_POST
+def review_approve(request, consultation_id):
+    return _review(request, consultation_id, True)
+
+
+@staff_member_required
+@require_POST
+def review_reject(request, consultation_id):
+    return _review(request, consultation_id, False)
+
 
 def parse_response(response):
     try:
-        recomendation = json.loads(response)
-        print(recomendation)
-        #breakpoint()
-        return recomendation
+        return json.loads(response)
     except json.JSONDecodeError:
         return None
 
@@ -76,22 +342,196 @@ def upload(request):
 def upload_images(request):
     if request.method == "POST":
         files = request.FILES.getlist("images")
-        folder = os.path.join(settings.MEDIA_ROOT, "user_images")
-        os.makedirs(folder, exist_ok=True)
 
-        # Save images
-        for f in files:
-            img_path = os.path.join(folder, f.name)
-            with open(img_path, "wb+") as destination:
-                for chunk in f.chunks():
-                    destination.write(chunk)
+        # Each upload set gets its own workspace keyed on the image contents
+        staging, digest = workspace.stage_uploads(files)
+        work_dir = workspace.open_workspace(digest, staging)
+        return redirect("reconstruction_viewer", job_id=_start_job(work_dir))
+
+    return render(request, "colorsense/upload.html")
+
+
+def _start_job(work_dir, staging=None):
+    """
+    Job id reconstructing ``work_dir``: a finished one for a cached mesh, a running
+    one, or a new one. A new job first moves the images over from ``staging``.
+    """
+    image_dir = os.path.join(work_dir, "images")
+    mesh_path = os.path.join(work_dir, "mesh", "manifest.json")
+
+    if workspace.is_done(work_dir, "mesh") and os.path.exists(mesh_path):
+        # Identical upload: serve the cached mesh straight away
+        if staging:
+            uploads.discard_staging(staging)
+        return jobs.create_job(image_dir, work_dir, mesh_path, status=jobs.DONE)
+    job_id = jobs.find_active_job(work_dir)
+    if job_id is None:
+        # Run reconstruction pipeline in the background; the viewer polls for the mesh
+        job_id = jobs.create_job(os.path.join(staging, "images") if staging else image_dir, work_dir, mesh_path)
+        jobs.submit(job_id)
+    elif staging:
+        uploads.discard_staging(staging)
+    return job_id
+
+
+def _upload_error(e):
+    body = {"ok": False, "error": str(e)}
+    if getattr(e, "offset", None) is not None:
+        body["offset"] = e.offset
+    return JsonResponse(body, status=getattr(e, "status", 400))
+
+
+@require_POST
+def upload_session(request):
+    """
+    Start a resumable upload (see uploads.py). Returns 'upload' (the session id)
+    and 'chunk_size', the chunk length clients should send.
+    """
+    session = uploads.create_session()
+    return JsonResponse(dict(uploads.session_payload(session), ok=True), status=201)
+
+
+@require_GET
+def upload_status(request, upload_id):
+    """Every file of an upload with its status and the offset to resume from."""
+    try:
+        session = uploads.get_session(upload_id)
+    except LookupError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=404)
+    return JsonResponse(dict(uploads.session_payload(session), ok=True))
+
+
+@require_POST
+def upload_file(request, upload_id):
+    """
+    Register the next file: JSON or form fields 'name', 'size' and optionally
+    'sha256'. A file whose sha256 the server already has comes back as done
+    and needs no chunks.
+    """
+    try:
+        data = json.loads(request.body) if request.content_type == "application/json" else request.POST
+        session = uploads.get_session(upload_id)
+        result = uploads.add_file(session, str(data.get("name", "")), int(data.get("size", 0)),
+                                  str(data.get("sha256") or ""))
+    except LookupError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=404)
+    except (TypeError, ValueError) as e:
+        return _upload_error(e)
+    return JsonResponse(dict(result, ok=True), status=201)
+
+
+@require_http_methods(["PUT"])
+def upload_chunk(request, upload_id, index):
+    """
+    Append one chunk: the raw bytes as the body, positioned by 'Content-Range:
+    bytes <start>-<end>/<size>'. The body is streamed to disk, not buffered.
+    A chunk that does not start at the file's current offset gets 409 with
+    'offset' so the client can resume from there.
+    """
+    try:
+        session = uploads.get_session(upload_id)
+        result = uploads.write_chunk(session, uploads.get_file(session, index), request.headers.get("Content-Range"),
+                                     request, int(request.META.get("CONTENT_LENGTH") or 0))
+    except LookupError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=404)
+    except ValueError as e:
+        return _upload_error(e)
+    return JsonResponse(dict(result, ok=True))
+
+
+@require_POST
+def upload_complete(request, upload_id):
+    """
+    Finish an upload and start (or reuse) its reconstruction; returns the job id
+    and viewer URL. Safe to retry: a session completed without a job gets one.
+    """
+    try:
+        session = uploads.get_session(upload_id)
+        if session.job_id:
+            job_id = session.job_id
+        else:
+            job_id = _start_job(*uploads.complete(session))
+            session.job_id = job_id
+            session.save(update_fields=["job_id", "updated_at"])
+    except LookupError as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=404)
+    except ValueError as e:
+        return _upload_error(e)
+    return JsonResponse({"ok": True, "job": job_id, "url": reverse("reconstruction_viewer", args=[job_id])})
+
+
+def _job_payload(job):
+    lods = []
+    error = job["error"]
+    if job["status"] == jobs.DONE and not os.path.exists(job["mesh_path"] or ""):
+        error = "This reconstruction has been evicted; please upload the images again."
+    elif job["status"] == jobs.DONE:
+        workspace.touch(job["work_dir"])
+        with open(job["mesh_path"]) as fh:
+            manifest = json.load(fh)
+        mesh_dir = os.path.relpath(os.path.dirname(job["mesh_path"]), settings.MEDIA_ROOT).replace(os.sep, "/")
+        for lod in manifest["lods"]:
+            lods.append(dict(lod, url=f"{settings.MEDIA_URL}{mesh_dir}/{lod['file']}"))
+    return {
+        "ok": True,
+        "id": job["id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "timings": job["timings"],
+        "stages": {stage: workspace.stage_info(job["work_dir"], stage)
+                   for stage in workspace.STAGES if workspace.is_done(job["work_dir"], stage)},
+        "error": error,
+        # Coarse to fine; the viewer shows the first and refines.
+        "lods": lods,
+    }
+
+
+def reconstruction_status(request, job_id):
+    """Poll endpoint: job status, current stage and per-stage timings in seconds."""
+    job = jobs.get_job(job_id)
+    if job is None:
+        return JsonResponse({"ok": False, "error": "Unknown job."}, status=404)
+    return JsonResponse(_job_payload(job))
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition: span and request histograms, provider token
+    counts, plus cache, coalescing, retry and connection-pool counters. Requires
+    ``Authorization: Bearer <COLORSENSE_METRICS['TOKEN']>`` when a token is set.
+    """
+    if not metrics.authorized(request):
+        return HttpResponse(status=401)
 
-        # Run reconstruction pipeline
-        ply_path = reconstruct_3d(folder)
-        mesh_path = pointcloud_to_textured_mesh(ply_path)
+    extra = {}
+    for name, value in agent.coalescing_stats().items():
+        extra[f"colorsense_coalescing_{name}"] = value
+    resilience = agent.resilience_stats()
+    for name in ("retries", "throttled", "rejected", "failovers"):
+        extra[f"colorsense_provider_{name}"] = resilience[name]
+    extra["colorsense_provider_breaker_open"] = {
+        (("provider", provider),): int(state != "closed") for provider, state in resilience["breakers"].items()
+    }
+    extra["colorsense_provider_rate_rps"] = {
+        (("bucket", bucket),): rate for bucket, rate in resilience["rates"].items()
+    }
+    pools = agent.client_pool_stats()
+    for name in ("requests", "connections_opened", "tls_handshakes"):
+        extra[f"colorsense_http_client_{name}"] = {
+            (("provider", provider),): stats[name] for provider, stats in pools.items()
+        }
+    from .cache import get_response_cache
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        extra["colorsense_response_cache_hits"] = stats["hits"]
+        extra["colorsense_response_cache_misses"] = stats["misses"]
+    return HttpResponse(metrics.render(extra), content_type="text/plain; version=0.0.4; charset=utf-8")
 
-        # Return mesh URL
-        mesh_url = os.path.join(settings.MEDIA_URL, os.path.basename(mesh_path))
-        return render(request, "viewer.html", {"mesh_url": mesh_url})
 
-    return render(request, "upload.html")
+def reconstruction_viewer(request, job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return HttpResponseBadRequest("Unknown job.")
+    return render(request, "colorsense/3dmodel.html", {"job_id": job_id})
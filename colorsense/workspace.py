@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+from .conf import setting
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX hosts run without workspace locks
+    fcntl = None
+
+
+# Content-addressed reconstruction workspaces.
+#
+# Each workspace is named after a hash of the sorted image digests, so an
+# identical upload always lands in the same directory:
+#
+#   <root>/<digest>/images/      uploaded images, named by their own digest
+#   <root>/<digest>/database.db  COLMAP database
+#   <root>/<digest>/sparse/      sparse models and fused.ply
+#   <root>/<digest>/stages/      one marker per completed stage
+#
+# Stage markers are only written after a stage succeeds, so a rerun skips
+# exactly the work that is already on disk.
+
+STAGES = ("features", "matching", "mapping", "mesh")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def _options() -> Dict[str, Any]:
+    conf = setting("COLORSENSE_WORKSPACES", {}) or {}
+    media_root = setting("MEDIA_ROOT", "media")
+    return {
+        "root": conf.get("ROOT") or os.path.join(media_root, "reconstructions"),
+        "budget": int(float(conf.get("BUDGET_MB", 2048)) * 1024 * 1024),
+    }
+
+
+def workspace_root() -> str:
+    return _options()["root"]
+
+
+def set_digest(image_digests: Iterable[str]) -> str:
+    """Workspace key for a set of images, independent of upload order and file names."""
+    h = hashlib.sha256()
+    for digest in sorted(image_digests):
+        h.update(digest.encode("ascii"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def stage_uploads(files: List[Any]):
+    """
+    Stream uploaded files into a private staging directory, hashing them as they
+    are written. Files are named ``<upload index>_<content digest>``, so same-named
+    uploads never overwrite each other, duplicates are dropped and capture order
+    is kept for sequential matching. Returns ``(staging_dir, set_digest)``.
+    """
+    staging = os.path.join(workspace_root(), ".staging", uuid.uuid4().hex)
+    images = os.path.join(staging, "images")
+    os.makedirs(images, exist_ok=True)
+    digests = []
+    tmp_path = os.path.join(staging, "upload.part")
+    for f in files:
+        ext = os.path.splitext(getattr(f, "name", "") or "")[1].lower()
+        if ext not in IMAGE_EXTENSIONS:
+            ext = ".jpg"
+        h = hashlib.sha256()
+        with open(tmp_path, "wb") as destination:
+            for chunk in f.chunks():
+                h.update(chunk)
+                destination.write(chunk)
+        digest = h.hexdigest()
+        if digest in digests:
+            os.remove(tmp_path)
+            continue
+        os.replace(tmp_path, os.path.join(images, f"{len(digests):05d}_{digest}{ext}"))
+        digests.append(digest)
+    return staging, set_digest(digests)
+
+
+def open_workspace(digest: str, staging_dir: Optional[str] = None, root: Optional[str] = None) -> str:
+    """
+    Return the workspace for ``digest``, creating it from ``staging_dir`` if
+    needed. Pool workers have no settings, so they pass the ``root``.
+    """
+    path = os.path.join(root or workspace_root(), digest)
+    if not os.path.isdir(path) and staging_dir:
+        try:
+            os.replace(staging_dir, path)
+            staging_dir = None
+        except OSError:
+            # Lost a race with an identical upload; use the winner's workspace.
+            pass
+    if staging_dir:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(os.path.join(path, "stages"), exist_ok=True)
+    touch(path)
+    return path
+
+
+def touch(path: str) -> None:
+    """Mark a workspace as recently used for LRU eviction."""
+    marker = os.path.join(path, ".last_used")
+    with open(marker, "a"):
+        pass
+    os.utime(marker, None)
+
+
+def is_done(path: str, stage: str) -> bool:
+    return os.path.exists(os.path.join(path, "stages", stage + ".json"))
+
+
+def mark_done(path: str, stage: str, info: Dict[str, Any] = None) -> None:
+    stages = os.path.join(path, "stages")
+    os.makedirs(stages, exist_ok=True)
+    tmp = os.path.join(stages, stage + ".tmp")
+    with open(tmp, "w") as fh:
+        json.dump(dict(info or {}, finished=time.time()), fh)
+    os.replace(tmp, os.path.join(stages, stage + ".json"))
+
+
+def stage_info(path: str, stage: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(path, "stages", stage + ".json")) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def clear_from(path: str, stages: Iterable[str]) -> None:
+    """Drop the markers of ``stages`` (a stage and everything downstream of it)."""
+    for stage in stages:
+        try:
+            os.remove(os.path.join(path, "stages", stage + ".json"))
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def locked(path: str):
+    """Exclusive lock on a workspace so two jobs never write one COLMAP database."""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(path, ".lock"), "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _is_locked(path: str) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        with open(os.path.join(path, ".lock"), "a") as fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(fh, fcntl.LOCK_UN)
+    except OSError:
+        return True
+    return False
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+def eviction_budget() -> int:
+    return _options()["budget"]
+
+
+def evict(keep: Iterable[str] = (), root: str = None, budget: int = None) -> List[str]:
+    """
+    Delete least recently used workspaces until the total fits the disk budget
+    (COLORSENSE_WORKSPACES['BUDGET_MB']). Workspaces in ``keep`` or currently
+    locked by a running job are never removed. Returns the evicted paths.
+    """
+    opts = _options()
+    root = root or opts["root"]
+    budget = opts["budget"] if budget is None else budget
+    if not os.path.isdir(root):
+        return []
+    keep = {os.path.abspath(p) for p in keep}
+    entries = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(".") or not os.path.isdir(path):
+            continue
+        try:
+            used = os.path.getmtime(os.path.join(path, ".last_used"))
+        except OSError:
+            used = os.path.getmtime(path)
+        entries.append([used, path, _dir_size(path)])
+    total = sum(e[2] for e in entries)
+    evicted = []
+    for used, path, size in sorted(entries):
+        if total <= budget:
+            break
+        if os.path.abspath(path) in keep or _is_locked(path):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted.append(path)
+    return evicted
@@ -52,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'colorsense.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'paintme.urls'
@@ -125,3 +126,212 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# PaintSense agent
+# Completion cache in front of AIClient.chat. BACKEND: memory | django | sqlite | none
+COLORSENSE_RESPONSE_CACHE = {
+    'BACKEND': 'memory',
+    'TTL': 24 * 3600,
+    'MAX_ENTRIES': 512,
+    'MAX_BYTES': 32 * 1024 * 1024,
+    'PATH': os.path.join(MEDIA_ROOT, 'cache', 'responses.sqlite3'),
+    'DJANGO_CACHE': 'default',
+}
+
+# Shared keep-alive HTTP pool used by each provider client (seconds for timeouts/expiry).
+COLORSENSE_HTTP_POOL = {
+    'MAX_CONNECTIONS': 50,
+    'MAX_KEEPALIVE': 20,
+    'KEEPALIVE_EXPIRY': 60,
+    'TIMEOUT': 60,
+    'CONNECT_TIMEOUT': 5,
+}
+
+# Images are downscaled, EXIF-oriented and re-encoded without metadata before vision calls.
+COLORSENSE_IMAGE = {
+    'MAX_EDGE': 1024,
+    'FORMAT': 'JPEG',  # JPEG | WEBP
+    'QUALITY': 85,
+}
+
+# Per-image fan-out: one provider request per image, run concurrently and merged.
+# Off by default: it multiplies provider requests by the number of photos.
+COLORSENSE_FANOUT = {
+    'ENABLED': False,
+    'CONCURRENCY': 4,
+    'TIMEOUT': 45,  # per image request, seconds
+}
+
+# Background reconstruction jobs: SQLite job table and local process pool size.
+COLORSENSE_JOBS = {
+    'DB': os.path.join(MEDIA_ROOT, 'jobs.sqlite3'),
+    'WORKERS': 1,
+    # 'inline' runs jobs in a pool owned by each web process; 'external' leaves them
+    # queued for `manage.py reconstruction_worker`, keeping pycolmap/open3d out of web workers.
+    'MODE': 'inline',
+    'POLL_INTERVAL': 2,
+}
+
+# Content-addressed reconstruction workspaces, evicted least-recently-used past the budget.
+COLORSENSE_WORKSPACES = {
+    'ROOT': os.path.join(MEDIA_ROOT, 'reconstructions'),
+    'BUDGET_MB': 2048,
+}
+
+# Reconstruction pipeline. MATCHING: auto | exhaustive | sequential | spatial | vocabtree
+# THREADS: CPU threads for feature extraction and matching (-1 = all cores).
+COLORSENSE_RECONSTRUCTION = {
+    'MATCHING': 'auto',
+    'THREADS': -1,
+    'SEQUENTIAL_OVERLAP': 10,
+    'EXHAUSTIVE_MAX_IMAGES': 40,
+    'VOCAB_TREE': None,  # path to a COLMAP vocabulary tree (.bin), enables vocabtree/loop detection
+    'VOCAB_TREE_MIN_IMAGES': 100,
+    'LODS': [2000, 20000, 80000],  # triangle budgets of the mesh levels served to the viewer
+    # Point-cloud preprocessing before meshing; distances are multiples of the cloud's point spacing.
+    'VOXEL_SIZE': None,  # None = downsample only clouds above TARGET_POINTS
+    'TARGET_POINTS': 200000,
+    'OUTLIER_REMOVAL': 'statistical',  # statistical | radius | none
+    'OUTLIER_NEIGHBORS': 20,
+    'OUTLIER_STD_RATIO': 2.0,
+    'OUTLIER_RADIUS_FACTOR': 6.0,
+    'NORMAL_NEIGHBORS': 30,
+    'ORIENT_MAX_POINTS': 100000,  # larger clouds orient normals towards the centroid
+    'POISSON_DEPTH': None,  # None = chosen from point density within MIN/MAX
+    'POISSON_MIN_DEPTH': 6,
+    'POISSON_MAX_DEPTH': 11,
+    'DENSITY_TRIM': 0.02,  # drop this quantile of lowest-density Poisson vertices
+}
+
+# Content-addressed store for preprocessed chat uploads; confirm requests send ids, not images.
+COLORSENSE_IMAGE_STORE = {
+    'ROOT': os.path.join(MEDIA_ROOT, 'image_store'),
+    'TTL_HOURS': 24,
+    'GC_INTERVAL': 3600,
+}
+
+# Local color analysis of room photos, added to the prompt. With VISION off only the
+# analysis is sent (no image tokens), which lets OpenAI requests use the text model.
+COLORSENSE_PALETTE = {
+    'ENABLED': True,
+    'VISION': True,
+    'COLORS': 5,
+    'SAMPLE_EDGE': 128,
+}
+
+# Manufacturer paint catalog (CSV or JSON with name, hex and optional brand/code columns).
+# Suggested swatches are snapped to the closest paints by CIEDE2000; the compiled index
+# is cached in CACHE_DIR. Leave PATH unset to disable matching.
+COLORSENSE_CATALOG = {
+    'PATH': None,
+    'CACHE_DIR': os.path.join(MEDIA_ROOT, 'cache'),
+    'MATCHES': 3,
+}
+
+# 2D wall recolor previews: flood-fill wall segmentation plus LAB recoloring.
+COLORSENSE_PREVIEW = {
+    'MAX_EDGE': 768,
+    'L_TOLERANCE': 30,
+    'AB_TOLERANCE': 8,
+    'CACHE_ENTRIES': 16,
+    'QUALITY': 85,
+}
+
+# Provider call scheduling: per provider (or "provider:model") token buckets that halve
+# on 429 and creep back up, jittered retries honoring Retry-After, a circuit breaker per
+# provider and failover to the other provider when one stays unavailable. Set
+# OPENAI_BASE_URL / GROQ_BASE_URL (env or here) to point the clients at a stub server.
+COLORSENSE_RESILIENCE = {
+    'MAX_ATTEMPTS': 4,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 20,
+    'BREAKER_FAILURES': 5,
+    'BREAKER_RESET': 30,
+    'FAILOVER': True,
+    'RATE_LIMITS': {
+        'groq': {'RPS': 4, 'BURST': 8},
+        'openai': {'RPS': 8, 'BURST': 16},
+    },
+}
+
+# Prompt token budget: MAX_TOKENS of input per request (capped by the model's context window
+# minus REPLY_TOKENS), split between the system prompt, user text, documents and images.
+# Documents are read in chunks of about CHUNK_TOKENS and the most relevant ones are kept.
+COLORSENSE_PROMPT = {
+    'MAX_TOKENS': 8000,
+    'REPLY_TOKENS': 2000,
+    'SPLIT': {'SYSTEM': 0.1, 'USER': 0.2, 'DOCS': 0.4, 'IMAGES': 0.3},
+    'CHUNK_TOKENS': 300,
+    'DOC_MAX_BYTES': 2 * 1024 * 1024,
+}
+
+# Offline stub provider (get_client("stub")) with canned JSON replies, used by the
+# benchmark command. LATENCY is seconds per request (+/- JITTER as a fraction); streams
+# send CHUNK_CHARS characters every CHUNK_DELAY seconds. ERROR_RATE injects 503s.
+COLORSENSE_STUB = {
+    'ENABLED': False,
+    'LATENCY': 0.8,
+    'JITTER': 0.2,
+    'CHUNK_CHARS': 24,
+    'CHUNK_DELAY': 0.01,
+    'ERROR_RATE': 0.0,
+    'SEED': 0,
+}
+
+# Instrumentation: stage spans and request timings served at /metrics (Prometheus text).
+# SERVER_TIMING adds a Server-Timing header per response; with PROFILE on, a request sent
+# with "X-Profile: 1" (or ?profile=1) is sampled and the collapsed stacks are written to
+# PROFILE_DIR. Set TOKEN to require "Authorization: Bearer <token>" on /metrics.
+COLORSENSE_METRICS = {
+    'ENABLED': True,
+    'SERVER_TIMING': DEBUG,
+    'PROFILE': DEBUG,
+    'PROFILE_INTERVAL': 0.005,
+    'PROFILE_DIR': os.path.join(MEDIA_ROOT, 'profiles'),
+    'TOKEN': None,
+}
+
+# Consultation history (colorsense/history.py): answered requests are stored for replay and
+# review. With REPLAY, an identical request made within REPLAY_TTL seconds is answered from the
+# stored result instead of the provider; off by default so asking again gets a fresh suggestion
+# (stored answers are always available by id). PAGE_SIZE is the review queue page; DOCS_MAX_CHARS
+# caps the notes kept per request.
+COLORSENSE_HISTORY = {
+    'ENABLED': True,
+    'REPLAY': False,
+    'REPLAY_TTL': 3600,
+    'PAGE_SIZE': 50,
+    'DOCS_MAX_CHARS': 20000,
+}
+
+# Per-user color preference profiles (colorsense/reflection.py), learned from accepted and
+# rejected paint suggestions and summarized into suggestion prompts. DECAY fades older feedback;
+# REJECT_WEIGHT scales rejections against acceptances. Profiles are cached per process and
+# written back every WRITE_BACK seconds; CATALOG_CANDIDATES paints that fit are listed.
+COLORSENSE_PROFILES = {
+    'ENABLED': True,
+    'DECAY': 0.85,
+    'REJECT_WEIGHT': 0.5,
+    'NEUTRAL_CHROMA': 10,
+    'MAX_CACHED': 2048,
+    'CACHE_TTL': 300,
+    'WRITE_BACK': 10,
+    'CATALOG_CANDIDATES': 6,
+}
+
+# Resumable chunked photo uploads for reconstruction (colorsense/uploads.py). Clients PUT files in
+# CHUNK_SIZE pieces (at most MAX_CHUNK bytes each) and resume from the offset the server reports.
+# Finished files are header-checked against FORMATS/MAX_PIXELS and stored once by content;
+# every EXTRACT_BATCH finished files are feature-extracted while the rest upload (0 disables).
+# Sessions idle for TTL_HOURS, and stored files no workspace uses, are purged every GC_INTERVAL seconds.
+COLORSENSE_UPLOADS = {
+    'CHUNK_SIZE': 8 * 1024 * 1024,
+    'MAX_CHUNK': 32 * 1024 * 1024,
+    'MAX_FILE_MB': 200,
+    'MAX_FILES': 1000,
+    'MAX_PIXELS': 100_000_000,
+    'FORMATS': ['JPEG', 'PNG', 'WEBP', 'TIFF', 'BMP', 'MPO'],
+    'EXTRACT_BATCH': 8,
+    'TTL_HOURS': 24,
+    'GC_INTERVAL': 3600,
+}